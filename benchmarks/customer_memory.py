@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+'''
+Measures the memory taken by a large list of loaded customers.
+
+A synthetic customers xml document is built by copying the customer in
+tests/files/customers-with-items.xml, giving each copy a year of invoices.
+The customers are then loaded the usual way and the total size of every
+object reachable from them is reported, once with the slotted invoice and
+charge records the parser returns and once with those records swapped for
+the plain dicts older versions of sharpy used.
+
+Usage: python benchmarks/customer_memory.py [customers] [invoices]
+'''
+from copy import deepcopy
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lxml.etree import tostring, XML
+
+from sharpy.parsers import CustomersParser
+from sharpy.product import CheddarProduct
+from sharpy.product import Customer
+
+FILES_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests', 'files')
+
+
+def build_xml(customer_count, invoice_count):
+    f = open(os.path.join(FILES_DIR, 'customers-with-items.xml'))
+    template = XML(f.read())[0]
+    f.close()
+
+    invoices = template.find('subscriptions/subscription/invoices')
+    invoice = invoices[0]
+    invoices.remove(invoice)
+    for n in xrange(invoice_count):
+        invoice = deepcopy(invoice)
+        invoice.set('id', 'invoice-%d' % n)
+        invoice.find('number').text = str(n + 1)
+        invoices.append(invoice)
+
+    customer_xml = tostring(template)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<customers>']
+    for n in xrange(customer_count):
+        parts.append(customer_xml.replace('code="test"',
+                                          'code="customer-%d"' % n, 1))
+    parts.append('</customers>')
+
+    return ''.join(parts)
+
+
+def deep_size(root, exclude):
+    seen = set(id(obj) for obj in exclude)
+    pending = [root]
+    size = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+
+    return size
+
+
+def records_to_dicts(customers):
+    for customer in customers:
+        subscription = customer.subscription
+        invoices = []
+        for invoice in subscription.invoices:
+            invoice = invoice.to_dict()
+            invoice['charges'] = [charge.to_dict()
+                                  for charge in invoice['charges']]
+            invoices.append(invoice)
+        subscription.invoices = invoices
+        if subscription.gateway_account is not None:
+            subscription.gateway_account = \
+                subscription.gateway_account.to_dict()
+
+
+def main(customer_count=2000, invoice_count=12):
+    product = CheddarProduct('user', 'password', 'PRODUCT')
+    content = build_xml(customer_count, invoice_count)
+    print '%d customers, %d invoices each, %.1f MB of xml' % (
+        customer_count, invoice_count, len(content) / 1024.0 / 1024)
+
+    start = time.time()
+    customers_data = CustomersParser().parse_xml(content)
+    customers = [Customer(product=product, **customer_data)
+                 for customer_data in customers_data]
+    elapsed = time.time() - start
+    del customers_data
+
+    exclude = [product, product.__dict__]
+    slotted = deep_size(customers, exclude)
+    records_to_dicts(customers)
+    plain = deep_size(customers, exclude)
+
+    print 'loaded in %.2fs' % elapsed
+    print '%-20s %10s %12s' % ('', 'total (MB)', 'per customer')
+    for label, size in (('records', slotted), ('dicts', plain)):
+        print '%-20s %10.1f %12d' % (label, size / 1024.0 / 1024,
+                                     size / customer_count)
+    print 'records use %.0f%% of the memory of dicts' % (
+        100.0 * slotted / plain)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
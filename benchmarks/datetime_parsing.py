@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+'''
+Compares sharpy's ISO 8601 datetime fast path against plain
+dateutil.parser.parse by parsing every fixture in tests/files.
+
+Usage: python benchmarks/datetime_parsing.py [repeat]
+'''
+import os
+import sys
+import timeit
+
+from dateutil import parser as date_parser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sharpy.parsers import CheddarOutputParser
+from sharpy.parsers import CustomersParser
+from sharpy.parsers import PlansParser
+from sharpy.parsers import PromotionsParser
+
+FILES_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests', 'files')
+
+PARSERS = {
+    'customers-with-items.xml': CustomersParser,
+    'customers-without-items.xml': CustomersParser,
+    'paypal_customer.xml': CustomersParser,
+    'plans.xml': PlansParser,
+    'plans_with_items.xml': PlansParser,
+    'promotions.xml': PromotionsParser,
+}
+
+
+def dateutil_parse_datetime(self, content):
+    value = None
+    if content:
+        value = date_parser.parse(content)
+
+    return value
+
+
+def time_parse(parser_class, content, repeat):
+    parser = parser_class()
+
+    def run():
+        # Empty the memo so repeated runs measure parsing, not lookups
+        CheddarOutputParser.datetime_memo.clear()
+        parser.parse_xml(content)
+
+    return min(timeit.repeat(run, number=1, repeat=repeat))
+
+
+def main(repeat=200):
+    fast_total = 0
+    slow_total = 0
+    print '%-30s %12s %14s %8s' % ('fixture', 'fast (ms)', 'dateutil (ms)',
+                                   'speedup')
+    for filename in sorted(PARSERS):
+        f = open(os.path.join(FILES_DIR, filename))
+        content = f.read()
+        f.close()
+        parser_class = PARSERS[filename]
+
+        fast = time_parse(parser_class, content, repeat)
+
+        class DateutilParser(parser_class):
+            parse_datetime = dateutil_parse_datetime
+
+        slow = time_parse(DateutilParser, content, repeat)
+
+        fast_total += fast
+        slow_total += slow
+        print '%-30s %12.3f %14.3f %7.1fx' % (filename, fast * 1000,
+                                               slow * 1000, slow / fast)
+
+    print '%-30s %12.3f %14.3f %7.1fx' % ('total', fast_total * 1000,
+                                           slow_total * 1000,
+                                           slow_total / fast_total)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
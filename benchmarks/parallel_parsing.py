@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+'''
+Compares parsing a large customers document in one process with parsing
+it across process pools of increasing size.
+
+The document is built as in customer_memory.py, by copying the customer in
+tests/files/customers-with-items.xml and giving each copy some invoices.
+Each pool is started before its timing begins, so only the split, the
+parsing and the merge are measured.
+
+Usage: python benchmarks/parallel_parsing.py [customers] [invoices]
+'''
+from multiprocessing import cpu_count, Pool
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from customer_memory import build_xml
+
+from sharpy.parsers import CustomersParser
+
+
+def main(customer_count=20000, invoice_count=12):
+    xml_str = build_xml(customer_count, invoice_count)
+    print 'Parsing %d customers (%.1f MB) on %d cpus' % (
+        customer_count, len(xml_str) / 1e6, cpu_count())
+    parser = CustomersParser()
+
+    started = time.time()
+    expected = parser.parse_xml(xml_str)
+    serial = time.time() - started
+    print '%-12s %8.2f s' % ('serial', serial)
+
+    processes = 2
+    while processes <= max(cpu_count(), 2):
+        pool = Pool(processes)
+        try:
+            started = time.time()
+            result = parser.parse_xml(xml_str, processes=processes, pool=pool)
+            elapsed = time.time() - started
+        finally:
+            pool.close()
+            pool.join()
+        assert len(result) == len(expected)
+        print '%-12s %8.2f s  %5.2fx' % ('%d processes' % processes, elapsed,
+                                         serial / elapsed)
+        processes *= 2
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
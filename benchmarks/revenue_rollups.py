@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+'''
+Times the sharpy.revenue rollups and sharpy.cohorts analyses over a large
+customer base.
+
+CustomerTables are built from the customers in tests/files, then every
+table is repeated until there are the requested number of customers, with
+their signup and cancellation dates spread over three years and their
+plans spread over a few billing frequencies.
+
+Usage: python benchmarks/revenue_rollups.py [customers]
+'''
+from collections import OrderedDict
+from datetime import date
+import os
+from StringIO import StringIO
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'tests'))
+
+import numpy
+
+from sharpy import cohorts, revenue
+from sharpy.columnar import CustomerTables, Table
+
+from testing_tools.fixtures import build_customers_xml
+
+
+def build_tables(customer_count):
+    template = CustomerTables.from_xml(StringIO(build_customers_xml()))
+    copies = -(-customer_count // len(template.customers))
+    random = numpy.random.RandomState(0)
+    seconds = 3 * 365 * 86400
+    tables = OrderedDict()
+
+    for name, table in template.tables.items():
+        if name == 'plans':
+            tables[name] = table
+            continue
+        columns = OrderedDict()
+        for column in table.keys():
+            values = numpy.tile(table[column], copies)
+            if column in ('customer', 'invoice'):
+                rows = len(getattr(template, column + 's'))
+                offsets = numpy.repeat(numpy.arange(copies) * rows,
+                                       len(table))
+                values = values + offsets
+            columns[column] = values
+        tables[name] = Table(name, columns, table.categories)
+
+    subscriptions = tables['subscriptions']
+    count = len(subscriptions)
+    created = (numpy.datetime64('2011-01-01T00:00:00') +
+               random.randint(0, seconds, count).astype('timedelta64[s]'))
+    canceled = created + random.randint(
+        0, seconds, count).astype('timedelta64[s]')
+    canceled[random.rand(count) < 0.7] = numpy.datetime64('NaT')
+    subscriptions.columns['created'] = created
+    subscriptions.columns['canceled'] = canceled
+
+    plans = template.plans
+    plans['billing_frequency_quantity'][:] = [1, 1, 3]
+    plans['trial_days'][:] = [30, 0, 0]
+
+    return CustomerTables(tables, template.plan_codes, template.item_codes,
+                          template.charge_codes)
+
+
+def timed(label, function, *args):
+    started = time.time()
+    function(*args)
+    print '%-26s %8.1f ms' % (label, (time.time() - started) * 1000)
+
+
+def main(customer_count=200000):
+    print 'Building tables for %d customers...' % customer_count
+    tables = build_tables(customer_count)
+    at = date(2013, 1, 1)
+
+    timed('mrr', revenue.mrr, tables, at)
+    timed('arr', revenue.arr, tables, at)
+    timed('mrr_by_plan', revenue.mrr_by_plan, tables, at)
+    timed('mrr_by_campaign_source', revenue.mrr_by_campaign_source,
+          tables, at)
+    timed('plan_mix', revenue.plan_mix, tables, at)
+    timed('mrr_by_month', revenue.mrr_by_month, tables,
+          date(2011, 1, 1), date(2014, 1, 1))
+    timed('charge_totals', revenue.charge_totals, tables)
+    timed('charge_totals_by_code', revenue.charge_totals_by_code, tables)
+    timed('charge_totals_by_month', revenue.charge_totals_by_month, tables,
+          date(2011, 1, 1), date(2014, 1, 1))
+    timed('signup_cohorts', cohorts.signup_cohorts, tables,
+          date(2011, 1, 1), date(2014, 1, 1))
+    timed('retention', cohorts.retention, tables, date(2011, 1, 1),
+          date(2014, 1, 1), 24, at)
+    timed('churn_by_plan', cohorts.churn_by_plan, tables, date(2012, 1, 1),
+          at)
+    timed('churn_by_cancel_reason', cohorts.churn_by_cancel_reason, tables,
+          date(2012, 1, 1), at)
+    timed('monthly_churn', cohorts.monthly_churn, tables, date(2011, 1, 1),
+          date(2014, 1, 1))
+    timed('trial_conversion', cohorts.trial_conversion, tables, at)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
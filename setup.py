@@ -17,6 +17,7 @@ setup(
     license="BSD",
     long_description=open('README.rst').read(),
     install_requires=['httplib2', 'elementtree', 'python-dateutil<2.0'],
+    extras_require={'columnar': ['numpy']},
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',
@@ -0,0 +1,163 @@
+from multiprocessing.pool import ThreadPool
+import threading
+
+from sharpy.client import Client
+from sharpy.pool import HttpPool
+from sharpy.product import CheddarProduct
+
+
+class AsyncClient(Client):
+    '''
+    A Client which can issue requests without blocking the caller.
+
+    Requests are run on a bounded pool of worker threads sharing the
+    client's keep-alive connections.  Each *_async method returns a
+    multiprocessing.pool.AsyncResult; call get() on it to wait for the
+    result.  Cheddar errors (AccessDenied, NotFound, NaughtyGateway, ...)
+    are raised from get() exactly as make_request would raise them.
+    '''
+    default_workers = 10
+
+    def __init__(self, username, password, product_code, cache=None,
+                 timeout=None, endpoint=None, pool=None, workers=None,
+                 retry_policy=None, circuit_breaker=None, rate_limiter=None,
+                 coalesce=True):
+        '''
+        workers - Maximum number of requests in flight at once (optional)
+
+        The other arguments are as for Client.
+        '''
+        self.workers = workers or self.default_workers
+        if pool is None:
+            pool = HttpPool(cache=cache, timeout=timeout,
+                            max_per_host=self.workers)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+        super(AsyncClient, self).__init__(username, password, product_code,
+                                          cache, timeout, endpoint, pool,
+                                          retry_policy, circuit_breaker,
+                                          rate_limiter, coalesce)
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPool(self.workers)
+
+        return self._executor
+
+    def submit(self, func, *args, **kwargs):
+        '''
+        Runs func(*args, **kwargs) on the worker pool and returns an
+        AsyncResult.
+        '''
+        return self.executor.apply_async(func, args, kwargs)
+
+    def make_request_async(self, path, params=None, data=None, method=None,
+                           idempotent=None, mutation=None):
+        '''
+        Non-blocking version of make_request.
+        '''
+        return self.submit(self.make_request, path, params, data, method,
+                           idempotent, mutation)
+
+    def close(self):
+        '''
+        Waits for in flight requests to finish, stops the worker threads and
+        closes any idle connections.
+        '''
+        with self._executor_lock:
+            executor = self._executor
+            self._executor = None
+
+        if executor is not None:
+            executor.close()
+            executor.join()
+
+        super(AsyncClient, self).close()
+
+
+class AsyncCheddarProduct(CheddarProduct):
+    '''
+    A CheddarProduct with non-blocking versions of its most common calls.
+
+    The blocking methods inherited from CheddarProduct keep working as
+    usual, and customers returned by the *_async methods are ordinary
+    Customer objects bound to this product.
+    '''
+
+    def __init__(self, username, password, product_code, cache=None,
+                 timeout=None, endpoint=None, pool=None, workers=None,
+                 retry_policy=None, circuit_breaker=None, rate_limiter=None,
+                 refresh=None, result_cache=None, journal=None):
+        '''
+        workers - Maximum number of requests in flight at once (optional)
+
+        The other arguments are as for CheddarProduct.
+        '''
+        super(AsyncCheddarProduct, self).__init__(
+            username, password, product_code, cache, timeout, endpoint, pool,
+            result_cache=result_cache, retry_policy=retry_policy,
+            circuit_breaker=circuit_breaker, rate_limiter=rate_limiter,
+            journal=journal, refresh=refresh)
+        self.client = AsyncClient(
+            username,
+            password,
+            product_code,
+            cache,
+            timeout,
+            endpoint,
+            pool,
+            workers,
+            retry_policy,
+            circuit_breaker,
+            rate_limiter,
+        )
+
+    def __repr__(self):
+        return u'AsyncCheddarProduct: %s' % self.product_code
+
+    def get_customers_async(self, filter_data=None, **filters):
+        return self.client.submit(self.get_customers, filter_data, **filters)
+
+    def get_customer_async(self, code):
+        return self.client.submit(self.get_customer, code)
+
+    def create_customer_async(self, *args, **kwargs):
+        return self.client.submit(self.create_customer, *args, **kwargs)
+
+    def charge_async(self, customer, code, each_amount, quantity=1,
+                     description=None, refresh=None):
+        '''
+        Non-blocking version of Customer.charge.  The AsyncResult resolves
+        to the customer once it has been reloaded.
+        '''
+        def charge():
+            customer.charge(code, each_amount, quantity, description,
+                            refresh)
+            return customer
+
+        return self.client.submit(charge)
+
+    def increment_async(self, item, quantity=None, refresh=None):
+        '''
+        Non-blocking version of Item.increment.  The AsyncResult resolves
+        to the item once its customer has been reloaded.
+        '''
+        def increment():
+            item.increment(quantity, refresh)
+            return item
+
+        return self.client.submit(increment)
+
+    def replay_journal_async(self, include_sent=False, workers=1):
+        '''
+        Non-blocking version of replay_journal, for sending requests queued
+        with queue_customer_request in the background.
+        '''
+        return self.client.submit(self.replay_journal, include_sent, workers)
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,274 @@
+from collections import deque
+import httplib
+import logging
+import socket
+import threading
+from time import time
+
+from sharpy.exceptions import CheddarError
+from sharpy.pool import PoolTimeout
+from sharpy.ratelimit import RateLimited
+
+client_log = logging.getLogger('SharpyClient')
+
+
+class CircuitOpen(Exception):
+    "A request was refused without being sent as cheddar appears to be down"
+
+    def __init__(self, message, retry_after=None):
+        super(CircuitOpen, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    '''
+    Stops sending requests to cheddar while it appears to be down, so
+    callers fail straight away instead of each waiting out a timeout.
+
+    The breaker starts closed and lets every request through.  It opens
+    after failure_threshold failures in a row, or once error_rate of the
+    last window_size requests have failed (and at least min_requests have
+    been made).  While open, requests raise CircuitOpen without being sent.
+    After reset_timeout seconds the breaker goes half-open and lets up to
+    half_open_max trial requests through: if they all succeed it closes
+    again, if any fails it opens for another reset_timeout.
+
+    Only transient failures count (5xx responses, socket errors and
+    httplib errors); a 404 or validation error means cheddar is up.
+    Requests refused locally without being sent (by a rate limiter,
+    connection pool or another breaker) count as neither, and give back
+    any trial slot they took.
+
+    on_state_change, if given, is called as on_state_change(breaker,
+    old_state, new_state) on every transition.  One breaker may be shared
+    between clients talking to the same endpoint.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    default_failure_threshold = 5
+    default_window_size = 20
+    default_min_requests = 10
+    default_reset_timeout = 30
+    default_half_open_max = 1
+    failure_statuses = frozenset([500, 502, 503, 504])
+    failure_exceptions = (socket.error, httplib.HTTPException)
+    not_sent_exceptions = (CircuitOpen, RateLimited, PoolTimeout)
+
+    def __init__(self, failure_threshold=None, error_rate=None,
+                 window_size=None, min_requests=None, reset_timeout=None,
+                 half_open_max=None, failure_statuses=None,
+                 failure_exceptions=None, on_state_change=None):
+        '''
+        failure_threshold - Consecutive failures which open the breaker. 0
+                            turns this check off. (optional)
+        error_rate - Fraction of failed requests in the window, from 0 to
+                     1, which opens the breaker. Off by default. (optional)
+        window_size - Number of recent requests error_rate is measured
+                      over (optional)
+        min_requests - Requests needed in the window before error_rate is
+                       checked (optional)
+        reset_timeout - Seconds to stay open before trying again (optional)
+        half_open_max - Trial requests let through while half-open
+                        (optional)
+        failure_statuses - HTTP status codes counted as failures (optional)
+        failure_exceptions - Exception classes counted as failures
+                             (optional)
+        on_state_change - Called with (breaker, old_state, new_state) when
+                          the state changes (optional)
+        '''
+        if failure_threshold is None:
+            failure_threshold = self.default_failure_threshold
+        self.failure_threshold = failure_threshold
+        self.error_rate = error_rate
+        if window_size is None:
+            window_size = self.default_window_size
+        if min_requests is None:
+            min_requests = min(self.default_min_requests, window_size)
+        self.min_requests = min_requests
+        if reset_timeout is None:
+            reset_timeout = self.default_reset_timeout
+        self.reset_timeout = reset_timeout
+        if half_open_max is None:
+            half_open_max = self.default_half_open_max
+        self.half_open_max = max(half_open_max, 1)
+        if failure_statuses is not None:
+            self.failure_statuses = frozenset(failure_statuses)
+        if failure_exceptions is not None:
+            self.failure_exceptions = tuple(failure_exceptions)
+        self.on_state_change = on_state_change
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._consecutive_failures = 0
+        self._window = deque(maxlen=window_size)
+        self._trials = 0
+        self._trial_successes = 0
+        self.stats = {
+            'successes': 0,
+            'failures': 0,
+            'rejected': 0,
+            'opened': 0,
+        }
+
+        super(CircuitBreaker, self).__init__()
+
+    @property
+    def state(self):
+        with self._lock:
+            transitions = self._check_reset(time())
+        self._notify(transitions)
+
+        return self._state
+
+    def is_failure(self, error):
+        '''
+        Returns True if error suggests cheddar is unavailable.
+        '''
+        if isinstance(error, CheddarError):
+            return error.response.status in self.failure_statuses
+
+        return isinstance(error, self.failure_exceptions)
+
+    def call(self, func):
+        '''
+        Calls func if the breaker allows it, recording whether it failed.
+        Raises CircuitOpen without calling func if the breaker is open.
+        '''
+        self.before_call()
+        try:
+            result = func()
+        except Exception, e:
+            if isinstance(e, self.not_sent_exceptions):
+                self.record_not_sent()
+            elif self.is_failure(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        self.record_success()
+
+        return result
+
+    def before_call(self):
+        now = time()
+        with self._lock:
+            transitions = self._check_reset(now)
+            rejected = None
+            if self._state == self.OPEN:
+                rejected = self._opened_at + self.reset_timeout - now
+            elif self._state == self.HALF_OPEN:
+                if self._trials >= self.half_open_max:
+                    rejected = 0
+                else:
+                    self._trials += 1
+            if rejected is not None:
+                self.stats['rejected'] += 1
+        self._notify(transitions)
+
+        if rejected is not None:
+            raise CircuitOpen('Not sending request, cheddar is unavailable',
+                              retry_after=max(rejected, 0))
+
+    def record_success(self):
+        with self._lock:
+            self.stats['successes'] += 1
+            self._consecutive_failures = 0
+            self._window.append(True)
+            transitions = []
+            if self._state == self.HALF_OPEN:
+                self._trial_successes += 1
+                if self._trial_successes >= self.half_open_max:
+                    self._window.clear()
+                    transitions.append(self._set_state(self.CLOSED))
+        self._notify(transitions)
+
+    def record_not_sent(self):
+        '''
+        Gives back the trial slot of a request which was never sent.
+        '''
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._trials > 0:
+                self._trials -= 1
+
+    def record_failure(self):
+        with self._lock:
+            self.stats['failures'] += 1
+            self._consecutive_failures += 1
+            self._window.append(False)
+            transitions = []
+            if self._state == self.HALF_OPEN or (
+                    self._state == self.CLOSED and self._should_open()):
+                transitions.append(self._open(time()))
+        self._notify(transitions)
+
+    def reset(self):
+        '''
+        Closes the breaker and forgets past failures.
+        '''
+        with self._lock:
+            self._consecutive_failures = 0
+            self._window.clear()
+            transitions = [self._set_state(self.CLOSED)]
+        self._notify(transitions)
+
+    def get_stats(self):
+        '''
+        Returns the current state with counts of successful, failed and
+        rejected requests and the number of times the breaker has opened.
+        '''
+        stats = {'state': self.state}
+        with self._lock:
+            stats.update(self.stats)
+
+        return stats
+
+    def _should_open(self):
+        # Called with the lock held
+        if (self.failure_threshold and
+                self._consecutive_failures >= self.failure_threshold):
+            return True
+
+        if self.error_rate is not None and \
+                len(self._window) >= self.min_requests:
+            failures = self._window.count(False)
+            if failures >= self.error_rate * len(self._window):
+                return True
+
+        return False
+
+    def _check_reset(self, now):
+        # Called with the lock held
+        if self._state == self.OPEN and \
+                now >= self._opened_at + self.reset_timeout:
+            return [self._set_state(self.HALF_OPEN)]
+
+        return []
+
+    def _open(self, now):
+        # Called with the lock held
+        self._opened_at = now
+        self.stats['opened'] += 1
+
+        return self._set_state(self.OPEN)
+
+    def _set_state(self, state):
+        # Called with the lock held.  Returns the transition so the hook
+        # can be called once the lock is released.
+        old_state = self._state
+        self._state = state
+        self._trials = 0
+        self._trial_successes = 0
+
+        return old_state, state
+
+    def _notify(self, transitions):
+        for old_state, new_state in transitions:
+            if old_state == new_state:
+                continue
+            client_log.warning('Circuit breaker %s -> %s' % (old_state,
+                                                            new_state))
+            if self.on_state_change is not None:
+                self.on_state_change(self, old_state, new_state)
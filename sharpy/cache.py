@@ -0,0 +1,397 @@
+from collections import OrderedDict
+import cPickle as pickle
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+from time import time
+
+
+class CacheBackend(object):
+    '''
+    Base class for caches of parsed cheddar results.
+
+    Entries are fresh for ttl seconds after they are set.  If stale_ttl is
+    given, expired entries are kept for that many more seconds so callers
+    can serve the stale value while they refresh it.
+
+    Several users (such as products) can share a backend by keying their
+    entries with a namespace's generation (see get_generation), so one of
+    them can drop its own entries with clear_namespace.  Keys invalidated
+    with invalidate get a new version, which lets a caller who loaded a
+    value before the invalidation skip caching it (see set_if_version).
+
+    Subclasses implement load, store, delete and clear.  Backends which
+    serialize values (and so hand out a new copy on every read) should set
+    serializes to True.
+    '''
+    FRESH = 'fresh'
+    STALE = 'stale'
+    MISSING = 'missing'
+
+    default_ttl = 300
+    serializes = False
+    generation_prefix = 'generation:'
+    version_prefix = 'version:'
+    # Seconds a key's version outlives its invalidation, which should be
+    # longer than any load
+    version_ttl = 3600
+
+    def __init__(self, ttl=None, stale_ttl=None):
+        '''
+        ttl - Seconds an entry stays fresh (optional)
+        stale_ttl - Seconds past expiry an entry may still be served while
+                    it is refreshed. Stale entries are not kept by
+                    default. (optional)
+        '''
+        if ttl is None:
+            ttl = self.default_ttl
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl or 0
+
+        super(CacheBackend, self).__init__()
+
+    def load(self, key):
+        '''
+        Returns the (value, expires) pair stored for key, or None.
+        '''
+        raise NotImplementedError
+
+    def store(self, key, value, expires):
+        '''
+        Stores value under key.  The entry may be discarded once the
+        expires timestamp plus stale_ttl has passed.
+        '''
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def lookup(self, key):
+        '''
+        Returns a (value, state) tuple where state is one of FRESH, STALE or
+        MISSING.  The value is None when the state is MISSING.
+        '''
+        entry = self.load(key)
+        if entry is None:
+            return None, self.MISSING
+
+        value, expires = entry
+        now = time()
+        if now < expires:
+            return value, self.FRESH
+        elif now < expires + self.stale_ttl:
+            return value, self.STALE
+
+        self.delete(key)
+        return None, self.MISSING
+
+    def get(self, key, default=None):
+        '''
+        Returns the fresh value for key, or default.
+        '''
+        value, state = self.lookup(key)
+        if state != self.FRESH:
+            return default
+
+        return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+
+        self.store(key, value, time() + ttl)
+
+    def get_generation(self, namespace):
+        '''
+        Returns the current generation of namespace, starting one if it
+        has none.
+        '''
+        entry = self.load(self.generation_prefix + namespace)
+        if entry is not None:
+            return entry[0]
+
+        return self.clear_namespace(namespace)
+
+    def clear_namespace(self, namespace):
+        '''
+        Starts a new generation of namespace and returns it.  Entries keyed
+        with an older generation are no longer looked up and are left to
+        expire, so other namespaces in the backend keep their entries.
+        '''
+        generation = new_token()
+        self.store(self.generation_prefix + namespace, generation,
+                   float('inf'))
+
+        return generation
+
+    def get_version(self, key):
+        '''
+        Returns a token which changes whenever key is invalidated, or None.
+        '''
+        entry = self.load(self.version_prefix + key)
+        if entry is None:
+            return None
+
+        return entry[0]
+
+    def invalidate(self, key):
+        '''
+        Deletes key and gives it a new version.
+        '''
+        self.store(self.version_prefix + key, new_token(),
+                   time() + self.version_ttl)
+        self.delete(key)
+
+    def set_if_version(self, key, value, version, ttl=None):
+        '''
+        Sets key to value unless key has been invalidated since
+        get_version returned version, and returns whether it was set.
+        '''
+        if self.get_version(key) != version:
+            return False
+
+        self.set(key, value, ttl)
+        return True
+
+
+def new_token():
+    return os.urandom(8).encode('hex')
+
+
+class LRUCache(CacheBackend):
+    '''
+    A thread safe, in-process cache with per entry expiry and least
+    recently used eviction.  Values are stored as is, without copying.
+
+    Namespace generations and key versions are kept apart from the
+    entries and never evicted (versions are dropped once they expire), so
+    evicting entries can't make set_if_version forget an invalidation.
+    '''
+    default_max_entries = 1024
+
+    def __init__(self, max_entries=None, ttl=None, stale_ttl=None):
+        '''
+        max_entries - Maximum number of entries before the least recently
+                      used ones are evicted (optional)
+        '''
+        self.max_entries = max_entries or self.default_max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generations = {}
+        # In expiry order, as every version has the same ttl
+        self._versions = OrderedDict()
+
+        super(LRUCache, self).__init__(ttl, stale_ttl)
+
+    def get_markers(self, key):
+        # Returns the dict a generation or version is kept in, or None for
+        # ordinary entries
+        if key.startswith(self.generation_prefix):
+            return self._generations
+        if key.startswith(self.version_prefix):
+            return self._versions
+
+        return None
+
+    def load(self, key):
+        markers = self.get_markers(key)
+        with self._lock:
+            if markers is not None:
+                return markers.get(key)
+
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                return None
+
+            # Re-insert to mark the entry as most recently used
+            self._entries[key] = entry
+
+        return entry
+
+    def store(self, key, value, expires):
+        markers = self.get_markers(key)
+        with self._lock:
+            if markers is not None:
+                markers.pop(key, None)
+                markers[key] = (value, expires)
+                self._expire_versions(time())
+                return
+
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        markers = self.get_markers(key)
+        if markers is None:
+            markers = self._entries
+        with self._lock:
+            markers.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+            self._versions.clear()
+
+    def _expire_versions(self, now):
+        # Called with the lock held
+        while self._versions:
+            key, (value, expires) = next(self._versions.iteritems())
+            if expires > now:
+                break
+            del self._versions[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FileCache(CacheBackend):
+    '''
+    A cache which pickles each entry into its own file in a directory, so
+    any number of processes on a host can share it.
+
+    Entries are written to a temporary file and renamed into place, so
+    readers never see a partial entry.  Only point this at a directory
+    which is not writable by untrusted users, as entries are unpickled
+    when read.
+    '''
+    serializes = True
+    suffix = '.sharpy-cache'
+
+    def __init__(self, directory, ttl=None, stale_ttl=None):
+        '''
+        directory - The directory to keep cache files in. It is created if
+                    it doesn't exist.
+        '''
+        self.directory = directory
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        super(FileCache, self).__init__(ttl, stale_ttl)
+
+    def get_path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        filename = hashlib.md5(key).hexdigest() + self.suffix
+
+        return os.path.join(self.directory, filename)
+
+    def load(self, key):
+        try:
+            f = open(self.get_path(key), 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+        try:
+            try:
+                expires, value = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError, ValueError):
+                return None
+        finally:
+            f.close()
+
+        return value, expires
+
+    def store(self, key, value, expires):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump((expires, value), f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(temp_path, self.get_path(key))
+        except Exception:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+    def delete(self, key):
+        try:
+            os.remove(self.get_path(key))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def clear(self):
+        '''
+        Deletes every entry in the directory, whoever set it.  Use
+        clear_namespace to drop only one product's entries.
+        '''
+        for filename in os.listdir(self.directory):
+            if filename.endswith(self.suffix):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+
+class MemcachedCache(CacheBackend):
+    '''
+    A cache stored in memcached (or anything speaking its protocol), so
+    processes on many hosts can share it.
+
+    client - A memcache client object, such as memcache.Client from
+             python-memcached, providing get, set, delete and flush_all
+    '''
+    serializes = True
+    key_prefix = 'sharpy:'
+    # Memcached reads longer lifetimes as unix timestamps
+    max_lifetime = 30 * 24 * 3600
+
+    def __init__(self, client, ttl=None, stale_ttl=None):
+        self.client = client
+
+        super(MemcachedCache, self).__init__(ttl, stale_ttl)
+
+    def get_key(self, key):
+        # Memcached keys can't contain spaces or control characters and are
+        # limited to 250 bytes, so hash them.
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+
+        return self.key_prefix + hashlib.md5(key).hexdigest()
+
+    def load(self, key):
+        data = self.client.get(self.get_key(key))
+        if data is None:
+            return None
+        expires, value = pickle.loads(data)
+
+        return value, expires
+
+    def store(self, key, value, expires):
+        data = pickle.dumps((expires, value), pickle.HIGHEST_PROTOCOL)
+        lifetime = expires + self.stale_ttl - time()
+        if lifetime > self.max_lifetime:
+            # Never expires
+            lifetime = 0
+        else:
+            lifetime = max(int(lifetime) + 1, 1)
+        self.client.set(self.get_key(key), data, time=lifetime)
+
+    def delete(self, key):
+        self.client.delete(self.get_key(key))
+
+    def clear(self):
+        '''
+        Flushes the whole memcached server, not just sharpy's entries.  Use
+        clear_namespace to drop only one product's entries.
+        '''
+        self.client.flush_all()
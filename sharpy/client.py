@@ -1,8 +1,9 @@
 import base64
+import httplib
 import logging
 from urllib import urlencode
+from urlparse import urlsplit
 from dateutil.tz import tzutc
-import httplib2
 
 from sharpy.exceptions import AccessDenied
 from sharpy.exceptions import BadRequest
@@ -12,6 +13,9 @@ from sharpy.exceptions import NaughtyGateway
 from sharpy.exceptions import NotFound
 from sharpy.exceptions import PreconditionFailed
 from sharpy.exceptions import UnprocessableEntity
+from sharpy.pool import HttpPool
+from sharpy.retry import RetryPolicy
+from sharpy.singleflight import SingleFlight
 
 client_log = logging.getLogger('SharpyClient')
 
@@ -20,7 +24,8 @@ class Client(object):
     default_endpoint = 'https://cheddargetter.com/xml'
 
     def __init__(self, username, password, product_code, cache=None,
-                 timeout=None, endpoint=None):
+                 timeout=None, endpoint=None, pool=None, retry_policy=None,
+                 circuit_breaker=None, rate_limiter=None, coalesce=True):
         '''
         username - Your cheddargetter username (probably an email address)
         password - Your cheddargetter password
@@ -29,6 +34,20 @@ class Client(object):
                 cache API (optional)
         timeout - Socket level timout in seconds (optional)
         endpoint - An alternate API endpoint (optional)
+        pool - An HttpPool to draw keep-alive connections from. Pass one in
+               to share connections between clients. (optional)
+        retry_policy - A RetryPolicy deciding which failed requests are
+                       retried. By default idempotent requests get three
+                       tries. (optional)
+        circuit_breaker - A CircuitBreaker which makes requests fail fast
+                          with CircuitOpen while cheddar is down. Pass one
+                          in to share it between clients. (optional)
+        rate_limiter - A TokenBucket (or FileTokenBucket) which each request
+                       takes a token from before it is sent. Share one
+                       between clients to give them a single budget.
+                       (optional)
+        coalesce - Whether concurrent identical GET requests share one
+                   round trip and response. On by default. (optional)
         '''
         self.username = username
         self.password = password
@@ -36,6 +55,12 @@ class Client(object):
         self.endpoint = endpoint or self.default_endpoint
         self.cache = cache
         self.timeout = timeout
+        self.pool = pool or HttpPool(cache=cache, timeout=timeout)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker
+        self.rate_limiter = rate_limiter
+        self.coalesce = coalesce
+        self.single_flight = SingleFlight()
 
         super(Client, self).__init__()
 
@@ -76,10 +101,10 @@ class Client(object):
             str_dt = utc_value.strftime('%Y-%m-%d')
         return str_dt
 
-    def make_request(self, path, params=None, data=None, method=None):
+    def build_request(self, path, params=None, data=None, method=None):
         '''
-        Makes a request to the cheddar api using the authentication and
-        configuration settings available.
+        Builds the url, method, body and headers for a request to the
+        cheddar api using the authentication settings available.
         '''
         # Setup values
         url = self.build_url(path, params)
@@ -99,7 +124,7 @@ class Client(object):
 
             # Clean credit card info from when the request gets logged
             # (remove ccv and only show last four of card num)
-            cleaned_data = data.copy()
+            cleaned_data = dict(data)
             if 'subscription[ccCardCode]' in cleaned_data:
                 del cleaned_data['subscription[ccCardCode]']
             if 'subscription[ccNumber]' in cleaned_data:
@@ -109,15 +134,18 @@ class Client(object):
         client_log.debug('Request Method:  %s' % method)
         client_log.debug('Request Body (Cleaned Data):  %s' % cleaned_data)
 
-        # Setup http client
-        h = httplib2.Http(cache=self.cache, timeout=self.timeout)
         # Skip the normal http client behavior and send auth headers
         # immediately to save an http request.
         headers['Authorization'] = "Basic %s" % base64.standard_b64encode(
             self.username + ':' + self.password).strip()
 
-        # Make request
-        response, content = h.request(url, method, body=body, headers=headers)
+        return url, method, body, headers
+
+    def check_response(self, response, content):
+        '''
+        Raises the appropriate CheddarError subclass if the response
+        status indicates a failure.
+        '''
         status = response.status
         client_log.debug('Response Status:  %d' % status)
         client_log.debug('Response Content:  %s' % content)
@@ -140,5 +168,159 @@ class Client(object):
 
             raise exception_class(response, content)
 
-        response.content = content
+    def make_request(self, path, params=None, data=None, method=None,
+                     idempotent=None, mutation=None):
+        '''
+        Makes a request to the cheddar api using the authentication and
+        configuration settings available.
+
+        Transient failures are retried according to retry_policy.  Pass
+        idempotent=True for a POST which is safe to repeat (such as a
+        customers/get with filters) to allow it to be retried, or
+        idempotent=False to never retry the request.
+
+        When coalesce is on, a GET made while an identical one is already
+        in flight waits for it and returns the same response object, which
+        callers must treat as read only.
+
+        A mutation (by default, any request but a GET) is never coalesced,
+        and GETs made after it never join ones which started before it
+        finished.  Pass mutation=True for a GET which changes something,
+        such as customers/cancel.
+        '''
+        url, method, body, headers = self.build_request(path, params, data,
+                                                        method)
+
+        def send():
+            # Make request over a pooled keep-alive connection
+            h = self.pool.acquire(url)
+            try:
+                response, content = h.request(url, method, body=body,
+                                              headers=headers)
+            except Exception:
+                self.pool.release(url, h, discard=True)
+                raise
+            self.pool.release(url, h)
+
+            self.check_response(response, content)
+
+            response.content = content
+            return response
+
+        def request():
+            return self.retry_policy.call(
+                lambda: self.call_with_breaker(send), method, path,
+                idempotent)
+
+        if mutation is None:
+            mutation = method != 'GET'
+
+        if not mutation:
+            if self.coalesce:
+                return self.single_flight.do(url, request)
+            return request()
+
+        try:
+            return request()
+        finally:
+            # Anything may have changed, so GETs from now on mustn't join
+            # ones which started before this request finished.
+            self.single_flight.forget_all()
+
+    def open_request(self, path, params=None, data=None, method=None,
+                     idempotent=None):
+        '''
+        Makes a request to the cheddar api and returns the response without
+        reading its body.  The returned httplib.HTTPResponse is file-like,
+        so large responses can be streamed into a parser.  The caller is
+        responsible for closing it.
+
+        Streamed requests use their own connection rather than one from the
+        pool and bypass the httplib2 cache.  Failures up to the point the
+        response status is known are retried as for make_request.
+        '''
+        url, method, body, headers = self.build_request(path, params, data,
+                                                        method)
+
+        return self.retry_policy.call(
+            lambda: self.call_with_breaker(
+                lambda: self._open(url, method, body, headers)),
+            method, path, idempotent)
+
+    def _open(self, url, method, body, headers):
+        parts = urlsplit(url)
+        if parts.scheme == 'https':
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        if self.timeout is None:
+            connection = connection_class(parts.netloc)
+        else:
+            connection = connection_class(parts.netloc, timeout=self.timeout)
+        # The connection can't be reused once its response has been handed
+        # off, so let the server close it when the body is done.
+        headers['Connection'] = 'close'
+
+        request_path = parts.path
+        if parts.query:
+            request_path = '%s?%s' % (request_path, parts.query)
+
+        try:
+            connection.request(method, request_path.encode('utf-8'),
+                               body=body, headers=headers)
+            response = connection.getresponse()
+        except Exception:
+            connection.close()
+            raise
+
+        if response.status != 200:
+            content = response.read()
+            connection.close()
+            self.check_response(response, content)
+
         return response
+
+    def call_with_breaker(self, func):
+        '''
+        Calls func through the circuit breaker, if there is one, taking a
+        token from the rate limiter just before func.  The breaker is
+        checked first so an open circuit fails fast without waiting for or
+        spending a token, and a request refused by the rate limiter gives
+        back its half-open trial slot.
+        '''
+        def throttled():
+            self.throttle()
+            return func()
+
+        if self.circuit_breaker is None:
+            return throttled()
+
+        return self.circuit_breaker.call(throttled)
+
+    def throttle(self):
+        '''
+        Takes a token from the rate limiter, if there is one, waiting for
+        it or raising RateLimited as the limiter is configured to.
+        '''
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+    def get_pool_stats(self):
+        '''
+        Returns the connection pool counters (hits, opens, evictions, ...)
+        so connection reuse can be verified under load.
+        '''
+        return self.pool.get_stats()
+
+    def get_retry_stats(self):
+        '''
+        Returns the retry policy's counters (requests, retries, recovered,
+        ...).
+        '''
+        return self.retry_policy.get_stats()
+
+    def close(self):
+        '''
+        Closes any idle keep-alive connections held by this client.
+        '''
+        self.pool.clear()
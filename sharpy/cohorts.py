@@ -0,0 +1,219 @@
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sharpy.revenue import month_starts, paying_since, to_datetime64
+
+# Churn, retention and trial conversion over a CustomerTables (see
+# sharpy.columnar), bucketing the subscription timestamps with array
+# operations rather than looping over customers.  Each customer's current
+# subscription is followed from its customer's signup until it was
+# canceled.  Datetime arguments are as for sharpy.revenue.
+
+Retention = namedtuple('Retention', 'months sizes retained rates')
+
+
+def signup_months(tables):
+    '''
+    Returns the month each subscription's customer signed up in, in
+    subscriptions table order, as datetime64[M] values.
+    '''
+    customers = tables.subscriptions['customer']
+
+    return tables.customers['created'][customers].astype('datetime64[M]')
+
+
+def signup_cohorts(tables, start, end=None):
+    '''
+    Returns [(month, signups)] counting the customers who signed up in each
+    month from start's month to end's (now by default).
+    '''
+    starts = month_starts(start, end)
+    months = starts.astype('datetime64[M]')
+    # Up to the start of the month after end's
+    after = (months[-1] + 1).astype('datetime64[s]')
+    created = tables.customers['created']
+    created = created[~numpy.isnat(created)]
+    created = created[(created >= starts[0]) & (created < after)]
+    buckets = numpy.searchsorted(starts, created, side='right') - 1
+    counts = numpy.bincount(buckets, minlength=len(starts))
+
+    return [(month, int(count)) for month, count in zip(months, counts)]
+
+
+def retention(tables, start, end=None, ages=12, at=None):
+    '''
+    Returns a Retention of the monthly signup cohorts from start's month to
+    end's (now by default):
+
+    months
+        The cohorts' signup months as datetime64[M]s
+    sizes
+        The number of subscriptions in each cohort
+    retained
+        A cohorts x ages array of how many subscriptions in each cohort were
+        still going at the end of the month age months after signup, so
+        age 0 is the signup month
+    rates
+        retained / sizes, with NaN for empty cohorts and for months which
+        hadn't ended by at (now by default)
+
+    Each subscription's lifetime in whole calendar months is computed
+    once and the cohorts x lifetimes histogram is taken with a single
+    bincount, so this is one pass over the subscriptions.
+    '''
+    starts = month_starts(start, end)
+    cohorts = starts.astype('datetime64[M]')
+    count = len(starts)
+    signed_up = signup_months(tables)
+    canceled = tables.subscriptions['canceled']
+
+    known = ~numpy.isnat(signed_up)
+    cohort = (signed_up[known] - cohorts[0]).astype(numpy.int64)
+    in_range = (cohort >= 0) & (cohort < count)
+    cohort = cohort[in_range]
+    canceled = canceled[known][in_range]
+    signed_up = signed_up[known][in_range]
+
+    lifetimes = numpy.full(len(cohort), ages, dtype=numpy.int64)
+    was_canceled = ~numpy.isnat(canceled)
+    lifetimes[was_canceled] = (
+        canceled[was_canceled].astype('datetime64[M]') -
+        signed_up[was_canceled]).astype(numpy.int64)
+    lifetimes = numpy.clip(lifetimes, 0, ages)
+
+    histogram = numpy.bincount(cohort * (ages + 1) + lifetimes,
+                               minlength=count * (ages + 1))
+    histogram = histogram.reshape(count, ages + 1)
+    sizes = histogram.sum(axis=1)
+    # Subscriptions whose lifetime is more than an age were retained at it
+    retained = sizes[:, None] - numpy.cumsum(histogram, axis=1)[:, :ages]
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        rates = retained / sizes[:, None].astype(numpy.float64)
+    # The month age months after a cohort's signup month must have ended
+    current = to_datetime64(at).astype('datetime64[M]')
+    ended = (cohorts[:, None] + numpy.arange(ages)[None, :]) < current
+    rates[~ended] = numpy.nan
+
+    return Retention(cohorts, sizes, retained, rates)
+
+
+def _exposed_and_churned(tables, start, end):
+    # The subscriptions which were going at some point from start until
+    # end, and which of them were canceled in that time
+    start = to_datetime64(start)
+    end = to_datetime64(end)
+    subscriptions = tables.subscriptions
+    created = subscriptions['created']
+    canceled = subscriptions['canceled']
+    going = numpy.isnat(canceled) | (canceled >= start)
+    exposed = ~numpy.isnat(created) & (created < end) & going
+    churned = exposed & ~numpy.isnat(canceled) & (canceled < end)
+
+    return exposed, churned
+
+
+def _count_by(codes, length, mask):
+    # Counts the masked rows by categorical code, with -1 (missing) in the
+    # last slot
+    codes = numpy.where(codes < 0, length, codes)
+
+    return numpy.bincount(codes[mask], minlength=length + 1)
+
+
+def _rates(labels, churned, exposed):
+    keys = list(labels) + [None]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        rates = churned / exposed.astype(numpy.float64)
+
+    return dict((keys[n], float(rates[n]))
+                for n in numpy.flatnonzero(exposed))
+
+
+def churn_by_plan(tables, start, end=None):
+    '''
+    Returns {plan code: churn rate} from start until end (now by default):
+    the share of each plan's subscriptions going at some point in that time
+    which were canceled in it.
+    '''
+    exposed, churned = _exposed_and_churned(tables, start, end)
+    plans = tables.subscriptions['plan']
+    length = len(tables.plan_codes)
+
+    return _rates(tables.plan_codes, _count_by(plans, length, churned),
+                  _count_by(plans, length, exposed))
+
+
+def churn_by_cancel_reason(tables, start, end=None, column='cancel_reason'):
+    '''
+    Returns {cancel reason: churn rate} from start until end (now by
+    default): the share of all subscriptions going at some point in that
+    time which were canceled in it for each reason, so the rates add up to
+    the overall churn rate.  Cancellations without a reason are under None.
+    Pass column='cancel_type' to break churn down by cancel type instead.
+    '''
+    exposed, churned = _exposed_and_churned(tables, start, end)
+    labels = tables.subscriptions.categories[column]
+    counts = _count_by(tables.subscriptions[column], len(labels), churned)
+    total = int(exposed.sum())
+    if not total:
+        return {}
+    keys = list(labels) + [None]
+
+    return dict((keys[n], float(counts[n]) / total)
+                for n in numpy.flatnonzero(counts))
+
+
+def monthly_churn(tables, start, end=None):
+    '''
+    Returns [(month, churn rate)] for each month from start's month to
+    end's (now by default): the share of subscriptions going at some point
+    in the month which were canceled in it, or None for months without
+    any.
+
+    Sorting the created and canceled datetimes once lets every month be
+    counted with a searchsorted.
+    '''
+    starts = month_starts(start, end)
+    months = starts.astype('datetime64[M]')
+    ends = (months + 1).astype('datetime64[s]')
+    created = tables.subscriptions['created']
+    canceled = tables.subscriptions['canceled']
+    created = numpy.sort(created[~numpy.isnat(created)])
+    canceled = numpy.sort(canceled[~numpy.isnat(canceled)])
+
+    canceled_before = numpy.searchsorted(canceled, starts, side='left')
+    churned = numpy.searchsorted(canceled, ends, side='left') - \
+        canceled_before
+    # Every subscription canceled before a month began was created before
+    # it ended
+    exposed = numpy.searchsorted(created, ends, side='left') - \
+        canceled_before
+
+    return [(month, float(churned[n]) / exposed[n] if exposed[n] else None)
+            for n, month in enumerate(months)]
+
+
+def trial_conversion(tables, at=None):
+    '''
+    Returns {plan code: conversion rate} for the plans with trials (a
+    positive trial_days): the share of their subscriptions whose trial had
+    ended by at (now by default) which weren't canceled before it ended.
+    '''
+    at = to_datetime64(at)
+    subscriptions = tables.subscriptions
+    plans = subscriptions['plan']
+    trial_days = numpy.append(tables.plans['trial_days'], 0)
+    trial_ended = paying_since(tables)
+    canceled = subscriptions['canceled']
+
+    ended = (trial_days[plans] > 0) & (trial_ended <= at)
+    converted = ended & (numpy.isnat(canceled) | (canceled >= trial_ended))
+    length = len(tables.plan_codes)
+
+    return _rates(tables.plan_codes, _count_by(plans, length, converted),
+                  _count_by(plans, length, ended))
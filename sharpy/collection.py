@@ -0,0 +1,291 @@
+from bisect import bisect_left, insort
+import threading
+
+from sharpy.columnar import to_naive_utc
+
+
+class SortedIndex(object):
+    '''
+    Customer codes kept sorted by a value such as a datetime, for range
+    queries.  Customers whose value is None aren't indexed.
+    '''
+
+    def __init__(self):
+        self._entries = []
+
+        super(SortedIndex, self).__init__()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, value, code):
+        if value is not None:
+            insort(self._entries, (value, code))
+
+    def remove(self, value, code):
+        if value is None:
+            return
+        position = bisect_left(self._entries, (value, code))
+        if position < len(self._entries) and \
+                self._entries[position] == (value, code):
+            del self._entries[position]
+
+    def between(self, start=None, end=None):
+        '''
+        Returns the codes whose value is at least start and before end, in
+        value order.  Either bound may be left open.
+        '''
+        entries = self._entries
+        if start is None:
+            low = 0
+        else:
+            low = bisect_left(entries, (start,))
+        if end is None:
+            high = len(entries)
+        else:
+            high = bisect_left(entries, (end,))
+
+        return [code for value, code in entries[low:high]]
+
+
+class CustomerCollection(object):
+    '''
+    A collection of customers indexed for fast lookups, as returned by
+    CheddarProduct.get_customers(indexed=True).
+
+    It iterates, indexes and measures like the list of customers it was
+    built from.  Hash indexes find customers by code, email, gateway token,
+    plan code, subscription status ('active' or 'canceled') and meta data
+    name or (name, value) in constant time, and sorted indexes find those
+    created, modified or canceled within a range of datetimes.
+
+    Indexes follow the customers' loaded data.  They are brought up to date
+    whenever a customer in the collection is reloaded after a mutation
+    (charge, save, Item.increment, ...), or by calling reindex after
+    changing a customer some other way.  Indexing a lazily decoded
+    customer decodes its subscription and plan.
+    '''
+    hash_indexes = ('email', 'gateway_token', 'plan_code', 'status',
+                    'meta_data_name', 'meta_data')
+    sorted_indexes = ('created', 'modified', 'canceled')
+
+    def __init__(self, customers=(), product=None):
+        '''
+        customers - The customers to start with (optional)
+        product - The product the customers belong to.  If given, the
+                  collection is told when any of its customers is reloaded.
+                  (optional)
+        '''
+        self.product = product
+        self._lock = threading.RLock()
+        self._customers = []
+        self._by_code = {}
+        self._keys = {}
+        self._hash = dict((name, {}) for name in self.hash_indexes)
+        self._sorted = dict((name, SortedIndex())
+                            for name in self.sorted_indexes)
+        for customer in customers:
+            self.add(customer)
+        if product is not None:
+            product.register_collection(self)
+
+        super(CustomerCollection, self).__init__()
+
+    def __len__(self):
+        return len(self._customers)
+
+    def __iter__(self):
+        return iter(self._customers)
+
+    def __getitem__(self, index):
+        return self._customers[index]
+
+    def __contains__(self, customer):
+        code = getattr(customer, 'code', customer)
+        return code in self._by_code
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return u'CustomerCollection: %d customers' % len(self)
+
+    def add(self, customer):
+        '''
+        Adds a customer, replacing any customer with the same code.
+        '''
+        keys = self.get_keys(customer)
+        with self._lock:
+            old_customer = self._by_code.get(customer.code)
+            if old_customer is not None:
+                position = self._customers.index(old_customer)
+                self._customers[position] = customer
+            else:
+                self._customers.append(customer)
+            self._by_code[customer.code] = customer
+            self._index(customer.code, keys)
+
+    def remove(self, customer):
+        '''
+        Removes a customer, given the customer or its code.
+        '''
+        code = getattr(customer, 'code', customer)
+        with self._lock:
+            customer = self._by_code.pop(code)
+            self._customers.remove(customer)
+            self._unindex(code, self._keys.pop(code))
+
+    def reindex(self, customer):
+        '''
+        Brings the indexes up to date with a customer's current data.  Only
+        the entries whose values changed are touched.  Customers which
+        aren't in the collection are ignored.
+        '''
+        code = customer.code
+        with self._lock:
+            if self._by_code.get(code) is not customer:
+                return
+
+            old_keys = self._keys[code]
+            new_keys = self.get_keys(customer)
+            for name in self.hash_indexes:
+                old_values, new_values = old_keys[name], new_keys[name]
+                if old_values != new_values:
+                    index = self._hash[name]
+                    for value in old_values - new_values:
+                        self._discard(index, value, code)
+                    for value in new_values - old_values:
+                        index.setdefault(value, set()).add(code)
+            for name in self.sorted_indexes:
+                if old_keys[name] != new_keys[name]:
+                    self._sorted[name].remove(old_keys[name], code)
+                    self._sorted[name].add(new_keys[name], code)
+            self._keys[code] = new_keys
+
+    def get_keys(self, customer):
+        '''
+        Returns the values a customer is indexed under: a set of values for
+        each hash index and one value for each sorted index.
+        '''
+        keys = {
+            'email': set(filter(None, [customer.email])),
+            'gateway_token': set(filter(None, [customer.gateway_token])),
+            'plan_code': set(),
+            'status': set(),
+            'meta_data_name': set(customer.meta_data or {}),
+            'meta_data': set((customer.meta_data or {}).items()),
+            'created': to_naive_utc(customer.created),
+            'modified': to_naive_utc(customer.modified),
+            'canceled': None,
+        }
+        subscription = getattr(customer, 'subscription', None)
+        if subscription is not None:
+            if subscription.gateway_token:
+                keys['gateway_token'].add(subscription.gateway_token)
+            plan = getattr(subscription, 'plan', None)
+            if plan is not None:
+                keys['plan_code'].add(plan.code)
+            if subscription.canceled:
+                keys['status'].add('canceled')
+            else:
+                keys['status'].add('active')
+            keys['canceled'] = to_naive_utc(subscription.canceled)
+
+        return keys
+
+    def get(self, code, default=None):
+        return self._by_code.get(code, default)
+
+    def find_by_email(self, email):
+        '''
+        Returns the customers with the given email address, ordered by
+        code.  The other find_by methods order their results the same way.
+        '''
+        return self._find('email', email)
+
+    def find_by_gateway_token(self, gateway_token):
+        '''
+        Returns the customers whose customer or subscription gateway token
+        matches.
+        '''
+        return self._find('gateway_token', gateway_token)
+
+    def find_by_plan(self, plan_code):
+        return self._find('plan_code', plan_code)
+
+    def find_by_status(self, status):
+        '''
+        Returns the customers whose subscription is 'active' or 'canceled'.
+        '''
+        if status not in ('active', 'canceled'):
+            raise ValueError("status must be 'active' or 'canceled'")
+        return self._find('status', status)
+
+    def find_by_meta_data(self, name, value=None):
+        '''
+        Returns the customers with the named meta data, or if value is
+        given, those whose meta data has that value.
+        '''
+        if value is None:
+            return self._find('meta_data_name', name)
+        return self._find('meta_data', (name, value))
+
+    def created_between(self, start=None, end=None):
+        '''
+        Returns the customers created at or after start and before end, in
+        order of creation.  Naive datetimes, as bounds or customers'
+        datetimes, are taken to be UTC.  modified_between and
+        canceled_between work the same way.
+        '''
+        return self._between('created', start, end)
+
+    def modified_between(self, start=None, end=None):
+        return self._between('modified', start, end)
+
+    def canceled_between(self, start=None, end=None):
+        return self._between('canceled', start, end)
+
+    def _find(self, name, value):
+        # Customers are returned in order of code
+        with self._lock:
+            codes = sorted(self._hash[name].get(value, ()))
+            return [self._by_code[code] for code in codes]
+
+    def _between(self, name, start, end):
+        # The sorted indexes hold naive UTC datetimes
+        start = to_naive_utc(start)
+        end = to_naive_utc(end)
+        with self._lock:
+            return [self._by_code[code]
+                    for code in self._sorted[name].between(start, end)]
+
+    def _index(self, code, keys):
+        # Called with the lock held
+        old_keys = self._keys.get(code)
+        if old_keys is not None:
+            self._unindex(code, old_keys)
+        for name in self.hash_indexes:
+            index = self._hash[name]
+            for value in keys[name]:
+                index.setdefault(value, set()).add(code)
+        for name in self.sorted_indexes:
+            self._sorted[name].add(keys[name], code)
+        self._keys[code] = keys
+
+    def _unindex(self, code, keys):
+        for name in self.hash_indexes:
+            index = self._hash[name]
+            for value in keys[name]:
+                self._discard(index, value, code)
+        for name in self.sorted_indexes:
+            self._sorted[name].remove(keys[name], code)
+
+    def _discard(self, index, value, code):
+        codes = index.get(value)
+        if codes is not None:
+            codes.discard(code)
+            if not codes:
+                del index[value]
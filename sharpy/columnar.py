@@ -0,0 +1,417 @@
+from collections import OrderedDict
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+
+from dateutil.tz import tzutc
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sharpy.parsers import CustomersParser
+
+UTC = tzutc()
+
+# Column types.  Categorical columns hold int32 codes into the table's
+# categories for the column, with -1 for missing values.
+TEXT = 'text'
+CATEGORY = 'category'
+INTEGER = 'integer'
+CENTS = 'cents'
+QUANTITY = 'quantity'
+BOOLEAN = 'boolean'
+DATETIME = 'datetime'
+
+TABLE_COLUMNS = OrderedDict([
+    ('customers', OrderedDict([
+        ('code', TEXT),
+        ('email', TEXT),
+        ('campaign_source', CATEGORY),
+        ('campaign_medium', CATEGORY),
+        ('campaign_name', CATEGORY),
+        ('created', DATETIME),
+        ('modified', DATETIME),
+    ])),
+    ('subscriptions', OrderedDict([
+        ('customer', INTEGER),
+        ('plan', CATEGORY),
+        ('created', DATETIME),
+        ('canceled', DATETIME),
+        ('cancel_type', CATEGORY),
+        ('cancel_reason', CATEGORY),
+        ('cc_type', CATEGORY),
+    ])),
+    ('plans', OrderedDict([
+        ('code', TEXT),
+        ('name', TEXT),
+        ('is_free', BOOLEAN),
+        ('trial_days', INTEGER),
+        ('billing_frequency_quantity', INTEGER),
+        ('billing_frequency_unit', CATEGORY),
+        ('setup_charge_cents', CENTS),
+        ('recurring_charge_cents', CENTS),
+    ])),
+    ('items', OrderedDict([
+        ('customer', INTEGER),
+        ('item', CATEGORY),
+        ('quantity', QUANTITY),
+        ('quantity_included', QUANTITY),
+        ('overage_cents', CENTS),
+        ('is_periodic', BOOLEAN),
+        ('modified', DATETIME),
+    ])),
+    ('invoices', OrderedDict([
+        ('customer', INTEGER),
+        ('type', CATEGORY),
+        ('billing', DATETIME),
+        ('created', DATETIME),
+        ('is_paid', BOOLEAN),
+    ])),
+    ('charges', OrderedDict([
+        ('customer', INTEGER),
+        ('invoice', INTEGER),
+        ('code', CATEGORY),
+        ('type', CATEGORY),
+        ('quantity', QUANTITY),
+        ('each_amount_cents', CENTS),
+        ('amount_cents', CENTS),
+        ('billing', DATETIME),
+        ('created', DATETIME),
+    ])),
+])
+
+# Categorical columns which share one set of categories, so their codes
+# can be compared across tables
+SHARED_CATEGORIES = {
+    ('subscriptions', 'plan'): 'plan_codes',
+    ('items', 'item'): 'item_codes',
+    ('charges', 'code'): 'charge_codes',
+}
+
+
+def to_cents(amount):
+    '''
+    Converts a Decimal amount to a whole number of cents, rounding half
+    up.  None counts as 0.
+    '''
+    if amount is None:
+        return 0
+
+    return int((Decimal(amount) * 100).quantize(Decimal(1), ROUND_HALF_UP))
+
+
+def to_naive_utc(value):
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone(UTC).replace(tzinfo=None)
+
+    return value
+
+
+class Categories(object):
+    '''
+    Assigns each distinct value a small integer code, in order of first
+    appearance.
+    '''
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+        super(Categories, self).__init__()
+
+    def encode(self, value):
+        if value is None or value == '':
+            return -1
+        try:
+            return self.codes[value]
+        except KeyError:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+            return code
+
+
+class Table(object):
+    '''
+    One table of a CustomerTables: a numpy array per column, all of the
+    same length.
+
+    Amounts are int64 cents, quantities float64, datetimes naive UTC
+    datetime64[s] (NaT when missing) and categorical columns int32 codes
+    into categories[column] (-1 when missing); labels decodes them.
+    Columns named customer or invoice hold row numbers in the customers
+    and invoices tables.
+    '''
+
+    def __init__(self, name, columns, categories):
+        self.name = name
+        self.columns = columns
+        self.categories = categories
+
+        super(Table, self).__init__()
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def __len__(self):
+        for values in self.columns.values():
+            return len(values)
+        return 0
+
+    def __repr__(self):
+        return u'Table: %s (%d rows)' % (self.name, len(self))
+
+    def keys(self):
+        return self.columns.keys()
+
+    def labels(self, column):
+        '''
+        Returns an object array of a categorical column's values, with None
+        where they are missing.
+        '''
+        codes = self.columns[column]
+        values = numpy.array(list(self.categories[column]) + [None],
+                             dtype=object)
+        # -1 picks the trailing None
+        return values[codes]
+
+
+class TableBuilder(object):
+    # Collects rows as lists of column values before converting them to
+    # arrays in one go
+
+    def __init__(self, name, categories):
+        self.name = name
+        self.types = TABLE_COLUMNS[name]
+        self.values = OrderedDict((column, []) for column in self.types)
+        self.categories = dict(
+            (column, categories.get((name, column)) or Categories())
+            for column, column_type in self.types.items()
+            if column_type == CATEGORY)
+        self.rows = 0
+
+        super(TableBuilder, self).__init__()
+
+    def add(self, **row):
+        for column, column_type in self.types.iteritems():
+            value = row.get(column)
+            if column_type == CATEGORY:
+                value = self.categories[column].encode(value)
+            elif column_type == CENTS:
+                value = to_cents(value)
+            elif column_type == QUANTITY:
+                value = float(value) if value is not None else numpy.nan
+            elif column_type == DATETIME:
+                value = to_naive_utc(value)
+            elif column_type == INTEGER:
+                value = value if value is not None else -1
+            elif column_type == BOOLEAN:
+                value = bool(value)
+            self.values[column].append(value)
+        self.rows += 1
+
+        return self.rows - 1
+
+    def finish(self):
+        columns = OrderedDict()
+        for column, column_type in self.types.iteritems():
+            values = self.values[column]
+            if column_type == CATEGORY:
+                array = numpy.array(values, dtype=numpy.int32)
+            elif column_type in (CENTS, INTEGER):
+                array = numpy.array(values, dtype=numpy.int64)
+            elif column_type == QUANTITY:
+                array = numpy.array(values, dtype=numpy.float64)
+            elif column_type == DATETIME:
+                array = numpy.array(values, dtype='datetime64[s]')
+            elif column_type == BOOLEAN:
+                array = numpy.array(values, dtype=bool)
+            else:
+                array = numpy.array(values, dtype=object)
+            columns[column] = array
+        categories = dict(
+            (column, numpy.array(self.categories[column].values,
+                                 dtype=object))
+            for column in self.categories)
+
+        return Table(self.name, columns, categories)
+
+
+class CustomerTables(object):
+    '''
+    A customer base as numpy arrays, one Table per kind of record, so
+    questions about every customer at once can be answered with vectorized
+    operations instead of loops over Customer objects.
+
+    customers
+        One row per customer
+    subscriptions
+        Each customer's current subscription, with the plan as a code into
+        plan_codes (the row of the plans table for that plan)
+    plans
+        One row per plan seen, in plan_codes order
+    items
+        One row per item on each subscription, with the item as a code into
+        item_codes
+    invoices
+        One row per invoice
+    charges
+        One row per invoice charge, with the charge code as a code into
+        charge_codes and amount_cents = quantity * each_amount_cents.
+        billing is the billing datetime of the charge's invoice.
+
+    Requires numpy.
+    '''
+
+    def __init__(self, tables, plan_codes, item_codes, charge_codes):
+        self.tables = tables
+        self.plan_codes = plan_codes
+        self.item_codes = item_codes
+        self.charge_codes = charge_codes
+
+        super(CustomerTables, self).__init__()
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['tables'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __repr__(self):
+        return u'CustomerTables: %d customers' % len(self.customers)
+
+    @classmethod
+    def from_data(cls, customers_data):
+        '''
+        Builds the tables from customer dicts as returned by
+        CustomersParser.parse_customer, parse_xml or iter_parse.  Any
+        iterable works, so customers can be streamed in.
+        '''
+        if numpy is None:
+            raise RuntimeError('CustomerTables requires numpy')
+
+        shared = dict((name, Categories())
+                      for name in set(SHARED_CATEGORIES.values()))
+        categories = dict((key, shared[name])
+                          for key, name in SHARED_CATEGORIES.items())
+        builders = OrderedDict((name, TableBuilder(name, categories))
+                               for name in TABLE_COLUMNS)
+        plan_codes = shared['plan_codes']
+        plan_rows = set()
+
+        for customer in customers_data:
+            cls._add_customer(customer, builders, plan_codes, plan_rows)
+
+        tables = OrderedDict((name, builder.finish())
+                             for name, builder in builders.items())
+
+        return cls(tables,
+                   numpy.array(plan_codes.values, dtype=object),
+                   numpy.array(shared['item_codes'].values, dtype=object),
+                   numpy.array(shared['charge_codes'].values, dtype=object))
+
+    @classmethod
+    def from_xml(cls, source):
+        '''
+        Builds the tables by incrementally parsing a customers document
+        from source, a file name or file-like object.
+        '''
+        return cls.from_data(CustomersParser().iter_parse(source))
+
+    @classmethod
+    def from_product(cls, product, filter_data=None, **filters):
+        '''
+        Builds the tables from the customers matching the filters (see
+        CheddarProduct.get_customers), streaming them from cheddar.
+        '''
+        parser = CustomersParser()
+        return cls.from_data(
+            parser.parse_customer(customer_element)
+            for customer_element in product.iter_customer_elements(
+                filter_data, parser, **filters))
+
+    @staticmethod
+    def _add_customer(customer, builders, plan_codes, plan_rows):
+        customer_row = builders['customers'].add(
+            code=customer['code'],
+            email=customer['email'],
+            campaign_source=customer['campaign_source'],
+            campaign_medium=customer['campaign_medium'],
+            campaign_name=customer['campaign_name'],
+            created=customer['created_datetime'],
+            modified=customer['modified_datetime'],
+        )
+        if not customer['subscriptions']:
+            return
+
+        subscription = customer['subscriptions'][0]
+        plan = None
+        plan_items = {}
+        if subscription['plans']:
+            plan = subscription['plans'][0]
+            plan_items = dict((item['code'], item)
+                              for item in plan['items'])
+            if plan['code'] not in plan_rows:
+                # A plan's row is added as its code is first seen, so a
+                # plan code is also the plan's row number
+                plan_rows.add(plan['code'])
+                plan_codes.encode(plan['code'])
+                builders['plans'].add(
+                    code=plan['code'],
+                    name=plan['name'],
+                    is_free=plan['is_free'],
+                    trial_days=plan['trial_days'],
+                    billing_frequency_quantity=plan[
+                        'billing_frequency_quantity'],
+                    billing_frequency_unit=plan['billing_frequency_unit'],
+                    setup_charge_cents=plan['setup_charge_amount'],
+                    recurring_charge_cents=plan['recurring_charge_amount'],
+                )
+
+        builders['subscriptions'].add(
+            customer=customer_row,
+            plan=plan and plan['code'],
+            created=subscription['created_datetime'],
+            canceled=subscription['canceled_datetime'],
+            cancel_type=subscription['cancel_type'],
+            cancel_reason=subscription['cancel_reason'],
+            cc_type=subscription['cc_type'],
+        )
+
+        for item in subscription['items']:
+            plan_item = plan_items.get(item['code'], {})
+            builders['items'].add(
+                customer=customer_row,
+                item=item['code'],
+                quantity=item['quantity'],
+                quantity_included=plan_item.get('quantity_included'),
+                overage_cents=plan_item.get('overage_amount'),
+                is_periodic=plan_item.get('is_periodic'),
+                modified=item['modified_datetime'],
+            )
+
+        for invoice in subscription['invoices']:
+            invoice_row = builders['invoices'].add(
+                customer=customer_row,
+                type=invoice['type'],
+                billing=invoice['billing_datetime'],
+                created=invoice['created_datetime'],
+                is_paid=invoice['paid_transaction_id'],
+            )
+            for charge in invoice['charges']:
+                quantity = charge['quantity'] or 0
+                each_amount = charge['each_amount'] or 0
+                builders['charges'].add(
+                    customer=customer_row,
+                    invoice=invoice_row,
+                    code=charge['code'],
+                    type=charge['type'],
+                    quantity=quantity,
+                    each_amount_cents=each_amount,
+                    amount_cents=quantity * each_amount,
+                    billing=invoice['billing_datetime'],
+                    created=charge['created_datetime'],
+                )
@@ -0,0 +1,463 @@
+from collections import OrderedDict
+import csv
+from datetime import date, datetime
+from decimal import Decimal
+import errno
+import gzip
+import json
+import os
+import tempfile
+
+from sharpy.columnar import to_naive_utc
+from sharpy.parsers import CustomersParser
+
+NDJSON = 'ndjson'
+CSV = 'csv'
+FORMATS = (NDJSON, CSV)
+
+EXPORT_COLUMNS = OrderedDict([
+    ('customers', (
+        'code', 'id', 'first_name', 'last_name', 'company', 'email', 'notes',
+        'gateway_token', 'is_vat_exempt', 'vat_number', 'first_contact',
+        'referer', 'referer_host', 'campaign_source', 'campaign_medium',
+        'campaign_term', 'campaign_content', 'campaign_name', 'created',
+        'modified', 'meta_data')),
+    ('subscriptions', (
+        'id', 'customer_code', 'plan_code', 'gateway_token', 'gateway',
+        'cc_first_name', 'cc_last_name', 'cc_company', 'cc_country',
+        'cc_address', 'cc_city', 'cc_state', 'cc_zip', 'cc_type',
+        'cc_email', 'cc_last_four', 'cc_expiration_date', 'cancel_type',
+        'cancel_reason', 'canceled', 'created', 'coupon_code')),
+    ('items', (
+        'customer_code', 'subscription_id', 'code', 'id', 'name',
+        'quantity', 'quantity_included', 'is_periodic', 'overage_amount',
+        'created', 'modified')),
+    ('invoices', (
+        'id', 'customer_code', 'subscription_id', 'number', 'type',
+        'vat_rate', 'billing', 'paid_transaction_id', 'created')),
+    ('charges', (
+        'id', 'invoice_id', 'customer_code', 'code', 'type', 'quantity',
+        'each_amount', 'amount', 'description', 'created')),
+])
+
+
+def to_json_value(value):
+    '''
+    Converts the values json can't encode: datetimes become ISO 8601 UTC
+    strings, dates ISO 8601 dates and Decimals strings, keeping their
+    precision.
+    '''
+    if isinstance(value, datetime):
+        return to_naive_utc(value).isoformat() + 'Z'
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+def to_csv_value(value):
+    '''
+    Converts a value to a utf-8 csv field: None becomes an empty field,
+    booleans true or false and dicts json.  Other values are formatted as
+    for ndjson.
+    '''
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, dict):
+        return json.dumps(value, sort_keys=True, default=to_json_value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, (datetime, date, Decimal)):
+        return to_json_value(value)
+
+    return str(value)
+
+
+def build_rows(customer):
+    '''
+    Flattens a customer dict, as returned by CustomersParser.parse_customer,
+    into {table: [row]} with each row a dict of the table's
+    EXPORT_COLUMNS.  Only the customer's current subscription is exported.
+    '''
+    code = customer['code']
+    rows = dict((table, []) for table in EXPORT_COLUMNS)
+    rows['customers'].append({
+        'code': code,
+        'id': customer['id'],
+        'first_name': customer['first_name'],
+        'last_name': customer['last_name'],
+        'company': customer['company'],
+        'email': customer['email'],
+        'notes': customer['notes'],
+        'gateway_token': customer['gateway_token'],
+        'is_vat_exempt': customer['is_vat_exempt'],
+        'vat_number': customer['vat_number'],
+        'first_contact': customer['first_contact_datetime'],
+        'referer': customer['referer'],
+        'referer_host': customer['referer_host'],
+        'campaign_source': customer['campaign_source'],
+        'campaign_medium': customer['campaign_medium'],
+        'campaign_term': customer['campaign_term'],
+        'campaign_content': customer['campaign_content'],
+        'campaign_name': customer['campaign_name'],
+        'created': customer['created_datetime'],
+        'modified': customer['modified_datetime'],
+        'meta_data': dict((datum['name'], datum['value'])
+                          for datum in customer['meta_data']),
+    })
+    if not customer['subscriptions']:
+        return rows
+
+    subscription = customer['subscriptions'][0]
+    plan = None
+    plan_items = {}
+    if subscription['plans']:
+        plan = subscription['plans'][0]
+        plan_items = dict((item['code'], item) for item in plan['items'])
+    gateway_account = subscription.get('gateway_account')
+    rows['subscriptions'].append({
+        'id': subscription['id'],
+        'customer_code': code,
+        'plan_code': plan and plan['code'],
+        'gateway_token': subscription['gateway_token'],
+        'gateway': gateway_account and gateway_account.gateway,
+        'cc_first_name': subscription['cc_first_name'],
+        'cc_last_name': subscription['cc_last_name'],
+        'cc_company': subscription['cc_company'],
+        'cc_country': subscription['cc_country'],
+        'cc_address': subscription['cc_address'],
+        'cc_city': subscription['cc_city'],
+        'cc_state': subscription['cc_state'],
+        'cc_zip': subscription['cc_zip'],
+        'cc_type': subscription['cc_type'],
+        'cc_email': subscription['cc_email'],
+        'cc_last_four': subscription['cc_last_four'],
+        'cc_expiration_date': subscription['cc_expiration_date'],
+        'cancel_type': subscription['cancel_type'],
+        'cancel_reason': subscription['cancel_reason'],
+        'canceled': subscription['canceled_datetime'],
+        'created': subscription['created_datetime'],
+        'coupon_code': subscription['coupon_code'],
+    })
+
+    for item in subscription['items']:
+        plan_item = plan_items.get(item['code'], {})
+        rows['items'].append({
+            'customer_code': code,
+            'subscription_id': subscription['id'],
+            'code': item['code'],
+            'id': item['id'],
+            'name': item['name'],
+            'quantity': item['quantity'],
+            'quantity_included': plan_item.get('quantity_included'),
+            'is_periodic': plan_item.get('is_periodic'),
+            'overage_amount': plan_item.get('overage_amount'),
+            'created': item['created_datetime'],
+            'modified': item['modified_datetime'],
+        })
+
+    for invoice in subscription['invoices']:
+        rows['invoices'].append({
+            'id': invoice.id,
+            'customer_code': code,
+            'subscription_id': subscription['id'],
+            'number': invoice.number,
+            'type': invoice.type,
+            'vat_rate': invoice.vat_rate,
+            'billing': invoice.billing_datetime,
+            'paid_transaction_id': invoice.paid_transaction_id,
+            'created': invoice.created_datetime,
+        })
+        for charge in invoice.charges:
+            amount = None
+            if charge.quantity is not None and \
+                    charge.each_amount is not None:
+                amount = charge.quantity * charge.each_amount
+            rows['charges'].append({
+                'id': charge.id or None,
+                'invoice_id': invoice.id,
+                'customer_code': code,
+                'code': charge.code,
+                'type': charge.type,
+                'quantity': charge.quantity,
+                'each_amount': charge.each_amount,
+                'amount': amount,
+                'description': charge.description,
+                'created': charge.created_datetime,
+            })
+
+    return rows
+
+
+class ExportFile(object):
+    '''
+    One table's output file.  Rows are written through a gzip stream if
+    compress is set, which is finished off at every checkpoint so the file
+    is always a complete (multi-member) gzip file up to the last checkpoint.
+    '''
+
+    def __init__(self, path, format, columns, compress, offset=None):
+        '''
+        offset - Where the last checkpoint left the file.  Anything after it
+                 is discarded and writing carries on from there.  If None,
+                 the file is started afresh. (optional)
+        '''
+        self.path = path
+        self.format = format
+        self.columns = columns
+        self.compress = compress
+        if offset is None:
+            self._file = open(path, 'wb')
+        else:
+            self._file = open(path, 'r+b')
+            self._file.truncate(offset)
+            self._file.seek(offset)
+        self._open_stream()
+        if format == CSV and not offset:
+            self._csv.writerow(columns)
+
+        super(ExportFile, self).__init__()
+
+    def _open_stream(self):
+        if self.compress:
+            self._stream = gzip.GzipFile(filename='', mode='wb',
+                                         fileobj=self._file)
+        else:
+            self._stream = self._file
+        if self.format == CSV:
+            self._csv = csv.writer(self._stream, lineterminator='\n')
+
+    def write(self, row):
+        if self.format == CSV:
+            self._csv.writerow([to_csv_value(row[column])
+                                for column in self.columns])
+        else:
+            self._stream.write(json.dumps(
+                OrderedDict((column, row[column]) for column in self.columns),
+                default=to_json_value) + '\n')
+
+    def checkpoint(self, sync=True):
+        '''
+        Makes everything written so far durable and returns the file's
+        length, to be passed back as offset when resuming.
+        '''
+        if self.compress:
+            self._stream.close()
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+        offset = self._file.tell()
+        if self.compress:
+            self._open_stream()
+
+        return offset
+
+    def close(self):
+        if self.compress:
+            self._stream.close()
+        self._file.close()
+
+
+class CustomerExporter(object):
+    '''
+    Streams customers with their current subscription, items, invoices and
+    charges to one NDJSON or CSV file per table (see EXPORT_COLUMNS) in a
+    directory, gzip-compressed if compress is set.
+
+    Customers are parsed one at a time and written straight out, so memory
+    use stays flat however many there are.  Every checkpoint_every
+    customers the files are made durable and the last customer written is
+    recorded in checkpoint.json.  If an export is interrupted, running it
+    again with the same arguments discards anything written after the last
+    checkpoint and carries on from the customer after it, which relies on
+    cheddar listing customers in the same order both times.
+
+    Datetimes are written as ISO 8601 UTC strings and amounts and
+    quantities as strings, so no precision is lost.
+    '''
+    checkpoint_name = 'checkpoint.json'
+
+    def __init__(self, directory, format=NDJSON, compress=False,
+                 tables=None, checkpoint_every=1000, sync=True):
+        '''
+        directory - Where to write the files.  It is created if it doesn't
+                    exist.
+        format - NDJSON or CSV (optional)
+        compress - Whether to gzip the files (optional)
+        tables - The tables to export, all of EXPORT_COLUMNS by default
+                 (optional)
+        checkpoint_every - How many customers to write between checkpoints
+                           (optional)
+        sync - Whether to fsync the files at each checkpoint (optional)
+        '''
+        if format not in FORMATS:
+            raise ValueError('format must be one of: %s' % ', '.join(FORMATS))
+        tables = list(tables or EXPORT_COLUMNS)
+        for table in tables:
+            if table not in EXPORT_COLUMNS:
+                raise ValueError('Unknown table: %s' % table)
+
+        self.directory = directory
+        self.format = format
+        self.compress = compress
+        self.tables = tables
+        self.checkpoint_every = checkpoint_every
+        self.sync = sync
+
+        super(CustomerExporter, self).__init__()
+
+    def get_path(self, table):
+        extension = self.format
+        if self.compress:
+            extension += '.gz'
+
+        return os.path.join(self.directory, '%s.%s' % (table, extension))
+
+    def get_checkpoint(self):
+        '''
+        Returns the last checkpoint as a dict, or None if there isn't one.
+        '''
+        try:
+            f = open(os.path.join(self.directory, self.checkpoint_name), 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def export_product(self, product, filter_data=None, resume=True,
+                       **filters):
+        '''
+        Exports the customers matching the filters (see
+        CheddarProduct.get_customers), streaming them from cheddar.
+        Returns the number of customers written.
+        '''
+        parser = CustomersParser()
+        return self.export_elements(
+            product.iter_customer_elements(filter_data, parser, **filters),
+            parser, resume)
+
+    def export_xml(self, source, resume=True):
+        '''
+        Exports the customers in a customers document read from source, a
+        file name or file-like object.
+        '''
+        parser = CustomersParser()
+        return self.export_elements(parser.iter_elements(source), parser,
+                                    resume)
+
+    def export_elements(self, customer_elements, parser=None, resume=True):
+        '''
+        Exports customer elements, as yielded by
+        CustomersParser.iter_elements.
+
+        resume - Whether to carry on from an unfinished export's checkpoint.
+                 Otherwise, or if the last export finished, the export
+                 starts afresh. (optional)
+
+        Returns the number of customers written by this call.
+        '''
+        parser = parser or CustomersParser()
+        checkpoint = None
+        if resume:
+            checkpoint = self.get_checkpoint()
+            if checkpoint is not None and checkpoint['complete']:
+                checkpoint = None
+        if checkpoint is not None:
+            self._check_settings(checkpoint)
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        files = OrderedDict()
+        try:
+            for table in self.tables:
+                offset = None
+                if checkpoint is not None:
+                    offset = checkpoint['offsets'][table]
+                files[table] = ExportFile(
+                    self.get_path(table), self.format, EXPORT_COLUMNS[table],
+                    self.compress, offset)
+
+            total = 0
+            last_code = None
+            skipping = False
+            if checkpoint is not None:
+                total = checkpoint['count']
+                last_code = checkpoint['last_code']
+                skipping = last_code is not None
+            else:
+                self._write_checkpoint(files, None, 0, False)
+
+            written = 0
+            for customer_element in customer_elements:
+                code = customer_element.get('code')
+                if skipping:
+                    skipping = code != last_code
+                    continue
+
+                rows = build_rows(parser.parse_customer(customer_element))
+                for table, export_file in files.iteritems():
+                    for row in rows[table]:
+                        export_file.write(row)
+                written += 1
+                last_code = code
+                if written % self.checkpoint_every == 0:
+                    self._write_checkpoint(files, last_code, total + written,
+                                           False)
+
+            if skipping:
+                raise ValueError("The checkpoint's last customer, %s, "
+                                 "wasn't found" % last_code)
+            self._write_checkpoint(files, last_code, total + written, True)
+        finally:
+            for export_file in files.values():
+                export_file.close()
+
+        return written
+
+    def _check_settings(self, checkpoint):
+        for name in ('format', 'compress', 'tables'):
+            if checkpoint[name] != getattr(self, name):
+                raise ValueError("Can't resume an export with a different "
+                                 "%s" % name)
+
+    def _write_checkpoint(self, files, last_code, count, complete):
+        offsets = dict((table, export_file.checkpoint(self.sync))
+                       for table, export_file in files.items())
+        checkpoint = {
+            'format': self.format,
+            'compress': self.compress,
+            'tables': self.tables,
+            'offsets': offsets,
+            'last_code': last_code,
+            'count': count,
+            'complete': complete,
+        }
+
+        # Replace the checkpoint atomically, so a crash leaves either the
+        # old one or the new one
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                json.dump(checkpoint, f, sort_keys=True)
+                f.flush()
+                if self.sync:
+                    os.fsync(f.fileno())
+            finally:
+                f.close()
+            os.rename(temp_path, os.path.join(self.directory,
+                                              self.checkpoint_name))
+        except Exception:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
@@ -0,0 +1,428 @@
+from decimal import Decimal
+import errno
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from time import time
+
+from sharpy.records import Record
+
+
+class EntryClaimed(Exception):
+    "A journal entry was claimed by another sender, which will send it"
+    pass
+
+
+class JournalEntry(Record):
+    '''
+    One mutation recorded in a journal.
+
+    state is one of Journal.PENDING (recorded but not yet sent),
+    Journal.SENT (sent, outcome unknown), Journal.DONE or Journal.FAILED.
+    data is a list of (name, value) pairs of unicode strings.  claims is
+    the number of times the entry has been claimed.
+    '''
+    __slots__ = ('id', 'customer_code', 'path', 'params', 'data', 'method',
+                 'state', 'created', 'error', 'claims')
+
+
+def normalize_data(data):
+    '''
+    Converts request data (a dict or list of pairs, with values of any
+    type) into a list of unicode pairs which survives a round trip through
+    json unchanged.
+    '''
+    if not data:
+        return []
+    if hasattr(data, 'items'):
+        data = sorted(data.items())
+
+    return [[to_unicode(key), to_unicode(value)] for key, value in data]
+
+
+def to_unicode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    if isinstance(value, Decimal):
+        return unicode(str(value))
+
+    return unicode(value)
+
+
+def encode_data(data):
+    '''
+    Converts a journaled data list back into utf-8 pairs for urlencode.
+    '''
+    return [(key.encode('utf-8'), value.encode('utf-8'))
+            for key, value in data]
+
+
+class Journal(object):
+    '''
+    Base class for durable, append-only logs of customer mutations.
+
+    A mutation is recorded before it is sent, claimed (marked sent) just
+    before the request goes out and marked done or failed once cheddar has
+    answered.  A request refused before it went out is released back to
+    the state it was claimed from.  After a crash, get_pending finds
+    mutations which never completed: PENDING ones were never sent and are
+    always safe to send again; SENT ones may or may not have reached
+    cheddar, so replaying them risks applying them twice.
+
+    Subclasses implement record, set_state, claim, get_pending and close.
+    '''
+    PENDING = 'pending'
+    SENT = 'sent'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def record(self, customer_code, path, params=None, data=None,
+               method=None):
+        '''
+        Durably records a mutation and returns its JournalEntry.
+        '''
+        raise NotImplementedError
+
+    def set_state(self, entry_id, state, error=None):
+        raise NotImplementedError
+
+    def claim(self, entry_id, state=None, claims=0):
+        '''
+        Marks an entry sent if it is still in state (PENDING by default)
+        and has been claimed claims times, returning whether it was.  Only
+        the sender whose claim succeeds may send the entry.  Pass the
+        entry's claims as read, so that of several senders which read the
+        same SENT entry only the first to claim it wins.
+        '''
+        raise NotImplementedError
+
+    def get_pending(self, include_sent=False):
+        '''
+        Returns the entries which haven't completed, oldest first.  SENT
+        entries are only included if include_sent is True.
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def mark_sent(self, entry_id):
+        self.set_state(entry_id, self.SENT)
+
+    def release(self, entry_id, state=None):
+        '''
+        Returns a claimed entry which was never sent to state (PENDING by
+        default), so it will be sent again.
+        '''
+        self.set_state(entry_id, state or self.PENDING)
+
+    def mark_done(self, entry_id):
+        self.set_state(entry_id, self.DONE)
+
+    def mark_failed(self, entry_id, error=None):
+        if error is not None:
+            error = to_unicode(error)
+        self.set_state(entry_id, self.FAILED, error)
+
+    def new_entry(self, entry_id, customer_code, path, params, data,
+                  method):
+        return JournalEntry(
+            id=entry_id,
+            customer_code=to_unicode(customer_code),
+            path=to_unicode(path),
+            params=dict((to_unicode(key), to_unicode(value))
+                        for key, value in (params or {}).items()),
+            data=normalize_data(data),
+            method=method and to_unicode(method),
+            state=self.PENDING,
+            created=time(),
+            error=None,
+            claims=0,
+        )
+
+
+class FileJournal(Journal):
+    '''
+    A journal kept in an append-only file with one json record per line.
+
+    Every write is flushed and, if sync is True, fsynced before it returns,
+    so a recorded mutation survives the process (or with sync, the host)
+    going down.  Completed entries stay in the file until compact is
+    called.  Only one process may have a given file open at a time, so
+    claims are only atomic between the threads of that process.
+    '''
+
+    def __init__(self, path, sync=True):
+        '''
+        path - The journal file. It is created if it doesn't exist.
+        sync - Whether to fsync after every write (optional)
+        '''
+        self.path = path
+        self.sync = sync
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._last_id = 0
+        complete = self._load()
+        self._file = open(path, 'ab')
+        if not complete:
+            # Start a fresh line after a partial record from a crash
+            self._file.write('\n')
+
+        super(FileJournal, self).__init__()
+
+    def _load(self):
+        # Returns False if the file ends in a partial line
+        try:
+            f = open(self.path, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return True
+            raise
+
+        complete = True
+        try:
+            for line in f:
+                complete = line.endswith('\n')
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A partial record from a crash mid-write
+                    continue
+                self._apply(record)
+        finally:
+            f.close()
+
+        return complete
+
+    def _apply(self, record):
+        entry_id = record['id']
+        self._last_id = max(self._last_id, entry_id)
+        if 'entry' in record:
+            entry = JournalEntry(**record['entry'])
+            if entry.claims is None:
+                # Recorded before claims were counted
+                entry.claims = 0
+            self._entries[entry_id] = entry
+            return
+
+        entry = self._entries.get(entry_id)
+        if entry is None:
+            return
+        if record['state'] in (self.DONE, self.FAILED):
+            del self._entries[entry_id]
+        else:
+            entry.state = record['state']
+            entry.error = record.get('error')
+            entry.claims = record.get('claims', entry.claims)
+
+    def _write(self, record):
+        # Called with the lock held
+        self._file.write(json.dumps(record, sort_keys=True) + '\n')
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+
+    def record(self, customer_code, path, params=None, data=None,
+               method=None):
+        with self._lock:
+            self._last_id += 1
+            entry = self.new_entry(self._last_id, customer_code, path,
+                                   params, data, method)
+            self._write({'id': entry.id, 'entry': entry.to_dict()})
+            self._entries[entry.id] = entry
+
+        # A copy, as the journal's own entry changes state
+        return JournalEntry(**entry.to_dict())
+
+    def set_state(self, entry_id, state, error=None):
+        with self._lock:
+            record = {'id': entry_id, 'state': state}
+            if error is not None:
+                record['error'] = error
+            self._write(record)
+            self._apply(record)
+
+    def claim(self, entry_id, state=None, claims=0):
+        with self._lock:
+            entry = self._entries.get(entry_id)
+            if entry is None or entry.state != (state or self.PENDING) or \
+                    entry.claims != claims:
+                return False
+            record = {'id': entry_id, 'state': self.SENT,
+                      'claims': claims + 1}
+            self._write(record)
+            self._apply(record)
+
+        return True
+
+    def get_pending(self, include_sent=False):
+        with self._lock:
+            entries = [JournalEntry(**entry.to_dict())
+                       for entry in self._entries.values()
+                       if include_sent or entry.state == self.PENDING]
+
+        return sorted(entries, key=lambda entry: entry.id)
+
+    def compact(self):
+        '''
+        Rewrites the file with only the entries which haven't completed.
+        '''
+        with self._lock:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, temp_path = tempfile.mkstemp(dir=directory)
+            try:
+                f = os.fdopen(fd, 'wb')
+                try:
+                    for entry_id in sorted(self._entries):
+                        entry = self._entries[entry_id]
+                        f.write(json.dumps({'id': entry_id,
+                                            'entry': entry.to_dict()},
+                                           sort_keys=True) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+                finally:
+                    f.close()
+                os.rename(temp_path, self.path)
+            except Exception:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+                raise
+
+            self._file.close()
+            self._file = open(self.path, 'ab')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class SQLiteJournal(Journal):
+    '''
+    A journal kept in a SQLite database, which may be shared by several
+    processes on a host.  Claims are a single UPDATE conditional on the
+    entry's state and claim count, so when several processes replay the
+    journal at once each entry is sent by only one of them.  Entries are
+    kept, with their final state, until purge is called.
+    '''
+
+    def __init__(self, path, sync=True):
+        '''
+        path - The database file. It is created if it doesn't exist.
+        sync - Whether SQLite should sync every commit to disk (optional)
+        '''
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False,
+                                           timeout=30)
+        if sync:
+            self._connection.execute('PRAGMA synchronous=FULL')
+        else:
+            self._connection.execute('PRAGMA synchronous=OFF')
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS sharpy_journal ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'customer_code TEXT NOT NULL, '
+                'path TEXT NOT NULL, '
+                'params TEXT NOT NULL, '
+                'data TEXT NOT NULL, '
+                'method TEXT, '
+                'state TEXT NOT NULL, '
+                'created REAL NOT NULL, '
+                'error TEXT, '
+                'claims INTEGER NOT NULL DEFAULT 0)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS sharpy_journal_state '
+                'ON sharpy_journal (state, id)')
+            columns = [row[1] for row in self._connection.execute(
+                'PRAGMA table_info(sharpy_journal)')]
+            if 'claims' not in columns:
+                # A journal created before claims were counted
+                self._connection.execute(
+                    'ALTER TABLE sharpy_journal '
+                    'ADD COLUMN claims INTEGER NOT NULL DEFAULT 0')
+
+        super(SQLiteJournal, self).__init__()
+
+    def record(self, customer_code, path, params=None, data=None,
+               method=None):
+        entry = self.new_entry(None, customer_code, path, params, data,
+                               method)
+        with self._lock:
+            with self._connection:
+                cursor = self._connection.execute(
+                    'INSERT INTO sharpy_journal (customer_code, path, '
+                    'params, data, method, state, created) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (entry.customer_code, entry.path,
+                     json.dumps(entry.params), json.dumps(entry.data),
+                     entry.method, entry.state, entry.created))
+                entry.id = cursor.lastrowid
+
+        return entry
+
+    def set_state(self, entry_id, state, error=None):
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    'UPDATE sharpy_journal SET state = ?, error = ? '
+                    'WHERE id = ?', (state, error, entry_id))
+
+    def claim(self, entry_id, state=None, claims=0):
+        with self._lock:
+            with self._connection:
+                cursor = self._connection.execute(
+                    'UPDATE sharpy_journal SET state = ?, claims = ? '
+                    'WHERE id = ? AND state = ? AND claims = ?',
+                    (self.SENT, claims + 1, entry_id, state or self.PENDING,
+                     claims))
+
+        return cursor.rowcount == 1
+
+    def get_pending(self, include_sent=False):
+        states = [self.PENDING]
+        if include_sent:
+            states.append(self.SENT)
+
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT id, customer_code, path, params, data, method, '
+                'state, created, error, claims FROM sharpy_journal '
+                'WHERE state IN (%s) ORDER BY id' % (
+                    ', '.join('?' * len(states))),
+                states).fetchall()
+
+        entries = []
+        for row in rows:
+            entry_id, customer_code, path, params, data, method, state, \
+                created, error, claims = row
+            entries.append(JournalEntry(
+                id=entry_id, customer_code=customer_code, path=path,
+                params=json.loads(params), data=json.loads(data),
+                method=method, state=state, created=created, error=error,
+                claims=claims))
+
+        return entries
+
+    def purge(self, before=None):
+        '''
+        Deletes done and failed entries, optionally only those created
+        before the given timestamp.
+        '''
+        query = 'DELETE FROM sharpy_journal WHERE state IN (?, ?)'
+        args = [self.DONE, self.FAILED]
+        if before is not None:
+            query += ' AND created < ?'
+            args.append(before)
+
+        with self._lock:
+            with self._connection:
+                self._connection.execute(query, args)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
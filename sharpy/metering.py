@@ -0,0 +1,244 @@
+from decimal import Decimal
+import logging
+from multiprocessing.pool import ThreadPool
+import threading
+from time import time
+
+from sharpy.exceptions import CheddarError
+
+client_log = logging.getLogger('SharpyClient')
+
+
+class UsageMeter(object):
+    '''
+    Collects item quantity changes in memory and sends them to cheddar in
+    batches.
+
+    Calling Item.increment for every billable event means a blocking
+    request, and a re-parse of the customer, per event.  A meter instead
+    adds each increment or decrement to a running net delta per (customer
+    code, item code) and only sends the deltas when flushed: one request
+    per item that changed, however many events it saw.  Nothing is sent
+    for deltas which net out to zero.
+
+    Pending deltas are flushed by a background thread every flush_interval
+    seconds, and as soon as max_pending events have been recorded.  Each
+    flush sends up to workers requests at once.  Call flush to send
+    everything now and close when done; a meter can also be used as a
+    context manager.  Deltas still pending when the process exits without
+    close are lost.
+
+    Deltas which cheddar rejects with a 4xx response (an unknown customer or
+    item, say) are dropped and counted as failed.  Deltas which fail any
+    other way, such as a connection error or 5xx response, are put back to
+    be retried on the next flush.  As with any retried POST, a request
+    which reached cheddar before the connection failed may then be counted
+    twice.
+    '''
+    default_max_pending = 1000
+    default_flush_interval = 5
+    default_workers = 4
+    precision = Decimal('.0001')
+
+    def __init__(self, product, max_pending=None, flush_interval=None,
+                 workers=None):
+        '''
+        product - The CheddarProduct to send quantities through
+        max_pending - Number of recorded events which triggers a flush
+                      (optional)
+        flush_interval - Seconds between background flushes (optional)
+        workers - Maximum number of requests in flight during a flush
+                  (optional)
+        '''
+        self.product = product
+        self.max_pending = max_pending or self.default_max_pending
+        self.flush_interval = flush_interval or self.default_flush_interval
+        self.workers = workers or self.default_workers
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._deltas = {}
+        self._pending_events = 0
+        self._wake = threading.Event()
+        self._closed = False
+        self._flusher = None
+        self._executor = None
+        self.stats = {
+            'events': 0,
+            'flushes': 0,
+            'requests': 0,
+            'failed': 0,
+            'requeued': 0,
+        }
+
+        super(UsageMeter, self).__init__()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def increment(self, customer_code, item_code, quantity=1):
+        '''
+        Records that the customer used quantity more of the item.
+        '''
+        self.add(customer_code, item_code, Decimal(quantity))
+
+    def decrement(self, customer_code, item_code, quantity=1):
+        '''
+        Records that the customer used quantity less of the item.
+        '''
+        self.add(customer_code, item_code, -Decimal(quantity))
+
+    def add(self, customer_code, item_code, delta, events=1):
+        with self._lock:
+            if self._closed:
+                raise ValueError('Usage meter is closed')
+            key = (customer_code, item_code)
+            self._deltas[key] = self._deltas.get(key, 0) + delta
+            self._pending_events += events
+            self.stats['events'] += events
+            full = self._pending_events >= self.max_pending
+            self._start_flusher()
+
+        if full:
+            self._wake.set()
+
+    def get_pending(self):
+        '''
+        Returns a dict of the net deltas waiting to be sent, keyed by
+        (customer code, item code).
+        '''
+        with self._lock:
+            return dict((key, delta) for key, delta in self._deltas.items()
+                        if delta)
+
+    def flush(self):
+        '''
+        Sends every pending delta now, waiting until they have been sent.
+        Returns the number of requests made.
+        '''
+        with self._flush_lock:
+            with self._lock:
+                deltas = self._deltas
+                self._deltas = {}
+                self._pending_events = 0
+
+            deltas = [(key, delta) for key, delta in deltas.iteritems()
+                      if delta]
+            if not deltas:
+                return 0
+
+            results = self.executor.map(self._send, deltas)
+            with self._lock:
+                self.stats['flushes'] += 1
+                self.stats['requests'] += len(deltas)
+                for (key, delta), outcome in zip(deltas, results):
+                    if outcome is not None:
+                        self.stats[outcome] += 1
+                    if outcome == 'requeued':
+                        self._deltas[key] = self._deltas.get(key, 0) + delta
+
+        return len(deltas)
+
+    def close(self):
+        '''
+        Stops the background flusher and sends anything still pending.
+        '''
+        with self._lock:
+            self._closed = True
+            flusher = self._flusher
+        self._wake.set()
+        if flusher is not None:
+            flusher.join()
+
+        try:
+            self.flush()
+        finally:
+            if self._executor is not None:
+                self._executor.close()
+                self._executor.join()
+                self._executor = None
+
+    def get_stats(self):
+        '''
+        Returns counts of recorded events, flushes, requests made, deltas
+        dropped after failing and deltas put back to retry, along with the
+        number of deltas pending.
+        '''
+        with self._lock:
+            stats = dict(self.stats)
+            stats['pending'] = len([delta for delta in self._deltas.values()
+                                    if delta])
+
+        return stats
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPool(self.workers)
+
+        return self._executor
+
+    def _send(self, pending):
+        # Returns None on success, otherwise the stat to count the failure
+        # under
+        (customer_code, item_code), delta = pending
+        if delta > 0:
+            path = 'customers/add-item-quantity'
+        else:
+            path = 'customers/remove-item-quantity'
+        quantity = abs(delta).quantize(self.precision)
+
+        try:
+            self.product.make_customer_request(
+                code=customer_code,
+                path=path,
+                params={
+                    'code': customer_code,
+                    'itemCode': item_code,
+                },
+                data={'quantity': quantity},
+                method='POST',
+            )
+        except CheddarError, e:
+            if e.response.status >= 500:
+                client_log.warning('Will retry %s of %s for %s: %s' % (
+                    delta, item_code, customer_code, e))
+                return 'requeued'
+            client_log.error('Dropping %s of %s for %s: %s' % (
+                delta, item_code, customer_code, e))
+            return 'failed'
+        except Exception, e:
+            client_log.warning('Will retry %s of %s for %s: %s' % (
+                delta, item_code, customer_code, e))
+            return 'requeued'
+
+    def _start_flusher(self):
+        # Called with the lock held
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._run_flusher,
+                                             name='sharpy-usage-meter')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _run_flusher(self):
+        next_flush = time() + self.flush_interval
+        while True:
+            self._wake.wait(max(next_flush - time(), 0))
+            self._wake.clear()
+            with self._lock:
+                closed = self._closed
+                due = (self._pending_events >= self.max_pending or
+                       time() >= next_flush)
+            if closed:
+                return
+            if not due:
+                continue
+
+            next_flush = time() + self.flush_interval
+            try:
+                self.flush()
+            except Exception:
+                client_log.exception('Usage meter flush failed')
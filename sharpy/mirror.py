@@ -0,0 +1,542 @@
+from datetime import datetime
+from decimal import Decimal
+import json
+import sqlite3
+import threading
+
+from dateutil.tz import tzutc
+
+try:
+    from lxml.etree import XML, tostring
+except ImportError:
+    from elementtree.ElementTree import XML, tostring
+
+from sharpy.parsers import CustomersParser
+from sharpy.product import Customer
+
+UTC = tzutc()
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS customers ('
+    'code TEXT PRIMARY KEY, id TEXT, first_name TEXT, last_name TEXT, '
+    'email TEXT, company TEXT, notes TEXT, gateway_token TEXT, '
+    'is_vat_exempt TEXT, vat_number TEXT, first_contact timestamp, '
+    'referer TEXT, referer_host TEXT, campaign_source TEXT, '
+    'campaign_medium TEXT, campaign_term TEXT, campaign_content TEXT, '
+    'campaign_name TEXT, created timestamp, modified timestamp, '
+    'meta_data TEXT, xml BLOB NOT NULL, synced timestamp NOT NULL)',
+
+    'CREATE TABLE IF NOT EXISTS subscriptions ('
+    'id TEXT PRIMARY KEY, customer_code TEXT NOT NULL, plan_code TEXT, '
+    'gateway_token TEXT, gateway TEXT, cc_first_name TEXT, '
+    'cc_last_name TEXT, cc_company TEXT, cc_country TEXT, '
+    'cc_address TEXT, cc_city TEXT, cc_state TEXT, cc_zip TEXT, '
+    'cc_type TEXT, cc_email TEXT, cc_last_four TEXT, '
+    'cc_expiration_date date, cancel_type TEXT, cancel_reason TEXT, '
+    'canceled timestamp, created timestamp, coupon_code TEXT)',
+
+    'CREATE TABLE IF NOT EXISTS plans ('
+    'code TEXT PRIMARY KEY, id TEXT, name TEXT, description TEXT, '
+    'is_active INTEGER, is_free INTEGER, trial_days INTEGER, '
+    'billing_frequency TEXT, billing_frequency_per TEXT, '
+    'billing_frequency_unit TEXT, billing_frequency_quantity INTEGER, '
+    'setup_charge_code TEXT, setup_charge_amount decimal, '
+    'recurring_charge_code TEXT, recurring_charge_amount decimal, '
+    'created timestamp)',
+
+    'CREATE TABLE IF NOT EXISTS items ('
+    'customer_code TEXT NOT NULL, code TEXT NOT NULL, id TEXT, name TEXT, '
+    'quantity decimal, quantity_included decimal, is_periodic INTEGER, '
+    'overage_amount decimal, created timestamp, modified timestamp, '
+    'PRIMARY KEY (customer_code, code))',
+
+    'CREATE TABLE IF NOT EXISTS invoices ('
+    'id TEXT PRIMARY KEY, customer_code TEXT NOT NULL, '
+    'subscription_id TEXT, number TEXT, type TEXT, vat_rate TEXT, '
+    'billing_datetime timestamp, paid_transaction_id TEXT, '
+    'created timestamp)',
+
+    'CREATE TABLE IF NOT EXISTS charges ('
+    'id INTEGER PRIMARY KEY, charge_id TEXT, invoice_id TEXT NOT NULL, '
+    'customer_code TEXT NOT NULL, code TEXT, type TEXT, '
+    'quantity decimal, each_amount decimal, description TEXT, '
+    'created timestamp)',
+
+    'CREATE TABLE IF NOT EXISTS mirror_state ('
+    'name TEXT PRIMARY KEY, value TEXT)',
+
+    'CREATE INDEX IF NOT EXISTS customers_email ON customers (email)',
+    'CREATE INDEX IF NOT EXISTS customers_created ON customers (created)',
+    'CREATE INDEX IF NOT EXISTS subscriptions_customer '
+    'ON subscriptions (customer_code)',
+    'CREATE INDEX IF NOT EXISTS subscriptions_plan '
+    'ON subscriptions (plan_code, canceled)',
+    'CREATE INDEX IF NOT EXISTS subscriptions_expiration '
+    'ON subscriptions (cc_expiration_date)',
+    'CREATE INDEX IF NOT EXISTS items_code ON items (code)',
+    'CREATE INDEX IF NOT EXISTS invoices_customer '
+    'ON invoices (customer_code)',
+    'CREATE INDEX IF NOT EXISTS invoices_billing '
+    'ON invoices (billing_datetime)',
+    'CREATE INDEX IF NOT EXISTS charges_invoice ON charges (invoice_id)',
+    'CREATE INDEX IF NOT EXISTS charges_customer '
+    'ON charges (customer_code)',
+    'CREATE INDEX IF NOT EXISTS charges_code ON charges (code)',
+]
+
+# Tables holding rows which belong to a customer
+CUSTOMER_TABLES = ('charges', 'invoices', 'items', 'subscriptions')
+
+# Customer columns find_customers returns
+SUMMARY_COLUMNS = (
+    'c.code', 'c.id', 'c.first_name', 'c.last_name', 'c.email', 'c.company',
+    'c.created', 'c.modified', 's.id AS subscription_id', 's.plan_code',
+    's.canceled', 's.cc_type', 's.cc_last_four', 's.cc_expiration_date',
+    's.coupon_code')
+
+# Columns holding amounts and quantities, which are read back as Decimals
+DECIMAL_COLUMNS = frozenset([
+    'setup_charge_amount', 'recurring_charge_amount', 'quantity',
+    'quantity_included', 'overage_amount', 'each_amount'])
+
+
+def to_utc(value):
+    '''
+    Converts a datetime to the naive UTC datetime the mirror stores.  Dates
+    and naive datetimes are assumed to be UTC already.
+    '''
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone(UTC).replace(tzinfo=None)
+
+    return value
+
+
+def to_sql_decimal(value):
+    '''
+    Converts a Decimal to the string the mirror stores.
+    '''
+    if value is None:
+        return None
+
+    return str(value)
+
+
+def from_sql_decimal(value):
+    '''
+    Converts a stored amount or quantity back into a Decimal.  SQLite keeps
+    numeric strings as integers or floats.
+    '''
+    if value is None:
+        return None
+    if isinstance(value, float):
+        value = repr(value)
+
+    return Decimal(value)
+
+
+def make_row(cursor, values):
+    # Row factory which reads the DECIMAL_COLUMNS as Decimals
+    values = list(values)
+    for index, column in enumerate(cursor.description):
+        if column[0] in DECIMAL_COLUMNS:
+            values[index] = from_sql_decimal(values[index])
+
+    return sqlite3.Row(cursor, tuple(values))
+
+
+def parse_expiration_date(value):
+    # Cheddar sends card expiration dates as a datetime string
+    if not value:
+        return None
+
+    try:
+        return datetime.strptime(value[:10], '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+
+class CustomerMirror(object):
+    '''
+    A local SQLite copy of a product's customers, with their current
+    subscription, plan, items, invoices and charges, for reporting and
+    support tools which would otherwise download the whole account from
+    cheddar for every question.
+
+    Call sync to bring the mirror up to date, then use find_customers
+    (summary rows), get_customers (Customer objects) or query (any SQL)
+    to read it.  Tables:
+
+    customers
+        One row per customer, keyed by code.  The xml column holds the
+        customer's complete xml, from which get_customers rebuilds Customer
+        objects.
+    subscriptions
+        The current subscription of each customer (customer_code)
+    plans
+        Every plan a subscription is on, keyed by code
+    items
+        Item quantities, keyed by (customer_code, code)
+    invoices, charges
+        Each subscription's invoices and their charges
+
+    Datetimes are stored as naive UTC datetimes.  Amounts and quantities
+    are read back as Decimals from columns with the names in
+    DECIMAL_COLUMNS.  Several threads or processes may read one mirror
+    while another syncs it; readers keep seeing the old data until a sync
+    completes.
+    '''
+    batch_size = 500
+
+    def __init__(self, product, path):
+        '''
+        product - The CheddarProduct to mirror, and to bind Customer objects
+                  returned by get_customers to
+        path - The database file. It is created if it doesn't exist.
+        '''
+        self.product = product
+        self.path = path
+        # Syncs write through their own connection, so reads don't wait
+        # for a sync to finish downloading.
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._connection = self._connect()
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        with self._connection:
+            for statement in SCHEMA:
+                self._connection.execute(statement)
+        self._reader = self._connect()
+
+        super(CustomerMirror, self).__init__()
+
+    def _connect(self):
+        connection = sqlite3.connect(
+            self.path, check_same_thread=False, timeout=30,
+            detect_types=sqlite3.PARSE_DECLTYPES)
+        connection.row_factory = make_row
+
+        return connection
+
+    def sync(self, filter_data=None, prune=None, **filters):
+        '''
+        Downloads the customers matching the filters (see
+        CheddarProduct.get_customers) and stores them, replacing what the
+        mirror held for them.  The whole sync is one transaction.
+
+        prune - Whether to delete customers which weren't downloaded.  Only
+                a sync of every customer can prune, and does by default.
+                (optional)
+
+        Returns the number of customers stored.
+        '''
+        if prune is None:
+            prune = not filter_data and not filters
+        elif prune and (filter_data or filters):
+            raise ValueError("Can't prune a filtered sync")
+
+        synced = to_utc(datetime.now(UTC))
+        parser = CustomersParser()
+        count = 0
+        with self._sync_lock:
+            with self._connection:
+                if prune:
+                    for table in CUSTOMER_TABLES + ('customers', 'plans'):
+                        self._connection.execute('DELETE FROM %s' % table)
+
+                batch = []
+                for customer_element in self.product.iter_customer_elements(
+                        filter_data, parser, **filters):
+                    batch.append(self._build_rows(customer_element, parser,
+                                                  synced))
+                    if len(batch) >= self.batch_size:
+                        self._write_batch(batch, replace=not prune)
+                        count += len(batch)
+                        batch = []
+                if batch:
+                    self._write_batch(batch, replace=not prune)
+                    count += len(batch)
+
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO mirror_state (name, value) '
+                    'VALUES (?, ?)',
+                    ('last_sync', synced.strftime('%Y-%m-%d %H:%M:%S')))
+
+        return count
+
+    def get_last_sync(self):
+        '''
+        Returns when the last sync started, as a naive UTC datetime, or None
+        if the mirror has never been synced.
+        '''
+        rows = self.query('SELECT value FROM mirror_state '
+                          'WHERE name = ?', ('last_sync',))
+        if not rows:
+            return None
+
+        return datetime.strptime(rows[0]['value'], '%Y-%m-%d %H:%M:%S')
+
+    def query(self, sql, params=()):
+        '''
+        Runs any SQL against the mirror and returns the rows, which can be
+        read like tuples or by column name.
+        '''
+        with self._lock:
+            return self._reader.execute(sql, params).fetchall()
+
+    def find_customers(self, order_by='c.code', limit=None, **filters):
+        '''
+        Returns summary rows for the customers matching the filters, each
+        with the customer's code, id, names, email, company, created and
+        modified along with its subscription_id, plan_code, canceled,
+        cc_type, cc_last_four, cc_expiration_date and coupon_code.
+
+        Filters:
+
+        code
+            A customer code or list of codes
+        plan_code
+            A plan code or list of codes
+        email
+            An email address
+        canceled
+            True for only canceled customers, False for only active ones
+        created_after, created_before
+            Datetimes bounding when the customer was created
+        card_expires_after, card_expires_before
+            Dates bounding the card's expiration date (inclusive)
+        item_code
+            Only customers using more than none of this item
+
+        order_by is an SQL ORDER BY expression over the customers (c) and
+        subscriptions (s) tables, and limit caps the number of rows.
+        '''
+        where, params = self._build_where(**filters)
+        sql = ('SELECT %s FROM customers c '
+               'LEFT JOIN subscriptions s ON s.customer_code = c.code%s '
+               'ORDER BY %s' % (', '.join(SUMMARY_COLUMNS), where, order_by))
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+
+        return self.query(sql, params)
+
+    def count_customers(self, **filters):
+        '''
+        Returns the number of customers matching the filters (see
+        find_customers).
+        '''
+        where, params = self._build_where(**filters)
+        rows = self.query(
+            'SELECT COUNT(*) FROM customers c '
+            'LEFT JOIN subscriptions s ON s.customer_code = c.code%s' % where,
+            params)
+
+        return rows[0][0]
+
+    def get_customers(self, order_by='c.code', limit=None, **filters):
+        '''
+        Returns Customer objects for the customers matching the filters (see
+        find_customers), as they were at the last sync.  Each customer's
+        subscription is decoded when first used.
+        '''
+        where, params = self._build_where(**filters)
+        sql = ('SELECT c.xml FROM customers c '
+               'LEFT JOIN subscriptions s ON s.customer_code = c.code%s '
+               'ORDER BY %s' % (where, order_by))
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+
+        parser = CustomersParser()
+        return [Customer.from_element(XML(str(row[0])), self.product,
+                                      parser)
+                for row in self.query(sql, params)]
+
+    def get_customer(self, code):
+        '''
+        Returns the mirrored Customer with the given code, or None.
+        '''
+        customers = self.get_customers(code=code)
+        if not customers:
+            return None
+
+        return customers[0]
+
+    def close(self):
+        with self._sync_lock:
+            with self._lock:
+                self._reader.close()
+                self._connection.close()
+
+    def _build_where(self, code=None, plan_code=None, email=None,
+                     canceled=None, created_after=None, created_before=None,
+                     card_expires_after=None, card_expires_before=None,
+                     item_code=None):
+        clauses = []
+        params = []
+
+        def add_in(column, values):
+            if isinstance(values, basestring):
+                values = [values]
+            values = list(values)
+            clauses.append('%s IN (%s)' % (column,
+                                           ', '.join('?' * len(values))))
+            params.extend(values)
+
+        if code is not None:
+            add_in('c.code', code)
+        if plan_code is not None:
+            add_in('s.plan_code', plan_code)
+        if email is not None:
+            clauses.append('c.email = ?')
+            params.append(email)
+        if canceled is not None:
+            if canceled:
+                clauses.append('s.canceled IS NOT NULL')
+            else:
+                clauses.append('s.canceled IS NULL')
+        if created_after is not None:
+            clauses.append('c.created >= ?')
+            params.append(to_utc(created_after))
+        if created_before is not None:
+            clauses.append('c.created < ?')
+            params.append(to_utc(created_before))
+        if card_expires_after is not None:
+            clauses.append('s.cc_expiration_date >= ?')
+            params.append(card_expires_after)
+        if card_expires_before is not None:
+            clauses.append('s.cc_expiration_date <= ?')
+            params.append(card_expires_before)
+        if item_code is not None:
+            clauses.append('EXISTS (SELECT 1 FROM items i '
+                           'WHERE i.customer_code = c.code AND i.code = ? '
+                           'AND i.quantity > 0)')
+            params.append(item_code)
+
+        if not clauses:
+            return '', params
+
+        return ' WHERE ' + ' AND '.join(clauses), params
+
+    def _build_rows(self, customer_element, parser, synced):
+        # Decodes a customer element into the rows for each table
+        customer = parser.parse_customer(customer_element)
+        code = customer['code']
+        meta_data = dict((datum['name'], datum['value'])
+                         for datum in customer['meta_data'])
+        rows = {
+            'customers': [(
+                code, customer['id'], customer['first_name'],
+                customer['last_name'], customer['email'],
+                customer['company'], customer['notes'],
+                customer['gateway_token'], customer['is_vat_exempt'],
+                customer['vat_number'],
+                to_utc(customer['first_contact_datetime']),
+                customer['referer'], customer['referer_host'],
+                customer['campaign_source'], customer['campaign_medium'],
+                customer['campaign_term'], customer['campaign_content'],
+                customer['campaign_name'],
+                to_utc(customer['created_datetime']),
+                to_utc(customer['modified_datetime']),
+                json.dumps(meta_data, sort_keys=True),
+                sqlite3.Binary(tostring(customer_element)), synced)],
+            'subscriptions': [],
+            'plans': [],
+            'items': [],
+            'invoices': [],
+            'charges': [],
+        }
+        if not customer['subscriptions']:
+            return code, rows
+
+        subscription = customer['subscriptions'][0]
+        plan = None
+        if subscription['plans']:
+            plan = subscription['plans'][0]
+        gateway_account = subscription.get('gateway_account')
+        rows['subscriptions'].append((
+            subscription['id'], code, plan and plan['code'],
+            subscription['gateway_token'],
+            gateway_account and gateway_account.gateway,
+            subscription['cc_first_name'], subscription['cc_last_name'],
+            subscription['cc_company'], subscription['cc_country'],
+            subscription['cc_address'], subscription['cc_city'],
+            subscription['cc_state'], subscription['cc_zip'],
+            subscription['cc_type'], subscription['cc_email'],
+            subscription['cc_last_four'],
+            parse_expiration_date(subscription['cc_expiration_date']),
+            subscription['cancel_type'], subscription['cancel_reason'],
+            to_utc(subscription['canceled_datetime']),
+            to_utc(subscription['created_datetime']),
+            subscription['coupon_code']))
+
+        plan_items = {}
+        if plan is not None:
+            rows['plans'].append((
+                plan['code'], plan['id'], plan['name'], plan['description'],
+                plan['is_active'], plan['is_free'], plan['trial_days'],
+                plan['billing_frequency'], plan['billing_frequency_per'],
+                plan['billing_frequency_unit'],
+                plan['billing_frequency_quantity'],
+                plan['setup_charge_code'],
+                to_sql_decimal(plan['setup_charge_amount']),
+                plan['recurring_charge_code'],
+                to_sql_decimal(plan['recurring_charge_amount']),
+                to_utc(plan['created_datetime'])))
+            plan_items = dict((item['code'], item) for item in plan['items'])
+
+        for item in subscription['items']:
+            plan_item = plan_items.get(item['code'], {})
+            rows['items'].append((
+                code, item['code'], item['id'], item['name'],
+                to_sql_decimal(item['quantity']),
+                to_sql_decimal(plan_item.get('quantity_included')),
+                plan_item.get('is_periodic'),
+                to_sql_decimal(plan_item.get('overage_amount')),
+                to_utc(item['created_datetime']),
+                to_utc(item['modified_datetime'])))
+
+        for invoice in subscription['invoices']:
+            rows['invoices'].append((
+                invoice.id, code, subscription['id'], invoice.number,
+                invoice.type, invoice.vat_rate,
+                to_utc(invoice.billing_datetime),
+                invoice.paid_transaction_id,
+                to_utc(invoice.created_datetime)))
+            for charge in invoice.charges:
+                rows['charges'].append((
+                    charge.id or None, invoice.id, code, charge.code,
+                    charge.type, to_sql_decimal(charge.quantity),
+                    to_sql_decimal(charge.each_amount),
+                    charge.description, to_utc(charge.created_datetime)))
+
+        return code, rows
+
+    def _write_batch(self, batch, replace):
+        # Called with the sync lock held, in a transaction
+        if replace:
+            codes = [(code,) for code, rows in batch]
+            for table in CUSTOMER_TABLES:
+                self._connection.executemany(
+                    'DELETE FROM %s WHERE customer_code = ?' % table, codes)
+
+        inserts = {
+            'customers': 'INSERT OR REPLACE INTO customers VALUES (%s)' % (
+                ', '.join('?' * 23)),
+            'subscriptions': 'INSERT OR REPLACE INTO subscriptions '
+                             'VALUES (%s)' % ', '.join('?' * 22),
+            'plans': 'INSERT OR REPLACE INTO plans VALUES (%s)' % (
+                ', '.join('?' * 16)),
+            'items': 'INSERT OR REPLACE INTO items VALUES (%s)' % (
+                ', '.join('?' * 10)),
+            'invoices': 'INSERT OR REPLACE INTO invoices VALUES (%s)' % (
+                ', '.join('?' * 9)),
+            'charges': 'INSERT INTO charges (charge_id, invoice_id, '
+                       'customer_code, code, type, quantity, each_amount, '
+                       'description, created) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        }
+        for table in ('customers', 'subscriptions', 'plans', 'items',
+                      'invoices', 'charges'):
+            table_rows = []
+            for code, rows in batch:
+                table_rows.extend(rows[table])
+            if table_rows:
+                self._connection.executemany(inserts[table], table_rows)
@@ -1,17 +1,34 @@
+import cPickle as pickle
+from cStringIO import StringIO
+from datetime import datetime
 from decimal import Decimal, InvalidOperation
+import gc
 import logging
+from multiprocessing import cpu_count, Pool
+import re
 
 from dateutil import parser as date_parser
+from dateutil.tz import tzoffset, tzutc
 
 try:
-    from lxml.etree import XML
+    from lxml.etree import XML, iterparse
 except ImportError:
-    from elementtree.ElementTree import XML
+    from elementtree.ElementTree import XML, iterparse
 
 from sharpy.exceptions import ParseError
+from sharpy.records import Charge, Coupon, GatewayAccount, Incentive, Invoice
 
 client_log = logging.getLogger('SharpyClient')
 
+# Cheddar always formats datetimes as YYYY-MM-DDTHH:MM:SS+00:00
+ISO_DATETIME_RE = re.compile(
+    r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)'
+    r'(?:(Z)|([+-])(\d\d):?(\d\d))?$')
+
+UTC = tzutc()
+
+CUSTOMER_END = '</customer>'
+
 
 def parse_error(xml_str):
     error = {}
@@ -31,6 +48,55 @@ def parse_error(xml_str):
     return error
 
 
+class LazyElementList(object):
+    '''
+    A read only list which decodes each of its xml elements with
+    parse_element the first time that item is accessed.  Decoded items are
+    kept, and their elements released.
+    '''
+    _undecoded = object()
+
+    def __init__(self, parent_element, parse_element):
+        if parent_element is None:
+            self._elements = []
+        else:
+            self._elements = list(parent_element)
+        self._values = [self._undecoded] * len(self._elements)
+        self._parse_element = parse_element
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+
+        value = self._values[index]
+        if value is self._undecoded:
+            value = self._parse_element(self._elements[index])
+            self._values[index] = value
+            self._elements[index] = None
+
+        return value
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __reduce__(self):
+        # Elements can't be pickled, so pickle as the decoded list
+        return list, (list(self),)
+
+
 class CheddarOutputParser(object):
     '''
     A utility class for parsing the various datatypes returned by the
@@ -58,26 +124,91 @@ class CheddarOutputParser(object):
 
         return value
 
+    # Parsed Decimals keyed by their source string.  Constructing a Decimal
+    # is slow and a document holds only a handful of distinct amounts and
+    # quantities, which are immutable and so can be shared like datetimes.
+    decimal_memo = {}
+    decimal_memo_size = 10000
+
     def parse_decimal(self, content):
         value = None
         if content != '' and content is not None:
+            try:
+                return self.decimal_memo[content]
+            except KeyError:
+                pass
+
             try:
                 value = Decimal(content)
             except InvalidOperation:
                 raise ParseError("Can't parse '%s' as a decimal." % content)
 
+            if len(self.decimal_memo) >= self.decimal_memo_size:
+                self.decimal_memo.clear()
+            self.decimal_memo[content] = value
+
         return value
 
+    # Parsed datetimes keyed by their source string.  The same few
+    # timestamps repeat throughout a document (a customer's created time
+    # is shared by its subscription, items, invoices, ...) and datetimes
+    # are immutable, so they can be handed out again.
+    datetime_memo = {}
+    datetime_memo_size = 10000
+
     def parse_datetime(self, content):
         value = None
         if content:
             try:
-                value = date_parser.parse(content)
-            except ValueError:
-                raise ParseError("Can't parse '%s' as a datetime." % content)
+                return self.datetime_memo[content]
+            except KeyError:
+                pass
+
+            value = self.parse_iso_datetime(content)
+            if value is None:
+                try:
+                    value = date_parser.parse(content)
+                except ValueError:
+                    raise ParseError(
+                        "Can't parse '%s' as a datetime." % content)
+
+            if len(self.datetime_memo) >= self.datetime_memo_size:
+                self.datetime_memo.clear()
+            self.datetime_memo[content] = value
 
         return value
 
+    def parse_iso_datetime(self, content):
+        '''
+        Fast path for the ISO 8601 datetimes cheddar returns.  Returns None
+        for anything else so the caller can fall back to dateutil.
+        '''
+        match = ISO_DATETIME_RE.match(content)
+        if match is None:
+            return None
+
+        (year, month, day, hour, minute, second, zulu, sign, offset_hours,
+         offset_minutes) = match.groups()
+
+        if zulu:
+            tzinfo = UTC
+        elif sign:
+            offset = int(offset_hours) * 3600 + int(offset_minutes) * 60
+            if offset == 0:
+                tzinfo = UTC
+            else:
+                if sign == '-':
+                    offset = -offset
+                tzinfo = tzoffset(None, offset)
+        else:
+            tzinfo = None
+
+        try:
+            return datetime(int(year), int(month), int(day), int(hour),
+                            int(minute), int(second), tzinfo=tzinfo)
+        except ValueError:
+            return None
+
 
 class PlansParser(CheddarOutputParser):
     '''
@@ -157,7 +288,17 @@ class CustomersParser(CheddarOutputParser):
     '''
     Utility class for parsing cheddar's xml output for customers.
     '''
-    def parse_xml(self, xml_str):
+    chunks_per_process = 4
+
+    def parse_xml(self, xml_str, processes=None, pool=None):
+        '''
+        processes - Parse with this many worker processes, see
+                    parse_xml_parallel (optional)
+        pool - Parse on this multiprocessing.Pool (optional)
+        '''
+        if pool is not None or (processes and processes > 1):
+            return self.parse_xml_parallel(xml_str, processes, pool)
+
         customers = []
         customers_xml = XML(xml_str)
         for customer_xml in customers_xml:
@@ -166,7 +307,111 @@ class CustomersParser(CheddarOutputParser):
 
         return customers
 
+    def parse_xml_parallel(self, xml_str, processes=None, pool=None,
+                           chunks=None):
+        '''
+        Parses a customers document across a pool of processes, for
+        documents big enough that parsing them would keep one core busy for
+        a long time.
+
+        The raw document is cut into chunks of consecutive customers (see
+        split_customers_xml) without being parsed, each worker parses whole
+        chunks and sends back its customers pickled into a single string,
+        and the chunks' customers are joined back together in document
+        order.  The result is the same as parse_xml's.
+
+        processes - How many worker processes to start, one per cpu by
+                    default.  If pool is given, how many processes it has.
+                    (optional)
+        pool - A multiprocessing.Pool to parse on instead of starting one.
+               Reusing a pool saves starting processes for every document.
+               (optional)
+        chunks - How many chunks to cut the document into, chunks_per_process
+                 per process by default, which keeps every process busy
+                 when some chunks take longer than others (optional)
+        '''
+        processes = processes or cpu_count()
+        own_pool = pool is None
+        if own_pool:
+            pool = Pool(processes)
+        pieces = split_customers_xml(
+            xml_str, chunks or processes * self.chunks_per_process)
+
+        customers = []
+        decimals = {}
+        try:
+            # imap hands the chunks back in order, so each can be unpickled
+            # and dropped while later ones are still being parsed
+            for result in pool.imap(parse_customers_chunk,
+                                    [(type(self), piece)
+                                     for piece in pieces]):
+                customers.extend(load_compact(result, decimals))
+        except Exception:
+            if own_pool:
+                pool.terminate()
+                pool.join()
+            raise
+        if own_pool:
+            pool.close()
+            pool.join()
+
+        return customers
+
+    def iter_parse(self, source):
+        '''
+        Incrementally parses a customers document from source, a file name
+        or file-like object, yielding one customer dict at a time.  Each
+        customer element is discarded once it has been parsed so memory
+        use stays flat no matter how many customers the document holds.
+        '''
+        for customer_element in self.iter_elements(source):
+            yield self.parse_customer(customer_element)
+
+    def iter_elements(self, source):
+        '''
+        Incrementally parses a customers document from source, yielding each
+        complete customer element.  Elements are detached from the document
+        once the caller moves on to the next one.
+        '''
+        depth = 0
+        root = None
+        for event, element in iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth == 1 and element.tag == 'customer':
+                yield element
+                root.clear()
+
+    def parse_elements(self, xml_str):
+        '''
+        Returns the customer elements in a customers document without
+        decoding them.
+        '''
+        return list(XML(xml_str))
+
     def parse_customer(self, customer_element):
+        customer = self.parse_customer_info(customer_element)
+
+        # Metadata
+        customer['meta_data'] = self.parse_meta_data(
+            customer_element.find('metaData'))
+
+        # Subscriptions
+        customer['subscriptions'] = self.parse_subscriptions(
+            customer_element.find('subscriptions'))
+
+        return customer
+
+    def parse_customer_info(self, customer_element):
+        '''
+        Parses a customer's own fields, without its meta data or
+        subscriptions.
+        '''
         customer = {}
 
         # Basic info
@@ -197,14 +442,6 @@ class CustomersParser(CheddarOutputParser):
         customer['modified_datetime'] = self.parse_datetime(
             customer_element.findtext('modifiedDatetime'))
 
-        # Metadata
-        customer['meta_data'] = self.parse_meta_data(
-            customer_element.find('metaData'))
-
-        # Subscriptions
-        customer['subscriptions'] = self.parse_subscriptions(
-            customer_element.find('subscriptions'))
-
         return customer
 
     def parse_meta_data(self, meta_data_element):
@@ -236,6 +473,26 @@ class CustomersParser(CheddarOutputParser):
         return subscriptions
 
     def parse_subscription(self, subscription_element):
+        subscription = self.parse_subscription_info(subscription_element)
+
+        # Plans
+        subscription['plans'] = self.parse_plans(
+            subscription_element.find('plans'))
+
+        # Invoices
+        subscription['invoices'] = self.parse_invoices(
+            subscription_element.find('invoices'))
+
+        subscription['items'] = self.parse_subscription_items(
+            subscription_element.find('items'))
+
+        return subscription
+
+    def parse_subscription_info(self, subscription_element):
+        '''
+        Parses a subscription's own fields, without its plans, invoices or
+        items.
+        '''
         subscription = {}
 
         # Basic info
@@ -270,25 +527,14 @@ class CustomersParser(CheddarOutputParser):
             'couponCode')
         gateway_account_element = subscription_element.find('gatewayAccount')
         if gateway_account_element is not None:
-            subscription['gateway_account'] = {
-                'id': gateway_account_element.findtext('id'),
-                'gateway': gateway_account_element.findtext('gateway'),
-                'type': gateway_account_element.findtext('type')
-            }
+            subscription['gateway_account'] = GatewayAccount(
+                id=gateway_account_element.findtext('id'),
+                gateway=gateway_account_element.findtext('gateway'),
+                type=gateway_account_element.findtext('type'),
+            )
         subscription['redirect_url'] = subscription_element.findtext(
             'redirectUrl')
 
-        # Plans
-        subscription['plans'] = self.parse_plans(
-            subscription_element.find('plans'))
-
-        # Invoices
-        subscription['invoices'] = self.parse_invoices(
-            subscription_element.find('invoices'))
-
-        subscription['items'] = self.parse_subscription_items(
-            subscription_element.find('items'))
-
         return subscription
 
     def parse_plans(self, plans_element):
@@ -310,21 +556,19 @@ class CustomersParser(CheddarOutputParser):
         return invoices
 
     def parse_invoice(self, invoice_element):
-        invoice = {}
-
-        invoice['id'] = invoice_element.attrib['id']
-        invoice['number'] = invoice_element.findtext('number')
-        invoice['type'] = invoice_element.findtext('type')
-        invoice['vat_rate'] = invoice_element.findtext('vatRate')
-        invoice['billing_datetime'] = self.parse_datetime(
-            invoice_element.findtext('billingDatetime'))
-        invoice['paid_transaction_id'] = invoice_element.findtext(
-            'paidTransactionId')
-        invoice['created_datetime'] = self.parse_datetime(
-            invoice_element.findtext('createdDatetime'))
-
-        invoice['charges'] = self.parse_charges(
-            invoice_element.find('charges'))
+        invoice = Invoice(
+            id=invoice_element.attrib['id'],
+            number=invoice_element.findtext('number'),
+            type=invoice_element.findtext('type'),
+            vat_rate=invoice_element.findtext('vatRate'),
+            billing_datetime=self.parse_datetime(
+                invoice_element.findtext('billingDatetime')),
+            paid_transaction_id=invoice_element.findtext(
+                'paidTransactionId'),
+            created_datetime=self.parse_datetime(
+                invoice_element.findtext('createdDatetime')),
+            charges=self.parse_charges(invoice_element.find('charges')),
+        )
 
         return invoice
 
@@ -337,18 +581,17 @@ class CustomersParser(CheddarOutputParser):
         return charges
 
     def parse_charge(self, charge_element):
-        charge = {}
-
-        charge['id'] = charge_element.attrib['id']
-        charge['code'] = charge_element.attrib['code']
-        charge['type'] = charge_element.findtext('type')
-        charge['quantity'] = self.parse_decimal(
-            charge_element.findtext('quantity'))
-        charge['each_amount'] = self.parse_decimal(
-            charge_element.findtext('eachAmount'))
-        charge['description'] = charge_element.findtext('description')
-        charge['created_datetime'] = self.parse_datetime(
-            charge_element.findtext('createdDatetime'))
+        charge = Charge(
+            id=charge_element.attrib['id'],
+            code=charge_element.attrib['code'],
+            type=charge_element.findtext('type'),
+            quantity=self.parse_decimal(charge_element.findtext('quantity')),
+            each_amount=self.parse_decimal(
+                charge_element.findtext('eachAmount')),
+            description=charge_element.findtext('description'),
+            created_datetime=self.parse_datetime(
+                charge_element.findtext('createdDatetime')),
+        )
 
         return charge
 
@@ -377,6 +620,120 @@ class CustomersParser(CheddarOutputParser):
         return item
 
 
+def split_customers_xml(xml_str, count):
+    '''
+    Cuts a customers document into at most count documents, each holding a
+    run of consecutive customers and roughly the same number of bytes,
+    without parsing it.  Every piece keeps the original xml declaration and
+    root tag so it parses on its own.
+
+    Cuts are made just after a </customer> end tag.  Customer elements
+    never contain one another and cheddar escapes the text inside them, so
+    every such tag closes a top-level customer.
+    '''
+    root_start = xml_str.find('<customers')
+    root_end = xml_str.rfind('</customers>')
+    if root_start == -1 or root_end == -1 or count < 2:
+        return [xml_str]
+
+    body_start = xml_str.index('>', root_start) + 1
+    prefix = xml_str[:body_start]
+    suffix = xml_str[root_end:]
+    step = max((root_end - body_start) // count, 1)
+
+    boundaries = [body_start]
+    for n in xrange(1, count):
+        target = max(body_start + n * step, boundaries[-1])
+        end = xml_str.find(CUSTOMER_END, target, root_end)
+        if end == -1:
+            break
+        boundaries.append(end + len(CUSTOMER_END))
+    boundaries.append(root_end)
+
+    pieces = [prefix + xml_str[start:end] + suffix
+              for start, end in zip(boundaries, boundaries[1:])
+              if xml_str.find(CUSTOMER_END, start, end) != -1]
+
+    return pieces or [xml_str]
+
+
+def dump_compact(value):
+    '''
+    Pickles parse results into a string which is quick to unpickle with
+    load_compact.
+
+    Unpickling a Decimal normally means running the pure Python Decimal
+    constructor, which would make unpickling customers cost a good share of
+    parsing them.  Decimals are pickled as persistent ids (their strings)
+    instead, so load_compact can build each distinct amount once.  The
+    parser hands out the same datetime object for each repeated timestamp,
+    so the pickle memo stores each one once per chunk.
+    '''
+    # Persistent ids by object id, as the parser hands out the same few
+    # Decimals again and again
+    decimal_ids = {}
+
+    def decimal_id(obj):
+        if type(obj) is not Decimal:
+            return None
+        try:
+            return decimal_ids[id(obj)]
+        except KeyError:
+            content = decimal_ids[id(obj)] = str(obj)
+            return content
+
+    f = StringIO()
+    pickler = pickle.Pickler(f, 2)
+    pickler.persistent_id = decimal_id
+    pickler.dump(value)
+
+    return f.getvalue()
+
+
+def load_compact(data, decimals=None):
+    '''
+    Unpickles a string from dump_compact.
+
+    decimals - A dict of Decimals by string to share between calls
+               (optional)
+    '''
+    if decimals is None:
+        decimals = {}
+
+    def load_decimal(content):
+        try:
+            return decimals[content]
+        except KeyError:
+            value = decimals[content] = Decimal(content)
+            return value
+
+    unpickler = pickle.Unpickler(StringIO(data))
+    unpickler.persistent_load = load_decimal
+
+    return unpickler.load()
+
+
+def parse_customers_chunk(args):
+    '''
+    Parses one piece of a split customers document in a worker process,
+    returning the customers from dump_compact, which the pool passes back as
+    plain bytes.
+
+    Parsing allocates a great many containers, which would otherwise set off
+    repeated, fruitless garbage collections, so the collector is paused
+    while a chunk is parsed.  This only runs in pool worker processes, and
+    the collector is left as it was found.
+    '''
+    parser_class, xml_str = args
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return dump_compact(parser_class().parse_xml(xml_str))
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
 class PromotionsParser(CheddarOutputParser):
     '''
     A utility class for parsing cheddar's xml output for promotions.
@@ -416,14 +773,14 @@ class PromotionsParser(CheddarOutputParser):
         return incentives
 
     def parse_incentive(self, incentive_element):
-        incentive = {}
-
-        incentive['id'] = incentive_element.attrib['id']
-        incentive['type'] = incentive_element.findtext('type')
-        incentive['percentage'] = incentive_element.findtext('percentage')
-        incentive['months'] = incentive_element.findtext('months')
-        incentive['created_datetime'] = self.parse_datetime(
-            incentive_element.findtext('createdDatetime'))
+        incentive = Incentive(
+            id=incentive_element.attrib['id'],
+            type=incentive_element.findtext('type'),
+            percentage=incentive_element.findtext('percentage'),
+            months=incentive_element.findtext('months'),
+            created_datetime=self.parse_datetime(
+                incentive_element.findtext('createdDatetime')),
+        )
 
         return incentive
 
@@ -445,14 +802,14 @@ class PromotionsParser(CheddarOutputParser):
         return coupons
 
     def parse_coupon(self, coupon_element):
-        coupon = {}
-
-        coupon['id'] = coupon_element.attrib['id']
-        coupon['code'] = coupon_element.attrib['code']
-        coupon['max_redemptions'] = coupon_element.findtext('maxRedemptions')
-        coupon['expiration_datetime'] = self.parse_datetime(
-            coupon_element.findtext('expirationDatetime'))
-        coupon['created_datetime'] = self.parse_datetime(
-            coupon_element.findtext('createdDatetime'))
+        coupon = Coupon(
+            id=coupon_element.attrib['id'],
+            code=coupon_element.attrib['code'],
+            max_redemptions=coupon_element.findtext('maxRedemptions'),
+            expiration_datetime=self.parse_datetime(
+                coupon_element.findtext('expirationDatetime')),
+            created_datetime=self.parse_datetime(
+                coupon_element.findtext('createdDatetime')),
+        )
 
         return coupon
@@ -0,0 +1,183 @@
+import logging
+import threading
+from time import time
+from urlparse import urlsplit
+
+import httplib2
+
+client_log = logging.getLogger('SharpyClient')
+
+
+class PoolTimeout(Exception):
+    "No connection became available before the pool's wait timeout expired"
+    pass
+
+
+class HttpPool(object):
+    '''
+    A thread safe pool of keep-alive httplib2.Http objects.
+
+    Each httplib2.Http object holds on to its open connections between
+    requests, so handing the same object back out saves the TCP and TLS
+    handshakes for every request after the first.  An Http object is only
+    ever checked out to one thread at a time.
+    '''
+    default_max_per_host = 10
+    default_idle_timeout = 60
+
+    def __init__(self, cache=None, timeout=None, max_per_host=None,
+                 idle_timeout=None, wait_timeout=None):
+        '''
+        cache - Passed to each httplib2.Http object (optional)
+        timeout - Socket level timeout in seconds (optional)
+        max_per_host - Maximum number of connections to open to a single
+                       host. Requests past this limit wait for a free
+                       connection. (optional)
+        idle_timeout - Seconds a connection may sit unused before it is
+                       closed and evicted from the pool (optional)
+        wait_timeout - Seconds to wait for a free connection before raising
+                       PoolTimeout. Waits forever by default. (optional)
+        '''
+        self.cache = cache
+        self.timeout = timeout
+        if max_per_host is None:
+            max_per_host = self.default_max_per_host
+        self.max_per_host = max_per_host
+        if idle_timeout is None:
+            idle_timeout = self.default_idle_timeout
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._idle = {}
+        self._in_use = {}
+        self.stats = {
+            'hits': 0,
+            'opens': 0,
+            'evictions': 0,
+            'discards': 0,
+            'waits': 0,
+        }
+
+        super(HttpPool, self).__init__()
+
+    def get_host_key(self, url):
+        parts = urlsplit(url)
+        return '%s://%s' % (parts.scheme, parts.netloc)
+
+    def create_http(self):
+        return httplib2.Http(cache=self.cache, timeout=self.timeout)
+
+    def acquire(self, url):
+        '''
+        Checks out an httplib2.Http object for the host in url, reusing an
+        idle one when possible.  Must be paired with a call to release.
+        '''
+        host = self.get_host_key(url)
+        deadline = None
+        if self.wait_timeout is not None:
+            deadline = time() + self.wait_timeout
+
+        with self._available:
+            self._evict_idle(time())
+            while True:
+                idle = self._idle.setdefault(host, [])
+                if idle:
+                    http, last_used = idle.pop()
+                    self._in_use[host] = self._in_use.get(host, 0) + 1
+                    self.stats['hits'] += 1
+                    return http
+
+                if self._in_use.get(host, 0) < self.max_per_host:
+                    self._in_use[host] = self._in_use.get(host, 0) + 1
+                    self.stats['opens'] += 1
+                    break
+
+                self.stats['waits'] += 1
+                if deadline is None:
+                    self._available.wait()
+                else:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        raise PoolTimeout(
+                            'Timed out waiting for a connection to %s' % host)
+                    self._available.wait(remaining)
+
+        client_log.debug('Opening pooled connection to %s' % host)
+        try:
+            return self.create_http()
+        except Exception:
+            # Give back the slot taken for the connection
+            with self._available:
+                self._in_use[host] -= 1
+                self._available.notify()
+            raise
+
+    def release(self, url, http, discard=False):
+        '''
+        Returns a checked out httplib2.Http object to the pool.  Pass
+        discard=True when the connection is in an unknown state (e.g. after
+        a socket error) and it will be closed rather than reused.
+        '''
+        host = self.get_host_key(url)
+
+        with self._available:
+            self._in_use[host] -= 1
+            if discard:
+                self.stats['discards'] += 1
+            else:
+                self._idle.setdefault(host, []).append((http, time()))
+            self._available.notify()
+
+        if discard:
+            self._close_http(http)
+
+    def clear(self):
+        '''
+        Closes every idle connection in the pool.
+        '''
+        with self._available:
+            to_close = []
+            for idle in self._idle.values():
+                to_close.extend(http for http, last_used in idle)
+            self._idle = {}
+
+        for http in to_close:
+            self._close_http(http)
+
+    def get_stats(self):
+        '''
+        Returns a snapshot of the pool's counters along with the current
+        number of idle and checked out connections.
+        '''
+        with self._available:
+            stats = dict(self.stats)
+            stats['idle'] = sum(len(idle) for idle in self._idle.values())
+            stats['in_use'] = sum(self._in_use.values())
+
+        return stats
+
+    def _evict_idle(self, now):
+        # Called with the lock held
+        if not self.idle_timeout:
+            return
+
+        cutoff = now - self.idle_timeout
+        for host, idle in self._idle.items():
+            fresh = []
+            for http, last_used in idle:
+                if last_used < cutoff:
+                    self.stats['evictions'] += 1
+                    self._close_http(http)
+                else:
+                    fresh.append((http, last_used))
+            self._idle[host] = fresh
+
+    def _close_http(self, http):
+        for connection in http.connections.values():
+            try:
+                connection.close()
+            except Exception:
+                pass
+        http.connections.clear()
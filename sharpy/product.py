@@ -1,20 +1,73 @@
-from copy import copy
+from collections import deque, OrderedDict
+from copy import copy, deepcopy
 from datetime import datetime
 from decimal import Decimal
+from itertools import islice
+import logging
+from multiprocessing.pool import ThreadPool
+import threading
 from time import time
+import weakref
 
 from dateutil.relativedelta import relativedelta
 
+from sharpy.breaker import CircuitOpen
 from sharpy.client import Client
+from sharpy.collection import CustomerCollection
+from sharpy.exceptions import CheddarError
 from sharpy.exceptions import NotFound
+from sharpy.journal import encode_data
+from sharpy.journal import EntryClaimed
 from sharpy.parsers import PlansParser, CustomersParser, PromotionsParser
+from sharpy.parsers import LazyElementList
+from sharpy.pool import PoolTimeout
+from sharpy.ratelimit import RateLimited
+from sharpy.singleflight import SingleFlight
+
+client_log = logging.getLogger('SharpyClient')
+
+# How a customer is brought up to date from the response to a mutation
+REFRESH_EAGER = 'eager'
+REFRESH_LAZY = 'lazy'
+REFRESH_NONE = 'none'
+REFRESH_POLICIES = (REFRESH_EAGER, REFRESH_LAZY, REFRESH_NONE)
 
 
 class CheddarProduct(object):
+    # Seconds a cached customer stays fresh. None uses the result_cache's
+    # default ttl.
+    customer_cache_ttl = None
+    default_refresh = REFRESH_EAGER
 
     def __init__(self, username, password, product_code, cache=None,
-                 timeout=None, endpoint=None):
+                 timeout=None, endpoint=None, pool=None, result_cache=None,
+                 retry_policy=None, circuit_breaker=None, rate_limiter=None,
+                 journal=None, refresh=None):
+        '''
+        result_cache - A sharpy.cache backend (LRUCache, FileCache, ...) used
+                       to cache parsed plans, promotions and customers.
+                       Nothing is cached by default. (optional)
+        retry_policy - A sharpy.retry.RetryPolicy for the client (optional)
+        circuit_breaker - A sharpy.breaker.CircuitBreaker for the client
+                          (optional)
+        rate_limiter - A sharpy.ratelimit.TokenBucket for the client
+                       (optional)
+        journal - A sharpy.journal backend (FileJournal or SQLiteJournal)
+                  which records every customer mutation before it is sent.
+                  Call replay_journal at startup to send mutations a
+                  previous process didn't finish. (optional)
+        refresh - How customers are updated from the response to a
+                  mutation (charge, Item.increment, ...) when the call
+                  doesn't say.  One of REFRESH_EAGER (decode the whole
+                  customer, the default), REFRESH_LAZY (decode the
+                  customer's own fields and plan and items, leaving
+                  invoices until they are read) or REFRESH_NONE (don't
+                  update the customer at all). (optional)
+        '''
         self.product_code = product_code
+        self.refresh = refresh or self.default_refresh
+        if self.refresh not in REFRESH_POLICIES:
+            raise ValueError('Unknown refresh policy %r' % self.refresh)
         self.client = Client(
             username,
             password,
@@ -22,22 +75,273 @@ class CheddarProduct(object):
             cache,
             timeout,
             endpoint,
+            pool,
+            retry_policy,
+            circuit_breaker,
+            rate_limiter,
         )
+        self.result_cache = result_cache
+        self.journal = journal
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
+        self.single_flight = SingleFlight()
+        self._collections = weakref.WeakSet()
+        self._collections_lock = threading.Lock()
 
         super(CheddarProduct, self).__init__()
 
     def __repr__(self):
         return u'CheddarProduct: %s' % self.product_code
 
-    def get_all_plans(self):
+    def get_cache_key(self, name):
+        '''
+        Returns the result_cache key for name.  Keys include the product's
+        cache generation, so clear_cache drops this product's entries
+        without touching other products sharing the cache.
+        '''
+        if self.result_cache is None:
+            return '%s:%s' % (self.product_code, name)
+
+        generation = self.result_cache.get_generation(self.product_code)
+        return '%s:%s:%s' % (self.product_code, generation, name)
+
+    def clear_cache(self):
+        '''
+        Drops every cached plan, promotion and customer of this product.
+        '''
+        self.single_flight.forget_all()
+        if self.result_cache is not None:
+            self.result_cache.clear_namespace(self.product_code)
+
+    def get_cached(self, name, loader, ttl=None):
+        '''
+        Returns a copy of the value cached under name, calling loader to
+        fill the cache when it is missing.  A stale value is returned as is
+        while loader refreshes it in the background.  Without a
+        result_cache, loader is simply called.
+
+        Concurrent calls which all need to run loader for the same name
+        share a single call, and each gets its own copy of the result.  A
+        result is not cached if name was invalidated while it was loading,
+        as it may be out of date.
+        '''
+        key = self.get_cache_key(name)
+        if self.result_cache is None:
+            return self.single_flight.do(key, loader, deepcopy)
+
+        value, state = self.result_cache.lookup(key)
+        if state == self.result_cache.MISSING:
+            def load():
+                version = self.result_cache.get_version(key)
+                value = loader()
+                self.result_cache.set_if_version(key, value, version, ttl)
+                return value
+
+            # Values are copied below unless the backend serializes
+            copy_shared = None
+            if self.result_cache.serializes:
+                copy_shared = deepcopy
+            value = self.single_flight.do(key, load, copy_shared)
+        elif state == self.result_cache.STALE:
+            self._refresh_cached(key, loader, ttl)
+
+        if self.result_cache.serializes:
+            return value
+        return deepcopy(value)
+
+    def _refresh_cached(self, key, loader, ttl=None):
+        with self._refresh_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                version = self.result_cache.get_version(key)
+                self.result_cache.set_if_version(key, loader(), version,
+                                                 ttl)
+            except Exception:
+                client_log.exception('Failed to refresh cached %s' % key)
+            finally:
+                with self._refresh_lock:
+                    self._refreshing.discard(key)
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    def invalidate_plans(self):
+        if self.result_cache is not None:
+            self.result_cache.invalidate(self.get_cache_key('plans'))
+
+    def invalidate_promotions(self):
+        if self.result_cache is not None:
+            self.result_cache.invalidate(self.get_cache_key('promotions'))
+
+    def invalidate_customer(self, code):
+        key = self.get_cache_key('customer:%s' % code)
+        self.single_flight.forget(key)
+        if self.result_cache is not None:
+            self.result_cache.invalidate(key)
+
+    def make_customer_request(self, code, path, params=None, data=None,
+                              method=None):
+        '''
+        Makes a request which changes the customer with the given code,
+        invalidating any cached copy of that customer whether or not the
+        request succeeds.  With a journal, the request is recorded before
+        it is sent.  Such requests are never retried or coalesced, even the
+        ones (like customers/cancel) which are sent as a GET.
+        '''
+        entry = None
+        if self.journal is not None:
+            entry = self.journal.record(code, path, params, data, method)
+
+        return self.send_customer_request(code, path, params, data, method,
+                                          entry)
+
+    def send_customer_request(self, code, path, params=None, data=None,
+                              method=None, entry=None):
+        '''
+        Sends a customer request, recording its progress against the given
+        journal entry.  The entry is claimed before the request is sent,
+        and EntryClaimed is raised if another sender claimed it first.  The
+        entry is marked done on success and failed if cheddar rejects the
+        request.  If the request was refused before it went out (by the
+        circuit breaker, rate limiter or connection pool) the entry is
+        released to be sent again.  If the outcome is unknown (a connection
+        error or 5xx response) it is left marked as sent.
+        '''
+        if entry is not None:
+            if not self.journal.claim(entry.id, entry.state, entry.claims):
+                raise EntryClaimed(
+                    'Journal entry %s is already being sent' % entry.id)
+            entry.claims += 1
+
+        try:
+            try:
+                response = self.client.make_request(
+                    path=path, params=params, data=data, method=method,
+                    idempotent=False, mutation=True)
+            except (CircuitOpen, RateLimited, PoolTimeout), e:
+                # Unless an earlier attempt went out, cheddar never saw it
+                if entry is not None and getattr(e, 'attempts', 1) == 1:
+                    self.journal.release(entry.id, entry.state)
+                raise
+            except CheddarError, e:
+                if entry is not None and e.response.status < 500:
+                    self.journal.mark_failed(entry.id, e)
+                raise
+            if entry is not None:
+                self.journal.mark_done(entry.id)
+
+            return response
+        finally:
+            self.invalidate_customer(code)
+
+    def queue_customer_request(self, code, path, params=None, data=None,
+                               method=None):
+        '''
+        Records a customer request in the journal without sending it, and
+        returns its JournalEntry.  Queued requests are sent, in order, by
+        the next replay_journal.
+        '''
+        if self.journal is None:
+            raise ValueError('Queueing requests needs a journal')
+
+        return self.journal.record(code, path, params, data, method)
+
+    def replay_journal(self, include_sent=False, workers=1):
+        '''
+        Sends every journaled request which hasn't been sent yet, oldest
+        first.  Returns a (sent, errors) tuple: a list of the entries sent
+        successfully and a dict of exceptions keyed by entry id.
+
+        include_sent
+            Also resend requests which were sent but whose outcome was
+            never recorded, e.g. because the process died waiting for the
+            response.  Cheddar may already have applied them, so this can
+            apply a mutation twice.
+        workers
+            Number of customers to replay at once.  Each customer's
+            requests are always sent one at a time, in order, and stop at
+            the first one whose outcome is unknown.
+
+        Each entry is claimed before it is sent, so with a journal shared
+        between processes (SQLiteJournal) replays running at once never
+        send the same entry twice.  A customer whose entry was claimed
+        elsewhere is left to the process which claimed it.
+        '''
+        if self.journal is None:
+            return [], {}
+
+        by_customer = OrderedDict()
+        for entry in self.journal.get_pending(include_sent):
+            by_customer.setdefault(entry.customer_code, []).append(entry)
+
+        def replay(entries):
+            sent = []
+            errors = {}
+            for entry in entries:
+                try:
+                    self.send_customer_request(
+                        entry.customer_code, entry.path, entry.params,
+                        encode_data(entry.data), entry.method, entry)
+                except EntryClaimed:
+                    # Another process is replaying this customer
+                    break
+                except CheddarError, e:
+                    errors[entry.id] = e
+                    if e.response.status >= 500:
+                        break
+                except Exception, e:
+                    errors[entry.id] = e
+                    break
+                else:
+                    sent.append(entry)
+            return sent, errors
+
+        if workers > 1 and len(by_customer) > 1:
+            pool = ThreadPool(min(workers, len(by_customer)))
+            try:
+                results = pool.map(replay, by_customer.values())
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [replay(entries) for entries in by_customer.values()]
+
+        sent = []
+        errors = {}
+        for customer_sent, customer_errors in results:
+            sent.extend(customer_sent)
+            errors.update(customer_errors)
+        if sent or errors:
+            client_log.info('Replayed %d journaled requests, %d failed' % (
+                len(sent), len(errors)))
+
+        return sent, errors
+
+    def _load_plans(self):
         response = self.client.make_request(path='plans/get')
         plans_parser = PlansParser()
         plans_data = plans_parser.parse_xml(response.content)
+
+        return OrderedDict(
+            (plan_data['code'], plan_data) for plan_data in plans_data)
+
+    def get_all_plans(self):
+        plans_data = self.get_cached('plans', self._load_plans).values()
         plans = [PricingPlan(**plan_data) for plan_data in plans_data]
 
         return plans
 
     def get_plan(self, code):
+        if self.result_cache is not None:
+            plans_data = self.get_cached('plans', self._load_plans)
+            if code in plans_data:
+                return PricingPlan(**plans_data[code])
+
         response = self.client.make_request(
             path='plans/get',
             params={'code': code},
@@ -232,7 +536,91 @@ class CheddarProduct(object):
 
         return data
 
-    def get_customers(self, filter_data=None):
+    def build_customer_filter_data(self, subscription_status=None,
+                                   plan_codes=None, created_after=None,
+                                   created_before=None, canceled_after=None,
+                                   canceled_before=None,
+                                   transacted_after=None,
+                                   transacted_before=None, order_by=None,
+                                   order_by_direction=None, search=None):
+        '''
+        Builds the post data for filtering a customers/get call.
+        https://cheddargetter.com/developers#all-customers
+
+        subscription_status
+            'activeOnly' or 'canceledOnly'
+        plan_codes
+            A list of plan codes. Only customers on one of these plans are
+            returned.
+        created_after, created_before, canceled_after, canceled_before,
+        transacted_after, transacted_before
+            Dates (or datetimes) bounding the customers returned.  Cheddar
+            treats both ends as inclusive.
+        order_by
+            One of 'name', 'company', 'plan', 'billingDatetime' or
+            'createdDatetime'
+        order_by_direction
+            'asc' or 'desc'
+        search
+            Text to match against customer name, company, email address and
+            last four digits of the credit card number
+        '''
+        data = []
+
+        if subscription_status:
+            data.append(('subscriptionStatus', subscription_status))
+
+        if plan_codes:
+            for plan_code in plan_codes:
+                data.append(('planCode[]', plan_code))
+
+        if created_after:
+            data.append(('createdAfterDate',
+                         self.client.format_date(created_after)))
+
+        if created_before:
+            data.append(('createdBeforeDate',
+                         self.client.format_date(created_before)))
+
+        if canceled_after:
+            data.append(('canceledAfterDate',
+                         self.client.format_date(canceled_after)))
+
+        if canceled_before:
+            data.append(('canceledBeforeDate',
+                         self.client.format_date(canceled_before)))
+
+        if transacted_after:
+            data.append(('transactedAfterDate',
+                         self.client.format_date(transacted_after)))
+
+        if transacted_before:
+            data.append(('transactedBeforeDate',
+                         self.client.format_date(transacted_before)))
+
+        if order_by:
+            data.append(('orderBy', order_by))
+
+        if order_by_direction:
+            data.append(('orderByDirection', order_by_direction))
+
+        if search:
+            data.append(('search', search))
+
+        return data
+
+    def _merge_filter_data(self, filter_data, filters):
+        data = []
+        if filter_data:
+            if hasattr(filter_data, 'items'):
+                filter_data = filter_data.items()
+            data.extend(filter_data)
+        data.extend(self.build_customer_filter_data(**filters))
+
+        return data
+
+    def get_customers(self, filter_data=None, lazy=False, indexed=False,
+                      **filters):
         '''
         Returns all customers. Sometimes they are too much and cause internal
         server errors on CG. API call permits post parameters for filtering
@@ -245,25 +633,193 @@ class CheddarProduct(object):
                 ("subscriptionStatus": "activeOnly"),
                 ("planCode[]": "100GB"), ("planCode[]": "200GB")
             ]
+
+        Any of the keyword arguments accepted by build_customer_filter_data
+        can be passed as well, e.g. subscription_status='activeOnly' or
+        plan_codes=['100GB', '200GB'].  For very large accounts see
+        scan_customers.
+
+        lazy
+            If True, each customer's subscription, plan, items and invoices
+            are only decoded when first accessed (see
+            Customer.load_element).  Much faster when only a few fields of
+            each customer are needed.
+        indexed
+            If True, returns a CustomerCollection which can look customers
+            up by email, plan, status, date and so on without scanning
+            them all.
         '''
         customers = []
+        filter_data = self._merge_filter_data(filter_data, filters)
 
         try:
             response = self.client.make_request(path='customers/get',
-                                                data=filter_data)
+                                                data=filter_data,
+                                                idempotent=True)
         except NotFound:
             response = None
 
         if response:
             customer_parser = CustomersParser()
-            customers_data = customer_parser.parse_xml(response.content)
-            for customer_data in customers_data:
-                customers.append(Customer(product=self, **customer_data))
+            if lazy:
+                customer_elements = customer_parser.parse_elements(
+                    response.content)
+                for customer_element in customer_elements:
+                    customers.append(Customer.from_element(
+                        customer_element, self, customer_parser))
+            else:
+                customers_data = customer_parser.parse_xml(response.content)
+                for customer_data in customers_data:
+                    customers.append(Customer(product=self, **customer_data))
 
+        if indexed:
+            return CustomerCollection(customers, self)
         return customers
 
-    def get_customer(self, code):
+    def register_collection(self, collection):
+        '''
+        Has collection.reindex called whenever a customer is reloaded after
+        a mutation, for as long as the collection is in use.
+        '''
+        with self._collections_lock:
+            self._collections.add(collection)
+
+    def reindex_customer(self, customer):
+        with self._collections_lock:
+            collections = list(self._collections)
+        for collection in collections:
+            collection.reindex(customer)
+
+    def iter_customers(self, filter_data=None, lazy=False, **filters):
+        '''
+        Like get_customers, but streams the response body through an
+        incremental parser and yields customers one at a time instead of
+        building the whole list in memory.  Use this for accounts with
+        very large numbers of customers.
+
+        Accepts the same arguments as get_customers.
+        '''
+        customer_parser = CustomersParser()
+        customer_elements = self.iter_customer_elements(
+            filter_data, customer_parser, **filters)
+        for customer_element in customer_elements:
+            if lazy:
+                yield Customer.from_element(customer_element, self,
+                                            customer_parser)
+            else:
+                yield Customer(
+                    product=self,
+                    **customer_parser.parse_customer(customer_element))
+
+    def iter_customer_elements(self, filter_data=None, parser=None,
+                               **filters):
+        '''
+        Streams the customers matching the filters (see get_customers) and
+        yields each one's xml element without decoding it.  An element is
+        only valid until the next one is requested.
+        '''
+        filter_data = self._merge_filter_data(filter_data, filters)
 
+        try:
+            response = self.client.open_request(path='customers/get',
+                                                data=filter_data,
+                                                idempotent=True)
+        except NotFound:
+            return
+
+        parser = parser or CustomersParser()
+        try:
+            for customer_element in parser.iter_elements(response):
+                yield customer_element
+        finally:
+            response.close()
+
+    def get_customer_windows(self, start, end=None, window=None):
+        '''
+        Splits the dates from start to end (today by default) into
+        consecutive, non-overlapping (first_day, last_day) pairs, each
+        spanning at most window (a relativedelta, one month by default).
+        '''
+        if isinstance(start, datetime):
+            start = start.date()
+        if end is None:
+            end = datetime.utcnow().date()
+        elif isinstance(end, datetime):
+            end = end.date()
+        window = window or relativedelta(months=1)
+
+        windows = []
+        window_start = start
+        while window_start <= end:
+            next_start = window_start + window
+            if next_start <= window_start:
+                raise ValueError('window must be a positive period of time')
+            window_end = min(next_start - relativedelta(days=1), end)
+            windows.append((window_start, window_end))
+            window_start = next_start
+
+        return windows
+
+    def scan_customers(self, start, end=None, window=None, workers=1,
+                       **filters):
+        '''
+        Lazily yields every customer created between start and end (today
+        by default), fetching them one creation date window at a time so no
+        single customers/get call has to return the whole account.
+
+        start
+            The earliest creation date to include, e.g. the date the product
+            was set up in cheddar
+        end
+            The latest creation date to include (optional)
+        window
+            A relativedelta giving the span of creation dates fetched per
+            request.  Defaults to one month. (optional)
+        workers
+            The number of windows to fetch at once.  With a single worker
+            each window is streamed with iter_customers; with more, up to
+            workers windows are fetched concurrently and at most that many
+            are held in memory at a time.  Customers are always yielded in
+            window order. (optional)
+
+        Any other keyword arguments accepted by build_customer_filter_data,
+        except the created_* ones, are applied to every window.
+        '''
+        windows = self.get_customer_windows(start, end, window)
+
+        if workers <= 1:
+            for window_start, window_end in windows:
+                for customer in self.iter_customers(
+                        created_after=window_start,
+                        created_before=window_end, **filters):
+                    yield customer
+            return
+
+        def fetch(window_dates):
+            return self.get_customers(created_after=window_dates[0],
+                                      created_before=window_dates[1],
+                                      **filters)
+
+        thread_pool = ThreadPool(workers)
+        try:
+            windows = iter(windows)
+            pending = deque()
+            for window_dates in islice(windows, workers):
+                pending.append(thread_pool.apply_async(fetch,
+                                                       (window_dates,)))
+
+            while pending:
+                customers = pending.popleft().get()
+                window_dates = next(windows, None)
+                if window_dates is not None:
+                    pending.append(thread_pool.apply_async(fetch,
+                                                           (window_dates,)))
+                for customer in customers:
+                    yield customer
+        finally:
+            thread_pool.terminate()
+
+    def _load_customer(self, code):
         response = self.client.make_request(
             path='customers/get',
             params={'code': code},
@@ -271,7 +827,60 @@ class CheddarProduct(object):
         customer_parser = CustomersParser()
         customers_data = customer_parser.parse_xml(response.content)
 
-        return Customer(product=self, **customers_data[0])
+        return customers_data[0]
+
+    def get_customer(self, code):
+        customer_data = self.get_cached(
+            'customer:%s' % code,
+            lambda: self._load_customer(code),
+            self.customer_cache_ttl,
+        )
+
+        return Customer(product=self, **customer_data)
+
+    def get_customers_by_codes(self, codes, workers=10):
+        '''
+        Fetches the customers with the given codes, running up to workers
+        get_customer calls at once.
+
+        Returns a (customers, errors) tuple of dicts keyed by customer code.
+        Codes with no matching customer end up in errors with their NotFound
+        exception rather than stopping the rest of the lookups.  Any other
+        CheddarError is raised.
+
+        Each worker holds a connection from the client's pool, so workers
+        beyond the pool's max_per_host simply wait their turn.
+        '''
+        customers = {}
+        errors = {}
+        unique_codes = []
+        seen = set()
+        for code in codes:
+            if code not in seen:
+                seen.add(code)
+                unique_codes.append(code)
+
+        if not unique_codes:
+            return customers, errors
+
+        def fetch(code):
+            try:
+                return code, self.get_customer(code), None
+            except NotFound, e:
+                return code, None, e
+
+        thread_pool = ThreadPool(min(workers, len(unique_codes)))
+        try:
+            for code, customer, error in thread_pool.imap_unordered(
+                    fetch, unique_codes):
+                if error is None:
+                    customers[code] = customer
+                else:
+                    errors[code] = error
+        finally:
+            thread_pool.terminate()
+
+        return customers, errors
 
     def delete_all_customers(self):
         '''
@@ -281,17 +890,16 @@ class CheddarProduct(object):
 
         DO NOT RUN THIS UNLESS YOU REALLY, REALLY, REALLY MEAN TO!
         '''
-        self.client.make_request(
-            path='customers/delete-all/confirm/%d' % int(time()),
-            method='POST'
-        )
+        try:
+            self.client.make_request(
+                path='customers/delete-all/confirm/%d' % int(time()),
+                method='POST'
+            )
+        finally:
+            self.clear_cache()
 
-    def get_all_promotions(self):
-        '''
-        Returns all promotions.
-        https://cheddargetter.com/developers#promotions
-        '''
-        promotions = []
+    def _load_promotions(self):
+        promotions_data = []
 
         try:
             response = self.client.make_request(path='promotions/get')
@@ -301,7 +909,17 @@ class CheddarProduct(object):
         if response:
             promotions_parser = PromotionsParser()
             promotions_data = promotions_parser.parse_xml(response.content)
-            promotions = [Promotion(**promotion_data) for promotion_data in promotions_data]
+
+        return promotions_data
+
+    def get_all_promotions(self):
+        '''
+        Returns all promotions.
+        https://cheddargetter.com/developers#promotions
+        '''
+        promotions_data = self.get_cached('promotions',
+                                          self._load_promotions)
+        promotions = [Promotion(**promotion_data) for promotion_data in promotions_data]
 
         return promotions
 
@@ -310,6 +928,13 @@ class CheddarProduct(object):
         Get the promotion with the specified coupon code.
         https://cheddargetter.com/developers#single-promotion
         '''
+        if self.result_cache is not None:
+            promotions_data = self.get_cached('promotions',
+                                              self._load_promotions)
+            for promotion_data in promotions_data:
+                for coupon in promotion_data['coupons']:
+                    if coupon['code'] == code:
+                        return Promotion(**promotion_data)
 
         response = self.client.make_request(
             path='promotions/get',
@@ -321,7 +946,174 @@ class CheddarProduct(object):
         return Promotion(**promotion_data[0])
 
 
-class PricingPlan(object):
+class SlotPickling(object):
+    '''
+    Mixin for models with __slots__, which pickle only handles by itself
+    from protocol 2.  The state is a dict of every slot which is set.
+    '''
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                try:
+                    state[name] = object.__getattribute__(self, name)
+                except AttributeError:
+                    pass
+
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            object.__setattr__(self, name, value)
+
+
+class LazyAttributes(SlotPickling):
+    '''
+    Mixin for models which can put off decoding groups of attributes until
+    one of them is first accessed.
+    '''
+    __slots__ = ('_lazy_loaders',)
+
+    def is_loaded(self, name):
+        '''
+        Returns True if the named attribute is set, without running any
+        pending loader for it.
+        '''
+        try:
+            object.__getattribute__(self, name)
+        except AttributeError:
+            return False
+
+        return True
+
+    def set_lazy(self, names, loader):
+        '''
+        Removes the named attributes and arranges for loader to be called,
+        once, to set them all again when any of them is next accessed.
+        '''
+        if not self.is_loaded('_lazy_loaders'):
+            self._lazy_loaders = {}
+        for name in names:
+            if self.is_loaded(name):
+                delattr(self, name)
+            self._lazy_loaders[name] = loader
+
+    def clear_lazy(self):
+        if self.is_loaded('_lazy_loaders'):
+            del self._lazy_loaders
+
+    def __getattr__(self, name):
+        # Only called for attributes which haven't been set
+        try:
+            lazy_loaders = object.__getattribute__(self, '_lazy_loaders')
+        except AttributeError:
+            lazy_loaders = None
+        if not lazy_loaders or name not in lazy_loaders:
+            raise AttributeError("'%s' object has no attribute '%s'" % (
+                type(self).__name__, name))
+
+        loader = lazy_loaders[name]
+        for key in [key for key, value in lazy_loaders.items()
+                    if value is loader]:
+            lazy_loaders.pop(key, None)
+        loader()
+
+        return object.__getattribute__(self, name)
+
+    def __getstate__(self):
+        # Loaders can't be pickled, so run any which are pending first
+        if self.is_loaded('_lazy_loaders'):
+            for name in list(self._lazy_loaders):
+                getattr(self, name)
+            self.clear_lazy()
+
+        return super(LazyAttributes, self).__getstate__()
+
+
+class ChangeTracking(SlotPickling):
+    '''
+    Mixin for models which remember which of their editable fields have
+    been assigned since they were last loaded, so save can send just
+    those.  Subclasses list the fields in editable_fields and must have a
+    _changed slot.
+
+    Fields loaded from cheddar are set with load_fields, which leaves
+    unchanged values (and the objects holding them) alone and doesn't mark
+    anything changed.  A field with an unsaved change keeps its new value
+    through reloads until it is saved or clear_changes is called.
+    '''
+    __slots__ = ()
+    editable_fields = frozenset()
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in self.editable_fields:
+            self._get_changed().add(name)
+
+    def _get_changed(self):
+        try:
+            return object.__getattribute__(self, '_changed')
+        except AttributeError:
+            changed = set()
+            object.__setattr__(self, '_changed', changed)
+            return changed
+
+    def load_fields(self, **fields):
+        '''
+        Sets fields to values loaded from cheddar, skipping those whose
+        value is unchanged or which have unsaved changes.
+        '''
+        changed = self._get_changed()
+        for name, value in fields.iteritems():
+            if name in changed:
+                continue
+            try:
+                current = object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+            else:
+                try:
+                    if current is value or (type(current) is type(value) and
+                                            current == value):
+                        continue
+                except TypeError:
+                    # e.g. naive and aware datetimes
+                    pass
+            object.__setattr__(self, name, value)
+
+    def has_changes(self):
+        return bool(self._get_changed())
+
+    def get_changes(self):
+        '''
+        Returns a dict of the editable fields assigned since the object was
+        loaded or saved, with their new values.
+        '''
+        return dict((name, getattr(self, name))
+                    for name in self._get_changed())
+
+    def clear_changes(self, names=None):
+        '''
+        Forgets unsaved changes to the named fields, or to every field,
+        without undoing them.  The next reload overwrites them.
+        '''
+        changed = self._get_changed()
+        if names is None:
+            changed.clear()
+        else:
+            changed.difference_update(names)
+
+
+class PricingPlan(SlotPickling):
+    __slots__ = ('name', 'code', 'id', 'description', 'is_active', 'is_free',
+                 'trial_days', 'initial_bill_count', 'initial_bill_count_unit',
+                 'billing_frequency', 'billing_frequency_per',
+                 'billing_frequency_quantity', 'billing_frequency_unit',
+                 'setup_charge_code', 'setup_charge_amount',
+                 'recurring_charge_code', 'recurring_charge_amount',
+                 'created', 'items', 'subscription')
 
     def __init__(self, name, code, id, description, is_active, is_free,
                  trial_days, initial_bill_count, initial_bill_count_unit,
@@ -401,7 +1193,21 @@ class PricingPlan(object):
         return initial_bill_date
 
 
-class Customer(object):
+class Customer(LazyAttributes, ChangeTracking):
+    __slots__ = ('code', 'id', 'first_name', 'last_name', 'email', 'product',
+                 'company', 'notes', 'gateway_token', 'is_vat_exempt',
+                 'vat_number', 'first_contact_datetime', 'referer',
+                 'referer_host', 'campaign_source', 'campaign_medium',
+                 'campaign_term', 'campaign_content', 'campaign_name',
+                 'created', 'modified', 'coupon_code', 'meta_data',
+                 'subscription', '_changed')
+    # Fields save sends when assigned.  Reassign meta_data rather than
+    # changing the dict in place.
+    editable_fields = frozenset([
+        'first_name', 'last_name', 'email', 'company', 'is_vat_exempt',
+        'vat_number', 'notes', 'first_contact_datetime', 'referer',
+        'campaign_term', 'campaign_name', 'campaign_source',
+        'campaign_medium', 'campaign_content', 'meta_data'])
 
     def __init__(self, code, first_name, last_name, email, product, id=None,
                  company=None, notes=None, gateway_token=None,
@@ -443,44 +1249,88 @@ class Customer(object):
                   campaign_content=None, campaign_name=None,
                   created_datetime=None, modified_datetime=None,
                   coupon_code=None, meta_data=None, subscriptions=None):
-        self.code = code
-        self.id = id
-        self.first_name = first_name
-        self.last_name = last_name
-        self.email = email
-        self.product = product
-        self.company = company
-        self.notes = notes
-        self.gateway_token = gateway_token
-        self.is_vat_exempt = is_vat_exempt
-        self.vat_number = vat_number
-        self.first_contact_datetime = first_contact_datetime
-        self.referer = referer
-        self.referer_host = referer_host
-        self.campaign_source = campaign_source
-        self.campaign_medium = campaign_medium
-        self.campaign_content = campaign_content
-        self.campaign_name = campaign_name
-        self.created = created_datetime
-        self.modified = modified_datetime
-        self.coupon_code = coupon_code
-
-        self.meta_data = {}
+        self.clear_lazy()
+        meta_data_map = {}
         if meta_data:
             for datum in meta_data:
-                self.meta_data[datum['name']] = datum['value']
-        subscription_data = subscriptions[0]
-        subscription_data['customer'] = self
-        if hasattr(self, 'subscription'):
-            self.subscription.load_data(**subscription_data)
+                meta_data_map[datum['name']] = datum['value']
+
+        self.load_fields(
+            code=code, id=id, first_name=first_name, last_name=last_name,
+            email=email, product=product, company=company, notes=notes,
+            gateway_token=gateway_token, is_vat_exempt=is_vat_exempt,
+            vat_number=vat_number,
+            first_contact_datetime=first_contact_datetime, referer=referer,
+            referer_host=referer_host, campaign_source=campaign_source,
+            campaign_medium=campaign_medium, campaign_term=campaign_term,
+            campaign_content=campaign_content, campaign_name=campaign_name,
+            created=created_datetime, modified=modified_datetime,
+            coupon_code=coupon_code, meta_data=meta_data_map)
+
+        if subscriptions is not None:
+            subscription_data = subscriptions[0]
+            subscription_data['customer'] = self
+            if self.is_loaded('subscription'):
+                self.subscription.load_data(**subscription_data)
+            else:
+                self.subscription = Subscription(**subscription_data)
+
+    @classmethod
+    def from_element(cls, customer_element, product, parser=None):
+        '''
+        Builds a customer from a parsed customer xml element, decoding its
+        subscription, plan, items and invoices only when they are first
+        used.  See load_element.
+        '''
+        customer = cls.__new__(cls)
+        customer.load_element(customer_element, product, parser)
+
+        return customer
+
+    def load_element(self, customer_element, product, parser=None):
+        '''
+        Loads the customer from a parsed customer xml element.  The
+        customer's own fields and meta data are decoded straight away, but
+        the subscription (with its plan, items and invoices) is decoded the
+        first time it is accessed.  Until then the customer holds on to the
+        element, which keeps the element's whole document in memory.
+        '''
+        parser = parser or CustomersParser()
+        customer_data = parser.parse_customer_info(customer_element)
+        customer_data['meta_data'] = parser.parse_meta_data(
+            customer_element.find('metaData'))
+        self.load_data(product=product, **customer_data)
+
+        subscription_element = customer_element.find('subscriptions')[0]
+        if self.is_loaded('subscription'):
+            self.subscription.load_element(subscription_element, self, parser)
         else:
-            self.subscription = Subscription(**subscription_data)
+            def load_subscription():
+                self.subscription = Subscription.from_element(
+                    subscription_element, self, parser)
+
+            self.set_lazy(('subscription',), load_subscription)
+
+    def load_data_from_xml(self, xml, refresh=None):
+        '''
+        Updates the customer from the xml returned by a mutation, as the
+        refresh policy (see CheddarProduct) or the product's default says.
+        '''
+        refresh = refresh or self.product.refresh
+        if refresh not in REFRESH_POLICIES:
+            raise ValueError('Unknown refresh policy %r' % refresh)
 
-    def load_data_from_xml(self, xml):
         customer_parser = CustomersParser()
-        customers_data = customer_parser.parse_xml(xml)
-        customer_data = customers_data[0]
-        self.load_data(product=self.product, **customer_data)
+        if refresh == REFRESH_LAZY:
+            customer_element = customer_parser.parse_elements(xml)[0]
+            self.load_element(customer_element, self.product,
+                              customer_parser)
+        elif refresh == REFRESH_EAGER:
+            customers_data = customer_parser.parse_xml(xml)
+            customer_data = customers_data[0]
+            self.load_data(product=self.product, **customer_data)
+
+        self.product.reindex_customer(self)
 
     def update(self, first_name=None, last_name=None, email=None,
                company=None, is_vat_exempt=None, vat_number=None,
@@ -493,7 +1343,8 @@ class Customer(object):
                cc_last_name=None, cc_company=None, cc_email=None,
                cc_country=None, cc_address=None, cc_city=None,
                cc_state=None, cc_zip=None, plan_code=None, bill_date=None,
-               coupon_code=None, return_url=None, cancel_url=None,):
+               coupon_code=None, return_url=None, cancel_url=None,
+               refresh=None):
 
         data = self.product.build_customer_post_data(
             first_name=first_name, last_name=last_name, email=email,
@@ -513,22 +1364,68 @@ class Customer(object):
         path = 'customers/edit'
         params = {'code': self.code}
 
-        response = self.product.client.make_request(
+        response = self.product.make_customer_request(
+            code=self.code,
             path=path,
             params=params,
             data=data,
         )
-        return self.load_data_from_xml(response.content)
+        return self.load_data_from_xml(response.content, refresh)
+
+    def save(self, refresh=None):
+        '''
+        Sends the fields of the customer, its subscription and its items
+        which have been assigned since they were loaded, and nothing else.
+        Customer and subscription fields go in one edit request, followed
+        by one request per changed item quantity.  Returns True if anything
+        was sent.
+        '''
+        changes = self.get_changes()
+        subscription = None
+        items = []
+        if self.is_loaded('subscription'):
+            subscription = self.subscription
+            changes.update(subscription.get_changes())
+            if subscription.is_loaded('items'):
+                items = [item for item in subscription.items.values()
+                         if item.has_changes()]
+        if not changes and not items:
+            return False
+
+        if changes:
+            data = self.product.build_customer_post_data(**changes)
+            response = self.product.make_customer_request(
+                code=self.code,
+                path='customers/edit',
+                params={'code': self.code},
+                data=data,
+            )
+            self.clear_changes(changes)
+            if subscription is not None:
+                subscription.clear_changes(changes)
+            if not items:
+                self.load_data_from_xml(response.content, refresh)
+
+        # Only reload the customer after the last request
+        for n, item in enumerate(items):
+            if n < len(items) - 1:
+                item.save(REFRESH_NONE)
+            else:
+                item.save(refresh)
+
+        return True
 
     def delete(self):
         path = 'customers/delete'
         params = {'code': self.code}
-        self.product.client.make_request(
+        self.product.make_customer_request(
+            code=self.code,
             path=path,
             params=params,
         )
 
-    def charge(self, code, each_amount, quantity=1, description=None):
+    def charge(self, code, each_amount, quantity=1, description=None,
+               refresh=None):
         '''
         Add an arbitrary charge or credit to a customer's account.  A positive
         number will create a charge.  A negative number will create a credit.
@@ -546,14 +1443,15 @@ class Customer(object):
         if description:
             data['description'] = description
 
-        response = self.product.client.make_request(
+        response = self.product.make_customer_request(
+            code=self.code,
             path='customers/add-charge',
             params={'code': self.code},
             data=data,
         )
-        return self.load_data_from_xml(response.content)
+        return self.load_data_from_xml(response.content, refresh)
 
-    def create_one_time_invoice(self, charges):
+    def create_one_time_invoice(self, charges, refresh=None):
         '''
         Charges should be a list of charges to execute immediately.  Each
         value in the charges diectionary should be a dictionary with the
@@ -583,12 +1481,13 @@ class Customer(object):
             if 'description' in charge.keys():
                 data['charges[%d][description]' % n] = charge['description']
 
-        response = self.product.client.make_request(
+        response = self.product.make_customer_request(
+            code=self.code,
             path='invoices/new',
             params={'code': self.code},
             data=data,
         )
-        return self.load_data_from_xml(response.content)
+        return self.load_data_from_xml(response.content, refresh)
 
     def __repr__(self):
         return u'Customer: %s %s (%s)' % (
@@ -598,7 +1497,19 @@ class Customer(object):
         )
 
 
-class Subscription(object):
+class Subscription(LazyAttributes, ChangeTracking):
+    __slots__ = ('id', 'gateway_token', 'cc_first_name', 'cc_last_name',
+                 'cc_company', 'cc_country', 'cc_address', 'cc_city',
+                 'cc_state', 'cc_zip', 'cc_type', 'cc_last_four',
+                 'cc_expiration_date', 'cc_email', 'canceled', 'created',
+                 'invoices', 'customer', 'gateway_account', 'cancel_type',
+                 'cancel_reason', 'coupon_code', 'redirect_url', 'plan',
+                 'items', '_changed')
+    # Fields Customer.save sends when assigned
+    editable_fields = frozenset([
+        'cc_first_name', 'cc_last_name', 'cc_company', 'cc_email',
+        'cc_country', 'cc_address', 'cc_city', 'cc_state', 'cc_zip',
+        'coupon_code'])
 
     def __init__(self, id, gateway_token, cc_first_name, cc_last_name,
                  cc_company, cc_country, cc_address, cc_city, cc_state,
@@ -634,79 +1545,127 @@ class Subscription(object):
                   cancel_reason=None, cancel_type=None, coupon_code=None,
                   redirect_url=None):
 
-        self.id = id
-        self.gateway_token = gateway_token
-        self.cc_first_name = cc_first_name
-        self.cc_last_name = cc_last_name
-        self.cc_company = cc_company
-        self.cc_country = cc_country
-        self.cc_address = cc_address
-        self.cc_city = cc_city
-        self.cc_state = cc_state
-        self.cc_zip = cc_zip
-        self.cc_type = cc_type
-        self.cc_last_four = cc_last_four
-        self.cc_expiration_date = cc_expiration_date
-        self.cc_email = cc_email
-        self.canceled = canceled_datetime
-        self.created = created_datetime
-        self.invoices = invoices
-        self.customer = customer
-        self.gateway_account = gateway_account
-        self.cancel_type = cancel_type
-        self.cancel_reason = cancel_reason
-        self.coupon_code = coupon_code
-        self.redirect_url = redirect_url
-
-        # Organize item data into something more useful
-        items_map = {}
-        for item in items:
-            items_map[item['code']] = {'subscription_data': item}
+        self.clear_lazy()
+        self.load_fields(
+            id=id, gateway_token=gateway_token, cc_first_name=cc_first_name,
+            cc_last_name=cc_last_name, cc_company=cc_company,
+            cc_country=cc_country, cc_address=cc_address, cc_city=cc_city,
+            cc_state=cc_state, cc_zip=cc_zip, cc_type=cc_type,
+            cc_last_four=cc_last_four, cc_expiration_date=cc_expiration_date,
+            cc_email=cc_email, canceled=canceled_datetime,
+            created=created_datetime, invoices=invoices, customer=customer,
+            gateway_account=gateway_account, cancel_type=cancel_type,
+            cancel_reason=cancel_reason, coupon_code=coupon_code,
+            redirect_url=redirect_url)
+
+        if plans is not None:
+            self.load_plan_and_items(plans, items or [])
+
+    def load_plan_and_items(self, plans, items):
+        '''
+        Loads the plan and items, updating existing plan and item objects
+        in place.  Items which are no longer on the subscription are
+        removed.
+        '''
         plan_data = plans[0]
-        for item in plan_data['items']:
-            items_map[item['code']]['plan_data'] = item
-
-        if not hasattr(self, 'items'):
-            self.items = {}
-        for code, item_map in items_map.iteritems():
-            plan_item_data = item_map['plan_data']
-            subscription_item_data = item_map['subscription_data']
-            item_data = copy(plan_item_data)
+        plan_items = dict((item['code'], item) for item in plan_data['items'])
+
+        if self.is_loaded('items'):
+            old_items = self.items
+        else:
+            old_items = {}
+        new_items = {}
+        for subscription_item_data in items:
+            code = subscription_item_data['code']
+            item_data = copy(plan_items[code])
             item_data.update(subscription_item_data)
             item_data['subscription'] = self
 
-            if code in self.items.keys():
-                item = self.items[code]
+            item = old_items.get(code)
+            if item is not None:
                 item.load_data(**item_data)
             else:
-                self.items[code] = Item(**item_data)
+                item = Item(**item_data)
+            new_items[code] = item
+
+        if self.is_loaded('items'):
+            for code in [code for code in old_items if code not in new_items]:
+                del old_items[code]
+            old_items.update(new_items)
+        else:
+            self.items = new_items
 
         plan_data['subscription'] = self
-        if hasattr(self, 'plan'):
+        if self.is_loaded('plan'):
             self.plan.load_data(**plan_data)
         else:
             self.plan = PricingPlan(**plan_data)
 
+    @classmethod
+    def from_element(cls, subscription_element, customer, parser=None):
+        '''
+        Builds a subscription from a parsed subscription xml element.  See
+        load_element.
+        '''
+        subscription = cls.__new__(cls)
+        subscription.load_element(subscription_element, customer, parser)
+
+        return subscription
+
+    def load_element(self, subscription_element, customer, parser=None):
+        '''
+        Loads the subscription from a parsed subscription xml element.  Each
+        invoice is decoded the first time it is read from invoices.  On a
+        new subscription the plan and items are decoded together the first
+        time either is accessed; existing plan and item objects are updated
+        straight away instead so references to them stay current.
+        '''
+        parser = parser or CustomersParser()
+        subscription_data = parser.parse_subscription_info(
+            subscription_element)
+        self.load_data(customer=customer, **subscription_data)
+        self.invoices = LazyElementList(
+            subscription_element.find('invoices'), parser.parse_invoice)
+
+        def load_plan_and_items():
+            self.load_plan_and_items(
+                parser.parse_plans(subscription_element.find('plans')),
+                parser.parse_subscription_items(
+                    subscription_element.find('items')),
+            )
+
+        if self.is_loaded('plan') or self.is_loaded('items'):
+            load_plan_and_items()
+        else:
+            self.set_lazy(('plan', 'items'), load_plan_and_items)
+
     def __repr__(self):
         return u'Subscription: %s' % self.id
 
-    def cancel(self):
-        client = self.customer.product.client
-        response = client.make_request(
+    def save(self, refresh=None):
+        '''
+        Sends the changed fields of the subscription along with those of
+        its customer and items.  See Customer.save.
+        '''
+        return self.customer.save(refresh)
+
+    def cancel(self, refresh=None):
+        product = self.customer.product
+        response = product.make_customer_request(
+            code=self.customer.code,
             path='customers/cancel',
             params={'code': self.customer.code},
         )
 
-        customer_parser = CustomersParser()
-        customers_data = customer_parser.parse_xml(response.content)
-        customer_data = customers_data[0]
-        self.customer.load_data(
-            product=self.customer.product,
-            **customer_data
-        )
+        self.customer.load_data_from_xml(response.content, refresh)
 
 
-class Item(object):
+class Item(ChangeTracking):
+    __slots__ = ('code', 'subscription', 'id', 'name', 'quantity_included',
+                 'quantity_used', 'is_periodic', 'overage_amount', 'created',
+                 'modified', '_changed')
+    # Assigning quantity_used and calling save sets the quantity
+    editable_fields = frozenset(['quantity_used'])
 
     def __init__(self, code, subscription, id=None, name=None,
                  quantity_included=None, is_periodic=None,
@@ -726,16 +1685,11 @@ class Item(object):
                   overage_amount=None, created_datetime=None,
                   modified_datetime=None, quantity=None):
 
-        self.code = code
-        self.subscription = subscription
-        self.id = id
-        self.name = name
-        self.quantity_included = quantity_included
-        self.quantity_used = quantity
-        self.is_periodic = is_periodic
-        self.overage_amount = overage_amount
-        self.created = created_datetime
-        self.modified = modified_datetime
+        self.load_fields(
+            code=code, subscription=subscription, id=id, name=name,
+            quantity_included=quantity_included, quantity_used=quantity,
+            is_periodic=is_periodic, overage_amount=overage_amount,
+            created=created_datetime, modified=modified_datetime)
 
     def __repr__(self):
         return u'Item: %s for %s' % (
@@ -743,6 +1697,25 @@ class Item(object):
             self.subscription.customer.code,
         )
 
+    def save(self, refresh=None):
+        '''
+        Sets the item's quantity to quantity_used if it has been assigned
+        since the item was loaded.  Returns True if anything was sent.
+        '''
+        if not self.has_changes():
+            return False
+
+        # Clear the change first so the reload can replace the quantity
+        # with cheddar's, putting it back if the request fails
+        self.clear_changes()
+        try:
+            self.set(self.quantity_used, refresh)
+        except Exception:
+            self.quantity_used = self.quantity_used
+            raise
+
+        return True
+
     def _normalize_quantity(self, quantity=None):
         if quantity is not None:
             quantity = Decimal(quantity)
@@ -750,7 +1723,7 @@ class Item(object):
 
         return quantity
 
-    def increment(self, quantity=None):
+    def increment(self, quantity=None, refresh=None):
         '''
         Increment the item's quantity by the passed in amount.  If nothing is
         passed in, a quantity of 1 is assumed.  If a decimal value is passsed
@@ -761,19 +1734,21 @@ class Item(object):
         if quantity:
             data['quantity'] = self._normalize_quantity(quantity)
 
-        response = self.subscription.customer.product.client.make_request(
+        customer = self.subscription.customer
+        response = customer.product.make_customer_request(
+            code=customer.code,
             path='customers/add-item-quantity',
             params={
-                'code': self.subscription.customer.code,
+                'code': customer.code,
                 'itemCode': self.code,
             },
             data=data,
             method='POST',
         )
 
-        return self.subscription.customer.load_data_from_xml(response.content)
+        return customer.load_data_from_xml(response.content, refresh)
 
-    def decrement(self, quantity=None):
+    def decrement(self, quantity=None, refresh=None):
         '''
         Decrement the item's quantity by the passed in amount.  If nothing is
         passed in, a quantity of 1 is assumed.  If a decimal value is passsed
@@ -784,19 +1759,21 @@ class Item(object):
         if quantity:
             data['quantity'] = self._normalize_quantity(quantity)
 
-        response = self.subscription.customer.product.client.make_request(
+        customer = self.subscription.customer
+        response = customer.product.make_customer_request(
+            code=customer.code,
             path='customers/remove-item-quantity',
             params={
-                'code': self.subscription.customer.code,
+                'code': customer.code,
                 'itemCode': self.code,
             },
             data=data,
             method='POST',
         )
 
-        return self.subscription.customer.load_data_from_xml(response.content)
+        return customer.load_data_from_xml(response.content, refresh)
 
-    def set(self, quantity):
+    def set(self, quantity, refresh=None):
         '''
         Set the item's quantity to the passed in amount.  If nothing is
         passed in, a quantity of 1 is assumed.  If a decimal value is passsed
@@ -806,20 +1783,25 @@ class Item(object):
         data = {}
         data['quantity'] = self._normalize_quantity(quantity)
 
-        response = self.subscription.customer.product.client.make_request(
+        customer = self.subscription.customer
+        response = customer.product.make_customer_request(
+            code=customer.code,
             path='customers/set-item-quantity',
             params={
-                'code': self.subscription.customer.code,
+                'code': customer.code,
                 'itemCode': self.code,
             },
             data=data,
             method='POST',
         )
 
-        return self.subscription.customer.load_data_from_xml(response.content)
+        return customer.load_data_from_xml(response.content, refresh)
+
 
+class Promotion(SlotPickling):
+    __slots__ = ('code', 'id', 'name', 'description', 'created', 'plans',
+                 'incentives', 'coupons')
 
-class Promotion(object):
     def __init__(self, id=None, code=None, name=None, description=None,
                  created_datetime=None, incentives=None, plans=None,
                  coupons=None):
@@ -0,0 +1,237 @@
+import errno
+import logging
+import os
+import struct
+import threading
+from time import sleep, time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+client_log = logging.getLogger('SharpyClient')
+
+
+class RateLimited(Exception):
+    "No request token became available in time"
+
+    def __init__(self, message, retry_after=None):
+        super(RateLimited, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    '''
+    A token bucket rate limiter for the threads of one process.
+
+    The bucket holds up to capacity tokens and refills at rate tokens a
+    second.  Each request takes a token.  When the bucket is empty acquire
+    either waits for a token (blocking) or raises RateLimited straight away
+    (non-blocking).  A full bucket allows a burst of capacity requests.
+
+    The limiter keeps counters of how often and how long callers waited,
+    see get_stats.  Share one limiter between clients to give them a single
+    budget; see FileTokenBucket to share one between processes.
+    '''
+
+    def __init__(self, rate, capacity=None, blocking=True, max_wait=None):
+        '''
+        rate - Tokens added per second
+        capacity - Most tokens the bucket holds. Defaults to rate, so at
+                   most a second's worth of requests can burst. (optional)
+        blocking - Whether acquire waits for a token by default (optional)
+        max_wait - Longest a blocking acquire waits before raising
+                   RateLimited. Waits as long as needed by default.
+                   (optional)
+        '''
+        self.rate = float(rate)
+        if capacity is None:
+            capacity = max(rate, 1)
+        self.capacity = float(capacity)
+        self.blocking = blocking
+        self.max_wait = max_wait
+
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated = time()
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            'acquired': 0,
+            'waited': 0,
+            'rejected': 0,
+            'wait_time': 0.0,
+            'max_wait_time': 0.0,
+        }
+
+        super(TokenBucket, self).__init__()
+
+    def take(self, tokens, now):
+        '''
+        Refills the bucket up to now and takes tokens from it if there are
+        enough.  Returns 0 if the tokens were taken, otherwise the number of
+        seconds until there will be enough.
+        '''
+        with self._lock:
+            self._tokens, self._updated, wait = self.refill_and_take(
+                self._tokens, self._updated, tokens, now)
+
+        return wait
+
+    def refill_and_take(self, available, updated, tokens, now):
+        '''
+        Returns the new (available, updated, wait) state of a bucket which
+        had available tokens at time updated, after trying to take tokens
+        at time now.
+        '''
+        # Clocks of different processes may disagree slightly, so never let
+        # time run backwards.
+        now = max(now, updated)
+        available = min(self.capacity,
+                        available + (now - updated) * self.rate)
+        if available >= tokens:
+            return available - tokens, now, 0
+
+        return available, now, (tokens - available) / self.rate
+
+    def try_acquire(self, tokens=1):
+        '''
+        Takes tokens if they are available right now.  Returns True if they
+        were taken, False otherwise.
+        '''
+        try:
+            self.acquire(tokens, blocking=False)
+        except RateLimited:
+            return False
+
+        return True
+
+    def acquire(self, tokens=1, blocking=None, timeout=None):
+        '''
+        Takes tokens from the bucket, waiting for them if blocking.  Raises
+        RateLimited if they aren't available without blocking, or within
+        timeout (default max_wait) seconds.  Returns the number of seconds
+        spent waiting.
+        '''
+        if blocking is None:
+            blocking = self.blocking
+        if timeout is None:
+            timeout = self.max_wait
+        if tokens > self.capacity:
+            raise ValueError('Can never acquire %s tokens from a bucket '
+                             'holding %s' % (tokens, self.capacity))
+
+        start = time()
+        deadline = None
+        if timeout is not None:
+            deadline = start + timeout
+
+        now = start
+        while True:
+            wait = self.take(tokens, now)
+            if not wait:
+                break
+
+            if not blocking or (deadline is not None and
+                                now + wait > deadline):
+                self._record(rejected=True)
+                raise RateLimited('Request rate limit reached',
+                                  retry_after=wait)
+
+            sleep(wait)
+            now = time()
+
+        waited = now - start
+        self._record(waited=waited)
+        if waited:
+            client_log.debug('Waited %.3fs for a request token' % waited)
+
+        return waited
+
+    def get_stats(self):
+        '''
+        Returns a snapshot of the limiter's counters:
+
+        acquired
+            Successful acquires
+        waited
+            Acquires which had to wait for a token
+        rejected
+            Acquires which raised RateLimited
+        wait_time
+            Total seconds spent waiting
+        max_wait_time
+            Longest single wait in seconds
+        '''
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def _record(self, waited=0, rejected=False):
+        with self._stats_lock:
+            if rejected:
+                self.stats['rejected'] += 1
+                return
+
+            self.stats['acquired'] += 1
+            if waited:
+                self.stats['waited'] += 1
+                self.stats['wait_time'] += waited
+                self.stats['max_wait_time'] = max(
+                    self.stats['max_wait_time'], waited)
+
+
+class FileTokenBucket(TokenBucket):
+    '''
+    A token bucket whose state lives in a small file, so every process on a
+    host pointing at the same path shares one budget.
+
+    The file is locked with flock while the bucket is updated, so this only
+    works on platforms with fcntl and on local filesystems.  Wait counters
+    are kept per process.
+    '''
+    state_format = '<dd'
+
+    def __init__(self, path, rate, capacity=None, blocking=True,
+                 max_wait=None):
+        '''
+        path - The file holding the bucket's state. It is created, full, if
+               it doesn't exist.
+        '''
+        if fcntl is None:
+            raise RuntimeError('FileTokenBucket requires fcntl')
+        self.path = path
+
+        super(FileTokenBucket, self).__init__(rate, capacity, blocking,
+                                              max_wait)
+
+    def take(self, tokens, now):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            state_size = struct.calcsize(self.state_format)
+            data = os.read(fd, state_size)
+            if len(data) == state_size:
+                available, updated = struct.unpack(self.state_format, data)
+            else:
+                available, updated = self.capacity, now
+
+            available, updated, wait = self.refill_and_take(
+                available, updated, tokens, now)
+
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, struct.pack(self.state_format, available, updated))
+        finally:
+            # Closing the file releases the lock
+            os.close(fd)
+
+        return wait
+
+    def reset(self):
+        '''
+        Refills the shared bucket by removing its state file.
+        '''
+        try:
+            os.remove(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
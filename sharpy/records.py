@@ -0,0 +1,108 @@
+class Record(object):
+    '''
+    A small, fixed set of named fields stored in __slots__.
+
+    Records are used for the many little structures hanging off customers
+    (invoices, charges, coupons, ...).  Each one takes a fraction of the
+    memory of the dict it replaces but can still be read like one, so
+    record['number'], record.get('number'), record.keys() and comparing a
+    record to a dict all work alongside record.number.
+    '''
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError('%s got unexpected fields: %s' % (
+                type(self).__name__, ', '.join(sorted(fields))))
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def get(self, key, default=None):
+        if key not in self.__slots__:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def values(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.__slots__]
+
+    def iteritems(self):
+        for name in self.__slots__:
+            yield name, getattr(self, name)
+
+    def to_dict(self):
+        return dict(self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return (type(self) is type(other) and
+                    self.items() == other.items())
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return self.values()
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % item for item in self.iteritems()))
+
+
+class Invoice(Record):
+    __slots__ = ('id', 'number', 'type', 'vat_rate', 'billing_datetime',
+                 'paid_transaction_id', 'created_datetime', 'charges')
+
+
+class Charge(Record):
+    __slots__ = ('id', 'code', 'type', 'quantity', 'each_amount',
+                 'description', 'created_datetime')
+
+
+class Coupon(Record):
+    __slots__ = ('id', 'code', 'max_redemptions', 'expiration_datetime',
+                 'created_datetime')
+
+
+class Incentive(Record):
+    __slots__ = ('id', 'type', 'percentage', 'months', 'created_datetime')
+
+
+class GatewayAccount(Record):
+    __slots__ = ('id', 'gateway', 'type')
@@ -0,0 +1,166 @@
+import httplib
+import logging
+import random
+import socket
+import threading
+import time
+
+from sharpy.exceptions import CheddarError
+
+client_log = logging.getLogger('SharpyClient')
+
+
+class RetryPolicy(object):
+    '''
+    Decides which failed requests to retry and how long to wait in between.
+
+    Delays follow capped exponential backoff with full jitter: before retry
+    n the client sleeps for a random time between zero and
+    min(max_delay, base_delay * 2 ** (n - 1)) seconds, so clients which
+    failed together don't all retry together.
+
+    Only idempotent requests are retried.  GET and HEAD requests always
+    are; a POST is only retried when its path is in safe_paths or the call
+    is explicitly marked idempotent (see Client.make_request).  Errors
+    raised while a POST is in flight may mean cheddar has already acted on
+    it, so retrying something like customers/add-charge could charge the
+    customer twice.
+
+    The policy keeps counters of what it has done, see get_stats.  One
+    policy may be shared between clients.
+    '''
+    default_max_attempts = 3
+    default_base_delay = 0.5
+    default_max_delay = 10
+    retry_statuses = frozenset([500, 502, 503, 504])
+    retry_exceptions = (socket.error, httplib.HTTPException)
+    idempotent_methods = frozenset(['GET', 'HEAD'])
+
+    def __init__(self, max_attempts=None, base_delay=None, max_delay=None,
+                 retry_statuses=None, retry_exceptions=None,
+                 safe_paths=None):
+        '''
+        max_attempts - Total number of tries for each request, including the
+                       first. 1 disables retries. (optional)
+        base_delay - Cap in seconds on the delay before the first retry
+                     (optional)
+        max_delay - Cap in seconds on the delay before any retry (optional)
+        retry_statuses - HTTP status codes worth retrying (optional)
+        retry_exceptions - Exception classes, raised while making the
+                           request, worth retrying (optional)
+        safe_paths - API paths, such as 'customers/set-item-quantity',
+                     whose POSTs may be safely repeated (optional)
+        '''
+        if max_attempts is None:
+            max_attempts = self.default_max_attempts
+        self.max_attempts = max(max_attempts, 1)
+        if base_delay is None:
+            base_delay = self.default_base_delay
+        self.base_delay = base_delay
+        if max_delay is None:
+            max_delay = self.default_max_delay
+        self.max_delay = max_delay
+        if retry_statuses is not None:
+            self.retry_statuses = frozenset(retry_statuses)
+        if retry_exceptions is not None:
+            self.retry_exceptions = tuple(retry_exceptions)
+        self.safe_paths = frozenset(safe_paths or [])
+
+        self._lock = threading.Lock()
+        self.stats = {
+            'requests': 0,
+            'retries': 0,
+            'recovered': 0,
+            'exhausted': 0,
+            'not_retried': 0,
+        }
+
+        super(RetryPolicy, self).__init__()
+
+    def is_idempotent(self, method, path, idempotent=None):
+        if idempotent is not None:
+            return idempotent
+
+        return method in self.idempotent_methods or path in self.safe_paths
+
+    def is_retryable(self, error):
+        '''
+        Returns True if error is a transient failure worth retrying.
+        '''
+        if isinstance(error, CheddarError):
+            return error.response.status in self.retry_statuses
+
+        return isinstance(error, self.retry_exceptions)
+
+    def get_delay(self, retry):
+        '''
+        Returns the number of seconds to sleep before the given retry,
+        counting from 1.
+        '''
+        cap = min(self.max_delay, self.base_delay * 2 ** (retry - 1))
+
+        return random.uniform(0, cap)
+
+    def sleep(self, delay):
+        time.sleep(delay)
+
+    def call(self, func, method, path, idempotent=None):
+        '''
+        Calls func, retrying it on transient failures if the request it
+        makes is idempotent.  The exception from the last attempt is
+        re-raised with an attempts attribute recording how many tries were
+        made.
+        '''
+        retry_allowed = self.is_idempotent(method, path, idempotent)
+        attempt = 1
+        self._count('requests')
+        while True:
+            try:
+                result = func()
+            except Exception, e:
+                if not self.is_retryable(e):
+                    e.attempts = attempt
+                    raise
+                if not retry_allowed:
+                    self._count('not_retried')
+                    e.attempts = attempt
+                    raise
+                if attempt >= self.max_attempts:
+                    self._count('exhausted')
+                    e.attempts = attempt
+                    raise
+
+                delay = self.get_delay(attempt)
+                client_log.warning(
+                    'Retrying %s %s in %.2fs after attempt %d failed: %s' % (
+                        method, path, delay, attempt, e))
+                self._count('retries')
+                self.sleep(delay)
+                attempt += 1
+            else:
+                if attempt > 1:
+                    self._count('recovered')
+                return result
+
+    def get_stats(self):
+        '''
+        Returns a snapshot of the policy's counters:
+
+        requests
+            Requests made under this policy
+        retries
+            Retries made, across all requests
+        recovered
+            Requests which succeeded after at least one retry
+        exhausted
+            Requests which were still failing after max_attempts tries
+        not_retried
+            Requests which failed in a retryable way but weren't retried
+            because they aren't idempotent
+        '''
+        with self._lock:
+            return dict(self.stats)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
@@ -0,0 +1,271 @@
+from datetime import date, datetime
+
+from dateutil.tz import tzutc
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sharpy.columnar import to_naive_utc
+
+UTC = tzutc()
+
+# Recurring revenue and charge rollups over a CustomerTables (see
+# sharpy.columnar), computed with array operations rather than loops over
+# customers.  Amounts are whole cents.  Datetime arguments may be
+# datetimes (naive ones are taken as UTC), dates or numpy datetime64s.
+
+# Months in one of each billing frequency unit
+MONTHS_PER_UNIT = {
+    'day': 12 / 365.25,
+    'week': 12 / (365.25 / 7),
+    'month': 1.0,
+    'year': 12.0,
+}
+
+
+def to_datetime64(value):
+    '''
+    Converts a datetime, date or datetime64 to a datetime64[s], or returns
+    the current time if value is None.
+    '''
+    if value is None:
+        value = datetime.now(UTC)
+    if isinstance(value, datetime):
+        value = to_naive_utc(value)
+    elif isinstance(value, date):
+        value = datetime(value.year, value.month, value.day)
+
+    return numpy.datetime64(value, 's')
+
+
+def plan_monthly_cents(tables):
+    '''
+    Returns each plan's recurring charge spread over a month, in cents,
+    indexed by plan code.  A plan billed 30 every 3 months is worth 10 a
+    month, one billed 120 a year 10 a month.  Plans with an unknown
+    billing frequency are worth nothing.
+    '''
+    plans = tables.plans
+    units = plans.categories['billing_frequency_unit']
+    months_per_unit = numpy.array(
+        [MONTHS_PER_UNIT.get((unit or '').rstrip('s'), 0) for unit in units]
+        + [0], dtype=numpy.float64)
+    # -1 (no unit) picks the trailing 0
+    months = months_per_unit[plans['billing_frequency_unit']] * numpy.maximum(
+        plans['billing_frequency_quantity'], 1)
+
+    monthly = numpy.zeros(len(plans), dtype=numpy.float64)
+    billed = months > 0
+    monthly[billed] = plans['recurring_charge_cents'][billed] / months[billed]
+
+    return numpy.rint(monthly).astype(numpy.int64)
+
+
+def subscription_monthly_cents(tables):
+    '''
+    Returns each subscription's monthly recurring amount in cents, in
+    subscriptions table order.
+    '''
+    plan_codes = tables.subscriptions['plan']
+    # -1 (no plan) picks the trailing 0
+    monthly = numpy.append(plan_monthly_cents(tables), 0)
+
+    return monthly[plan_codes]
+
+
+def paying_since(tables, exclude_trials=True):
+    '''
+    Returns when each subscription started paying: when it was created,
+    or if exclude_trials, when its plan's trial ended.
+    '''
+    subscriptions = tables.subscriptions
+    started = subscriptions['created']
+    if not exclude_trials:
+        return started
+
+    trial_days = numpy.append(
+        numpy.maximum(tables.plans['trial_days'], 0), 0)
+    trial_seconds = trial_days[subscriptions['plan']] * 86400
+
+    return started + trial_seconds.astype('timedelta64[s]')
+
+
+def active_mask(tables, at=None, exclude_trials=True):
+    '''
+    Returns a boolean array of the subscriptions which were paying at the
+    given time (now by default): started, past any trial and not canceled.
+    '''
+    at = to_datetime64(at)
+    canceled = tables.subscriptions['canceled']
+    started = paying_since(tables, exclude_trials)
+
+    return (started <= at) & (numpy.isnat(canceled) | (canceled > at))
+
+
+def mrr(tables, at=None, exclude_trials=True):
+    '''
+    Returns the monthly recurring revenue at the given time (now by
+    default) in cents.
+    '''
+    active = active_mask(tables, at, exclude_trials)
+
+    return int(subscription_monthly_cents(tables)[active].sum())
+
+
+def arr(tables, at=None, exclude_trials=True):
+    '''
+    Returns the annual recurring revenue, twelve times mrr, in cents.
+    '''
+    return mrr(tables, at, exclude_trials) * 12
+
+
+def _sum_by(codes, labels, weights):
+    # Sums weights by categorical code, returning {label: total} for the
+    # labels with any rows.  Rows with code -1 are totaled under None.
+    if not len(codes):
+        return {}
+    totals = numpy.bincount(codes + 1, weights=weights,
+                            minlength=len(labels) + 1)
+    counts = numpy.bincount(codes + 1, minlength=len(labels) + 1)
+    keys = [None] + list(labels)
+
+    return dict((keys[n], int(round(totals[n])))
+                for n in numpy.flatnonzero(counts))
+
+
+def mrr_by_plan(tables, at=None, exclude_trials=True):
+    '''
+    Returns {plan code: mrr in cents} for the plans with subscriptions
+    paying at the given time.
+    '''
+    active = active_mask(tables, at, exclude_trials)
+
+    return _sum_by(tables.subscriptions['plan'][active], tables.plan_codes,
+                   subscription_monthly_cents(tables)[active])
+
+
+def mrr_by_campaign_source(tables, at=None, exclude_trials=True):
+    '''
+    Returns {campaign source: mrr in cents}, with customers without a
+    campaign source under None.
+    '''
+    active = active_mask(tables, at, exclude_trials)
+    customers = tables.subscriptions['customer'][active]
+    sources = tables.customers['campaign_source'][customers]
+
+    return _sum_by(sources,
+                   tables.customers.categories['campaign_source'],
+                   subscription_monthly_cents(tables)[active])
+
+
+def plan_mix(tables, at=None, exclude_trials=True):
+    '''
+    Returns {plan code: number of subscriptions} paying at the given time.
+    '''
+    active = active_mask(tables, at, exclude_trials)
+    codes = tables.subscriptions['plan'][active]
+
+    return _sum_by(codes, tables.plan_codes,
+                   numpy.ones(len(codes), dtype=numpy.float64))
+
+
+def month_starts(start, end):
+    '''
+    Returns the first instant of every month from start's month to end's
+    month as datetime64[s] values.
+    '''
+    first = to_datetime64(start).astype('datetime64[M]')
+    last = to_datetime64(end).astype('datetime64[M]')
+
+    return numpy.arange(first, last + 1).astype('datetime64[s]')
+
+
+def mrr_by_month(tables, start, end=None, exclude_trials=True):
+    '''
+    Returns [(month, mrr in cents)] giving the mrr at the start of each
+    month from start's month to end's (now by default), as datetime64[M]
+    months and ints.
+
+    Each subscription adds its amount from the first month start it was
+    paying at until the first one after it was canceled, so the whole
+    series takes one pass over the subscriptions.
+    '''
+    starts = month_starts(start, end)
+    count = len(starts)
+    amounts = subscription_monthly_cents(tables)
+    paying = paying_since(tables, exclude_trials)
+    canceled = tables.subscriptions['canceled']
+
+    first = numpy.searchsorted(starts, paying, side='left')
+    never_canceled = numpy.isnat(canceled)
+    last = numpy.full(len(canceled), count, dtype=numpy.int64)
+    last[~never_canceled] = numpy.searchsorted(
+        starts, canceled[~never_canceled], side='left')
+    last = numpy.maximum(last, first)
+
+    changes = (numpy.bincount(first, weights=amounts, minlength=count + 1) -
+               numpy.bincount(last, weights=amounts, minlength=count + 1))
+    totals = numpy.rint(numpy.cumsum(changes)[:count]).astype(numpy.int64)
+
+    return [(month, int(total)) for month, total in
+            zip(starts.astype('datetime64[M]'), totals)]
+
+
+def _charge_mask(tables, start, end):
+    charges = tables.charges
+    billing = charges['billing']
+    mask = ~numpy.isnat(billing)
+    if start is not None:
+        mask &= billing >= to_datetime64(start)
+    if end is not None:
+        mask &= billing < to_datetime64(end)
+
+    return mask
+
+
+def charge_totals(tables, start=None, end=None):
+    '''
+    Returns {'charges': cents, 'credits': cents, 'net': cents} totaling
+    the invoice charges billed from start until end.  Credits (negative
+    charges) are totaled as a negative number.
+    '''
+    mask = _charge_mask(tables, start, end)
+    amounts = tables.charges['amount_cents'][mask]
+    charges = int(amounts[amounts > 0].sum())
+    credits = int(amounts[amounts < 0].sum())
+
+    return {'charges': charges, 'credits': credits,
+            'net': charges + credits}
+
+
+def charge_totals_by_code(tables, start=None, end=None):
+    '''
+    Returns {charge code: net cents} for the invoice charges billed from
+    start until end.
+    '''
+    mask = _charge_mask(tables, start, end)
+
+    return _sum_by(tables.charges['code'][mask], tables.charge_codes,
+                   tables.charges['amount_cents'][mask])
+
+
+def charge_totals_by_month(tables, start, end=None):
+    '''
+    Returns [(month, net cents)] of the invoice charges billed in each
+    month from start's month to end's (now by default).
+    '''
+    starts = month_starts(start, end)
+    months = starts.astype('datetime64[M]')
+    # Up to the start of the month after end's
+    mask = _charge_mask(tables, starts[0],
+                        (months[-1] + 1).astype('datetime64[s]'))
+    billing = tables.charges['billing'][mask]
+    buckets = numpy.searchsorted(starts, billing, side='right') - 1
+    totals = numpy.bincount(buckets,
+                            weights=tables.charges['amount_cents'][mask],
+                            minlength=len(starts))
+
+    return [(month, int(round(total))) for month, total in
+            zip(months, totals)]
@@ -0,0 +1,96 @@
+import sys
+import threading
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.followers = 0
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    '''
+    Coalesces concurrent calls for the same key into one.
+
+    The first thread to call do(key, func) runs func.  Threads which call
+    do with the same key while it is running wait for it and share its
+    result (or exception) instead of running func again.  Once the call
+    finishes the key is forgotten, so later calls run func afresh; this
+    isn't a cache.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.stats = {
+            'calls': 0,
+            'coalesced': 0,
+        }
+
+        super(SingleFlight, self).__init__()
+
+    def do(self, key, func, copy=None):
+        '''
+        Returns func(), sharing the result with concurrent calls for key.
+
+        copy - If given, every caller of a shared call gets copy(result)
+               rather than the result itself, so callers may modify what
+               they get back.  A call nobody else joined returns the
+               result as is. (optional)
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+                self.stats['calls'] += 1
+            else:
+                call.followers += 1
+                leader = False
+                self.stats['coalesced'] += 1
+
+        if leader:
+            try:
+                call.result = func()
+            except BaseException:
+                call.exc_info = sys.exc_info()
+            finally:
+                with self._lock:
+                    if self._calls.get(key) is call:
+                        del self._calls[key]
+                    # No one can join once the call is removed
+                    shared = call.followers > 0
+                call.done.set()
+        else:
+            call.done.wait()
+            shared = True
+
+        if call.exc_info is not None:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+
+        if shared and copy is not None:
+            return copy(call.result)
+        return call.result
+
+    def forget(self, key):
+        '''
+        Makes later calls for key start a new call rather than join one
+        already in flight, e.g. because the data it is fetching has just
+        changed.  Callers already waiting still get the old call's result.
+        '''
+        with self._lock:
+            self._calls.pop(key, None)
+
+    def forget_all(self):
+        with self._lock:
+            self._calls.clear()
+
+    def get_stats(self):
+        '''
+        Returns the number of calls made and the number of callers which
+        shared another's call instead.
+        '''
+        with self._lock:
+            return dict(self.stats)
@@ -0,0 +1,105 @@
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from sharpy.asynchronous import AsyncCheddarProduct
+from sharpy.asynchronous import AsyncClient
+from sharpy.cache import LRUCache
+from sharpy.journal import FileJournal
+from sharpy.retry import RetryPolicy
+
+from testing_tools.fixtures import FakeClient
+
+
+class RecordingRetryPolicy(RetryPolicy):
+    ''' A retry policy which records its calls instead of sleeping. '''
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingRetryPolicy, self).__init__(*args, **kwargs)
+        self.calls = []
+
+    def call(self, func, method, path, idempotent=None):
+        self.calls.append((method, path, idempotent))
+        return super(RecordingRetryPolicy, self).call(func, method, path,
+                                                      idempotent)
+
+    def sleep(self, delay):
+        pass
+
+
+class AsyncClientTests(unittest.TestCase):
+
+    def get_client(self, **kwargs):
+        return AsyncClient('user', 'password', 'PRODUCT',
+                           endpoint='http://127.0.0.1:1/xml', **kwargs)
+
+    def test_coalesce(self):
+        ''' Test coalescing can be turned off. '''
+        self.assertTrue(self.get_client().coalesce)
+        self.assertFalse(self.get_client(coalesce=False).coalesce)
+
+    def test_idempotent(self):
+        ''' Test a POST marked idempotent is retried. '''
+        policy = RecordingRetryPolicy(max_attempts=2)
+        client = self.get_client(retry_policy=policy)
+        try:
+            result = client.make_request_async(
+                'customers/get', data={'search': 'x'}, idempotent=True)
+            self.assertRaises(socket.error, result.get)
+        finally:
+            client.close()
+
+        self.assertEquals([('POST', 'customers/get', True)], policy.calls)
+        self.assertEquals(1, policy.get_stats()['retries'])
+
+
+class AsyncCheddarProductTests(unittest.TestCase):
+
+    def get_product(self, **kwargs):
+        return AsyncCheddarProduct('user', 'password', 'PRODUCT',
+                                   endpoint='http://127.0.0.1:1/xml',
+                                   **kwargs)
+
+    def test_result_cache(self):
+        ''' Test the async product caches results like the sync one. '''
+        cache = LRUCache()
+        product = self.get_product(result_cache=cache)
+        loads = []
+
+        def load():
+            loads.append(None)
+            return {'code': 'PLAN'}
+
+        try:
+            self.assertTrue(product.result_cache is cache)
+            product.get_cached('plans', load)
+            product.get_cached('plans', load)
+        finally:
+            product.close()
+
+        self.assertEquals(1, len(loads))
+
+    def test_journal(self):
+        ''' Test the async product replays its journal. '''
+        directory = tempfile.mkdtemp()
+        journal = FileJournal(os.path.join(directory, 'journal'))
+        entry = journal.record('customer', 'customers/add-charge',
+                               {'code': 'customer'}, {'eachAmount': '1.00'})
+        product = self.get_product(journal=journal)
+        client = product.client
+        try:
+            self.assertTrue(product.journal is journal)
+            product.client = FakeClient()
+            sent, errors = product.replay_journal()
+        finally:
+            client.close()
+            journal.close()
+            shutil.rmtree(directory)
+
+        self.assertEquals({}, errors)
+        self.assertEquals([entry.id], [each.id for each in sent])
+        self.assertEquals(['customers/add-charge'],
+                          [request[0] for request in
+                           product.client.requests])
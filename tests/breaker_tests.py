@@ -0,0 +1,199 @@
+import socket
+import time
+import unittest
+
+from nose.tools import assert_raises
+
+from sharpy.breaker import CircuitBreaker
+from sharpy.breaker import CircuitOpen
+from sharpy.client import Client
+from sharpy.exceptions import NotFound
+from sharpy.pool import PoolTimeout
+from sharpy.ratelimit import RateLimited
+from sharpy.ratelimit import TokenBucket
+from sharpy.retry import RetryPolicy
+
+from testing_tools.fixtures import get_cheddar_error
+
+
+class CircuitBreakerTests(unittest.TestCase):
+
+    def fail(self):
+        raise socket.error('connection refused')
+
+    def succeed(self):
+        return 'result'
+
+    def get_breaker(self, **kwargs):
+        transitions = []
+
+        def on_state_change(breaker, old_state, new_state):
+            transitions.append((old_state, new_state))
+
+        breaker = CircuitBreaker(on_state_change=on_state_change, **kwargs)
+        return breaker, transitions
+
+    def trip(self, breaker, failures):
+        for n in range(failures):
+            assert_raises(socket.error, breaker.call, self.fail)
+
+    def test_opens_after_consecutive_failures(self):
+        ''' Test the breaker opens after failure_threshold failures. '''
+        breaker, transitions = self.get_breaker(failure_threshold=3)
+
+        self.trip(breaker, 2)
+        self.assertEquals(CircuitBreaker.CLOSED, breaker.state)
+        self.trip(breaker, 1)
+
+        self.assertEquals(CircuitBreaker.OPEN, breaker.state)
+        self.assertEquals([('closed', 'open')], transitions)
+
+    def test_success_resets_consecutive_failures(self):
+        ''' Test a success in between failures keeps the breaker closed. '''
+        breaker, transitions = self.get_breaker(failure_threshold=2)
+
+        self.trip(breaker, 1)
+        breaker.call(self.succeed)
+        self.trip(breaker, 1)
+
+        self.assertEquals(CircuitBreaker.CLOSED, breaker.state)
+
+    def test_opens_on_error_rate(self):
+        ''' Test the breaker opens once the window's error rate is hit. '''
+        breaker, transitions = self.get_breaker(
+            failure_threshold=0, error_rate=0.5, window_size=4,
+            min_requests=4)
+
+        breaker.call(self.succeed)
+        self.trip(breaker, 1)
+        breaker.call(self.succeed)
+        self.assertEquals(CircuitBreaker.CLOSED, breaker.state)
+        self.trip(breaker, 1)
+
+        self.assertEquals(CircuitBreaker.OPEN, breaker.state)
+
+    def test_open_breaker_fails_fast(self):
+        ''' Test an open breaker raises CircuitOpen without calling. '''
+        breaker, transitions = self.get_breaker(failure_threshold=1,
+                                                reset_timeout=60)
+        self.trip(breaker, 1)
+        calls = []
+
+        with assert_raises(CircuitOpen) as context:
+            breaker.call(lambda: calls.append(None))
+
+        self.assertEquals([], calls)
+        self.assertTrue(0 < context.exception.retry_after <= 60)
+        self.assertEquals(1, breaker.get_stats()['rejected'])
+
+    def test_half_open_success_closes(self):
+        ''' Test a successful trial request closes the breaker. '''
+        breaker, transitions = self.get_breaker(failure_threshold=1,
+                                                reset_timeout=0.01)
+        self.trip(breaker, 1)
+        time.sleep(0.02)
+
+        self.assertEquals(CircuitBreaker.HALF_OPEN, breaker.state)
+        self.assertEquals('result', breaker.call(self.succeed))
+        self.assertEquals(CircuitBreaker.CLOSED, breaker.state)
+        self.assertEquals([('closed', 'open'), ('open', 'half-open'),
+                           ('half-open', 'closed')], transitions)
+
+    def test_half_open_failure_reopens(self):
+        ''' Test a failed trial request opens the breaker again. '''
+        breaker, transitions = self.get_breaker(failure_threshold=1,
+                                                reset_timeout=0.01)
+        self.trip(breaker, 1)
+        time.sleep(0.02)
+        self.trip(breaker, 1)
+
+        self.assertEquals(CircuitBreaker.OPEN, breaker.state)
+        self.assertEquals(2, breaker.get_stats()['opened'])
+
+    def test_half_open_limits_trials(self):
+        ''' Test only half_open_max trial requests are let through. '''
+        breaker, transitions = self.get_breaker(failure_threshold=1,
+                                                reset_timeout=0.01)
+        self.trip(breaker, 1)
+        time.sleep(0.02)
+
+        breaker.before_call()
+        assert_raises(CircuitOpen, breaker.before_call)
+
+    def test_not_sent_leaves_state(self):
+        ''' Test requests refused before being sent aren't counted. '''
+        breaker, transitions = self.get_breaker(failure_threshold=1,
+                                                reset_timeout=0.01)
+        self.trip(breaker, 1)
+        time.sleep(0.02)
+
+        for error in (RateLimited('limited'), PoolTimeout('timeout'),
+                      CircuitOpen('open')):
+            def refuse():
+                raise error
+            assert_raises(type(error), breaker.call, refuse)
+            self.assertEquals(CircuitBreaker.HALF_OPEN, breaker.state)
+
+        stats = breaker.get_stats()
+        self.assertEquals(0, stats['successes'])
+        self.assertEquals(1, stats['failures'])
+        # The trial slot was given back
+        breaker.before_call()
+
+    def test_client_rate_limit_frees_trial(self):
+        ''' Test a rate limited request gives back its trial slot. '''
+        breaker, transitions = self.get_breaker(failure_threshold=1,
+                                                reset_timeout=0.01)
+        bucket = TokenBucket(rate=0.1, capacity=1, blocking=False)
+        bucket.acquire()
+        client = Client('user', 'password', 'PRODUCT',
+                        endpoint='http://127.0.0.1:1/xml',
+                        retry_policy=RetryPolicy(max_attempts=1),
+                        circuit_breaker=breaker, rate_limiter=bucket)
+        self.trip(breaker, 1)
+        time.sleep(0.02)
+
+        assert_raises(RateLimited, client.make_request, 'plans/get')
+        assert_raises(RateLimited, client.open_request, 'plans/get')
+
+        self.assertEquals(CircuitBreaker.HALF_OPEN, breaker.state)
+        self.assertEquals(0, breaker.get_stats()['successes'])
+        breaker.before_call()
+
+    def test_client_open_breaker_spends_no_token(self):
+        ''' Test an open breaker refuses requests before throttling. '''
+        breaker, transitions = self.get_breaker(failure_threshold=1)
+        bucket = TokenBucket(rate=0.1, capacity=1, blocking=False)
+        client = Client('user', 'password', 'PRODUCT',
+                        endpoint='http://127.0.0.1:1/xml',
+                        retry_policy=RetryPolicy(max_attempts=1),
+                        circuit_breaker=breaker, rate_limiter=bucket)
+        self.trip(breaker, 1)
+
+        assert_raises(CircuitOpen, client.make_request, 'plans/get')
+        assert_raises(CircuitOpen, client.open_request, 'plans/get')
+
+        # The only token is still there
+        bucket.acquire()
+
+    def test_client_errors_are_not_failures(self):
+        ''' Test errors which show cheddar is up don't open the breaker. '''
+        breaker, transitions = self.get_breaker(failure_threshold=1)
+
+        def not_found():
+            raise get_cheddar_error(NotFound, 404)
+
+        assert_raises(NotFound, breaker.call, not_found)
+        self.assertEquals(CircuitBreaker.CLOSED, breaker.state)
+
+    def test_client_fails_fast(self):
+        ''' Test a client with an open breaker doesn't make requests. '''
+        breaker = CircuitBreaker(failure_threshold=1)
+        client = Client('user', 'password', 'PRODUCT',
+                        endpoint='http://127.0.0.1:1/xml',
+                        retry_policy=RetryPolicy(max_attempts=1),
+                        circuit_breaker=breaker)
+
+        assert_raises(socket.error, client.make_request, 'plans/get')
+        assert_raises(CircuitOpen, client.make_request, 'plans/get')
+        self.assertEquals(1, client.get_pool_stats()['opens'])
@@ -0,0 +1,296 @@
+from datetime import datetime
+from decimal import Decimal
+import shutil
+import tempfile
+import time
+import unittest
+
+from dateutil.tz import tzutc
+
+from sharpy.cache import FileCache
+from sharpy.cache import LRUCache
+from sharpy.cache import MemcachedCache
+from sharpy.product import CheddarProduct
+
+
+class LRUCacheTests(unittest.TestCase):
+
+    def test_set_and_get(self):
+        ''' Test a value can be read back while fresh. '''
+        cache = LRUCache()
+        cache.set('key', 'value')
+
+        self.assertEquals('value', cache.get('key'))
+        self.assertEquals(('value', LRUCache.FRESH), cache.lookup('key'))
+
+    def test_missing(self):
+        ''' Test looking up a key which was never set. '''
+        cache = LRUCache()
+
+        self.assertEquals(None, cache.get('key'))
+        self.assertEquals('default', cache.get('key', 'default'))
+        self.assertEquals((None, LRUCache.MISSING), cache.lookup('key'))
+
+    def test_expiry(self):
+        ''' Test entries are dropped once their ttl passes. '''
+        cache = LRUCache(ttl=0.01)
+        cache.set('key', 'value')
+        time.sleep(0.02)
+
+        self.assertEquals((None, LRUCache.MISSING), cache.lookup('key'))
+
+    def test_per_entry_ttl(self):
+        ''' Test a ttl passed to set overrides the default. '''
+        cache = LRUCache(ttl=0.01)
+        cache.set('key', 'value', ttl=60)
+        time.sleep(0.02)
+
+        self.assertEquals('value', cache.get('key'))
+
+    def test_stale(self):
+        ''' Test expired entries are reported stale within stale_ttl. '''
+        cache = LRUCache(ttl=0.01, stale_ttl=60)
+        cache.set('key', 'value')
+        time.sleep(0.02)
+
+        self.assertEquals(('value', LRUCache.STALE), cache.lookup('key'))
+        self.assertEquals(None, cache.get('key'))
+
+    def test_lru_eviction(self):
+        ''' Test the least recently used entry is evicted first. '''
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEquals(2, len(cache))
+        self.assertEquals(1, cache.get('a'))
+        self.assertEquals(None, cache.get('b'))
+        self.assertEquals(3, cache.get('c'))
+
+    def test_delete_and_clear(self):
+        ''' Test explicit invalidation. '''
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.delete('a')
+
+        self.assertEquals(None, cache.get('a'))
+        self.assertEquals(2, cache.get('b'))
+
+        cache.clear()
+        self.assertEquals(0, len(cache))
+
+    def test_versions_are_not_evicted(self):
+        ''' Test evicting entries doesn't forget an invalidation. '''
+        cache = LRUCache(max_entries=2)
+        generation = cache.get_generation('A')
+        version = cache.get_version('a')
+        cache.invalidate('a')
+        for n in range(5):
+            cache.set('k%d' % n, n)
+
+        self.assertEquals(2, len(cache))
+        self.assertEquals(generation, cache.get_generation('A'))
+        self.assertFalse(cache.set_if_version('a', 1, version))
+
+    def test_versions_expire(self):
+        ''' Test versions are dropped once their ttl passes. '''
+        cache = LRUCache()
+        cache.version_ttl = 0
+        cache.invalidate('a')
+        cache.invalidate('b')
+
+        self.assertEquals(None, cache.get_version('a'))
+        self.assertEquals(0, len(cache._versions))
+
+
+class FakeMemcacheClient(object):
+    ''' Stand in for a memcache client which keeps data in a dict. '''
+
+    def __init__(self):
+        self.data = {}
+        self.lifetimes = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, time=0):
+        self.data[key] = value
+        self.lifetimes[key] = time
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def flush_all(self):
+        self.data.clear()
+
+
+class SharedCacheTestsMixin(object):
+    ''' Tests every serializing cache backend should pass. '''
+
+    value = {
+        'code': 'test',
+        'amount': Decimal('10.00'),
+        'created_datetime': datetime(2011, 1, 10, 23, 57, 58,
+                                     tzinfo=tzutc()),
+        'items': [{'code': 'MONTHLY_ITEM', 'quantity': Decimal('3')}],
+    }
+
+    def test_set_and_get(self):
+        ''' Test a parsed value survives a round trip. '''
+        self.cache.set('customer:test', self.value)
+        result = self.cache.get('customer:test')
+
+        self.assertEquals(self.value, result)
+        self.assertFalse(result is self.value)
+
+    def test_shared(self):
+        ''' Test a second cache instance sees the same entries. '''
+        self.cache.set('customer:test', self.value)
+
+        self.assertEquals(self.value, self.get_other_cache().get(
+            'customer:test'))
+
+    def test_missing(self):
+        ''' Test looking up a key which was never set. '''
+        self.assertEquals((None, self.cache.MISSING),
+                          self.cache.lookup('customer:test'))
+
+    def test_expiry(self):
+        ''' Test entries are dropped once their ttl passes. '''
+        self.cache.set('customer:test', self.value, ttl=0.01)
+        time.sleep(0.02)
+
+        self.assertEquals(None, self.cache.get('customer:test'))
+
+    def test_delete_and_clear(self):
+        ''' Test explicit invalidation. '''
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.delete('a')
+
+        self.assertEquals(None, self.cache.get('a'))
+        self.assertEquals(2, self.cache.get('b'))
+
+        self.cache.clear()
+        self.assertEquals(None, self.cache.get('b'))
+
+    def test_clear_namespace(self):
+        ''' Test clearing a namespace starts a new shared generation. '''
+        first = self.cache.get_generation('A')
+        other = self.cache.get_generation('B')
+
+        self.assertEquals(first, self.get_other_cache().get_generation('A'))
+
+        self.cache.clear_namespace('A')
+
+        self.assertNotEquals(first, self.cache.get_generation('A'))
+        self.assertEquals(self.cache.get_generation('A'),
+                          self.get_other_cache().get_generation('A'))
+        self.assertEquals(other, self.cache.get_generation('B'))
+
+    def test_set_if_version(self):
+        ''' Test a value loaded before an invalidation isn't cached. '''
+        version = self.cache.get_version('a')
+        self.get_other_cache().invalidate('a')
+
+        self.assertFalse(self.cache.set_if_version('a', 1, version))
+        self.assertEquals(None, self.cache.get('a'))
+        self.assertTrue(self.cache.set_if_version(
+            'a', 1, self.cache.get_version('a')))
+        self.assertEquals(1, self.cache.get('a'))
+
+
+class FileCacheTests(SharedCacheTestsMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = FileCache(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_other_cache(self):
+        return FileCache(self.directory)
+
+    def test_unicode_key(self):
+        ''' Test keys with non ascii characters. '''
+        self.cache.set(u'customer:t\xe9st', 1)
+
+        self.assertEquals(1, self.cache.get(u'customer:t\xe9st'))
+
+    def test_corrupt_entry(self):
+        ''' Test an unreadable cache file is treated as missing. '''
+        self.cache.set('customer:test', self.value)
+        f = open(self.cache.get_path('customer:test'), 'wb')
+        f.write('garbage')
+        f.close()
+
+        self.assertEquals(None, self.cache.get('customer:test'))
+
+
+class MemcachedCacheTests(SharedCacheTestsMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeMemcacheClient()
+        self.cache = MemcachedCache(self.client)
+
+    def get_other_cache(self):
+        return MemcachedCache(self.client)
+
+    def test_lifetime(self):
+        ''' Test entries are stored with a relative memcached lifetime. '''
+        self.cache.set('a', 1, ttl=60)
+        self.cache.get_generation('A')
+
+        lifetime = self.client.lifetimes[self.cache.get_key('a')]
+        self.assertTrue(59 < lifetime <= 61)
+        # Memcached would read 30 days or more as a timestamp
+        self.assertEquals(0, self.client.lifetimes[self.cache.get_key(
+            self.cache.generation_prefix + 'A')])
+
+
+class ProductCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = LRUCache()
+        self.product = CheddarProduct('user', 'password', 'A',
+                                      result_cache=self.cache)
+        self.loads = []
+
+    def loader(self, value):
+        def load():
+            self.loads.append(value)
+            return value
+        return load
+
+    def test_clear_cache(self):
+        ''' Test clearing a product's cache leaves other products alone. '''
+        other = CheddarProduct('user', 'password', 'B',
+                               result_cache=self.cache)
+        self.product.get_cached('plans', self.loader('a'))
+        other.get_cached('plans', self.loader('b'))
+
+        self.product.clear_cache()
+        self.product.get_cached('plans', self.loader('a'))
+        other.get_cached('plans', self.loader('b'))
+
+        self.assertEquals(['a', 'b', 'a'], self.loads)
+
+    def test_invalidated_while_loading(self):
+        ''' Test a customer invalidated mid load isn't left cached. '''
+        def load():
+            self.loads.append('old')
+            # As a mutation of the customer finishing meanwhile would
+            self.product.invalidate_customer('test')
+            return 'old'
+
+        self.assertEquals('old', self.product.get_cached('customer:test',
+                                                         load))
+        self.assertEquals('new', self.product.get_cached(
+            'customer:test', self.loader('new')))
+        self.assertEquals('new', self.product.get_cached(
+            'customer:test', self.loader('newer')))
+        self.assertEquals(['old', 'new'], self.loads)
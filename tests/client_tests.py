@@ -7,6 +7,7 @@ from dateutil.tz import tzoffset
 from nose.tools import raises, assert_raises
 from testconfig import config
 
+from sharpy.asynchronous import AsyncClient
 from sharpy.client import Client
 from sharpy.exceptions import AccessDenied
 from sharpy.exceptions import BadRequest
@@ -100,6 +101,41 @@ class ClientTests(unittest.TestCase):
 
         self.assertEquals(response.status, 200)
 
+    def test_make_request_reuses_connection(self):
+        ''' Test consecutive requests share a pooled connection. '''
+        path = 'plans/get'
+        client = self.get_client()
+        client.make_request(path)
+        client.make_request(path)
+        stats = client.get_pool_stats()
+
+        self.assertEquals(1, stats['opens'])
+        self.assertEquals(1, stats['hits'])
+        self.assertEquals(1, stats['idle'])
+
+    def test_make_request_async(self):
+        ''' Test AsyncClient make_request_async method. '''
+        path = 'plans/get'
+        client = AsyncClient(**self.client_defaults)
+        results = [client.make_request_async(path) for i in range(3)]
+
+        for result in results:
+            self.assertEquals(200, result.get().status)
+        client.close()
+
+    @raises(NotFound)
+    def test_make_request_async_not_found(self):
+        ''' Test AsyncClient raises cheddar errors from get. '''
+        path = 'things-which-dont-exist'
+        client = AsyncClient(**self.client_defaults)
+        client.make_request_async(path).get()
+
+    def test_async_client_pool_size(self):
+        ''' Test AsyncClient allows one connection per worker. '''
+        client = AsyncClient(workers=25, **self.client_defaults)
+
+        self.assertEquals(25, client.pool.max_per_host)
+
     @raises(AccessDenied)
     def test_make_request_access_denied(self):
         ''' Test client make_request method with bad username. '''
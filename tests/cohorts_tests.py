@@ -0,0 +1,133 @@
+from datetime import date
+from StringIO import StringIO
+import unittest
+
+from sharpy import cohorts
+from sharpy.columnar import CustomerTables
+
+from testing_tools.fixtures import build_customers_xml
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class CohortsTests(unittest.TestCase):
+    '''
+    The fixture customers are c0 on TRACKED_MONTHLY and c1 on FREE_MONTHLY,
+    both signed up on 2011-01-10, and c2 on PAID_MONTHLY, signed up and
+    canceled (a PayPal preapproval is pending) on 2011-05-16.  c0 is
+    canceled here on 2011-03-05.
+    '''
+
+    def setUp(self):
+        self.tables = CustomerTables.from_xml(
+            StringIO(build_customers_xml()))
+        self.tables.subscriptions['canceled'][0] = numpy.datetime64(
+            '2011-03-05T12:00:00')
+
+    def months(self, series):
+        return [(str(month), value) for month, value in series]
+
+    def test_signup_cohorts(self):
+        ''' Test counting signups by month. '''
+        self.assertEquals(
+            [('2010-12', 0), ('2011-01', 2), ('2011-02', 0), ('2011-03', 0),
+             ('2011-04', 0), ('2011-05', 1)],
+            self.months(cohorts.signup_cohorts(
+                self.tables, date(2010, 12, 1), date(2011, 5, 1))))
+
+    def test_signup_cohorts_out_of_range(self):
+        ''' Test signups outside the months aren't counted. '''
+        self.assertEquals(
+            [('2011-02', 0), ('2011-03', 0)],
+            self.months(cohorts.signup_cohorts(
+                self.tables, date(2011, 2, 1), date(2011, 3, 31))))
+        self.assertEquals(
+            [('2010-12', 0), ('2011-01', 2)],
+            self.months(cohorts.signup_cohorts(
+                self.tables, date(2010, 12, 1), date(2011, 1, 1))))
+
+    def test_retention(self):
+        ''' Test retention curves of the monthly signup cohorts. '''
+        retention = cohorts.retention(self.tables, date(2011, 1, 1),
+                                      date(2011, 5, 1), ages=4,
+                                      at=date(2011, 6, 15))
+
+        self.assertEquals(['2011-01', '2011-02', '2011-03', '2011-04',
+                           '2011-05'], [str(month)
+                                        for month in retention.months])
+        self.assertEquals([2, 0, 0, 0, 1], list(retention.sizes))
+        self.assertEquals([2, 2, 1, 1], list(retention.retained[0]))
+        self.assertEquals([0, 0, 0, 0], list(retention.retained[4]))
+        self.assertEquals([1.0, 1.0, 0.5, 0.5], list(retention.rates[0]))
+        self.assertTrue(numpy.isnan(retention.rates[1]).all())
+        self.assertEquals(0.0, retention.rates[4, 0])
+        self.assertTrue(numpy.isnan(retention.rates[4, 1:]).all())
+
+    def test_churn_by_plan(self):
+        ''' Test churn rates by plan over a period. '''
+        self.assertEquals(
+            {'TRACKED_MONTHLY': 1.0, 'FREE_MONTHLY': 0.0,
+             'PAID_MONTHLY': 1.0},
+            cohorts.churn_by_plan(self.tables, date(2011, 1, 1),
+                                  date(2011, 6, 1)))
+        self.assertEquals(
+            {'FREE_MONTHLY': 0.0, 'PAID_MONTHLY': 1.0},
+            cohorts.churn_by_plan(self.tables, date(2011, 4, 1),
+                                  date(2011, 6, 1)))
+        self.assertEquals(
+            {'TRACKED_MONTHLY': 0.0, 'FREE_MONTHLY': 0.0},
+            cohorts.churn_by_plan(self.tables, date(2011, 1, 1),
+                                  date(2011, 3, 1)))
+
+    def test_churn_by_cancel_reason(self):
+        ''' Test churn broken down by cancel reason and type. '''
+        churn = cohorts.churn_by_cancel_reason(
+            self.tables, date(2011, 1, 1), date(2011, 6, 1))
+
+        self.assertEquals({'PayPal preapproval is pending': 1 / 3.0,
+                           None: 1 / 3.0}, churn)
+        self.assertEquals(
+            {'paypal-wait': 1 / 3.0, None: 1 / 3.0},
+            cohorts.churn_by_cancel_reason(
+                self.tables, date(2011, 1, 1), date(2011, 6, 1),
+                column='cancel_type'))
+        self.assertEquals({}, cohorts.churn_by_cancel_reason(
+            self.tables, date(2010, 1, 1), date(2010, 6, 1)))
+
+    def test_monthly_churn(self):
+        ''' Test the churn rate of each month. '''
+        self.assertEquals(
+            [('2010-12', None), ('2011-01', 0.0), ('2011-02', 0.0),
+             ('2011-03', 0.5), ('2011-04', 0.0), ('2011-05', 0.5),
+             ('2011-06', 0.0)],
+            self.months(cohorts.monthly_churn(
+                self.tables, date(2010, 12, 1), date(2011, 6, 1))))
+
+    def test_trial_conversion(self):
+        ''' Test the share of ended trials which converted. '''
+        trial_days = self.tables.plans['trial_days']
+        trial_days[:] = [30, 0, 14]
+
+        self.assertEquals({}, cohorts.trial_conversion(
+            self.tables, date(2011, 2, 1)))
+        self.assertEquals({'TRACKED_MONTHLY': 1.0, 'PAID_MONTHLY': 0.0},
+                          cohorts.trial_conversion(self.tables,
+                                                   date(2011, 7, 1)))
+
+    def test_empty(self):
+        ''' Test analysing tables without customers. '''
+        tables = CustomerTables.from_data([])
+        retention = cohorts.retention(tables, date(2011, 1, 1),
+                                      date(2011, 2, 1), ages=3)
+
+        self.assertEquals([0, 0], list(retention.sizes))
+        self.assertEquals({}, cohorts.churn_by_plan(tables, date(2011, 1, 1)))
+        self.assertEquals({}, cohorts.trial_conversion(tables))
+        self.assertEquals([None], [rate for month, rate in
+                                   cohorts.monthly_churn(tables,
+                                                         date(2011, 1, 1),
+                                                         date(2011, 1, 1))])
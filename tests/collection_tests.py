@@ -0,0 +1,182 @@
+from datetime import datetime
+import gc
+import unittest
+
+from dateutil.tz import tzoffset, tzutc
+from nose.tools import raises
+
+from sharpy.collection import CustomerCollection, SortedIndex
+from sharpy.parsers import CustomersParser
+from sharpy.product import CheddarProduct, Customer
+
+from testing_tools.fixtures import FakeClient, load_file
+
+
+class SortedIndexTests(unittest.TestCase):
+
+    def test_between(self):
+        ''' Test range queries on a sorted index. '''
+        index = SortedIndex()
+        for value, code in [(3, 'c'), (1, 'a'), (2, 'b'), (2, 'x'),
+                            (None, 'n')]:
+            index.add(value, code)
+
+        self.assertEquals(4, len(index))
+        self.assertEquals(['a', 'b', 'x', 'c'], index.between())
+        self.assertEquals(['b', 'x'], index.between(2, 3))
+        self.assertEquals(['b', 'x', 'c'], index.between(start=2))
+        self.assertEquals(['a'], index.between(end=2))
+
+    def test_remove(self):
+        ''' Test removing entries from a sorted index. '''
+        index = SortedIndex()
+        index.add(1, 'a')
+        index.add(1, 'b')
+
+        index.remove(1, 'a')
+        index.remove(1, 'missing')
+        index.remove(None, 'a')
+
+        self.assertEquals(['b'], index.between())
+
+
+class CustomerCollectionTests(unittest.TestCase):
+    files = ('customers-with-items.xml', 'customers-without-items.xml',
+             'paypal_customer.xml')
+
+    def setUp(self):
+        self.product = CheddarProduct('user', 'password', 'PRODUCT')
+        self.customers = []
+        parser = CustomersParser()
+        for n, filename in enumerate(self.files):
+            customer_data = parser.parse_xml(load_file(filename))[0]
+            customer_data['code'] = 'c%d' % n
+            customer_data['email'] = 'c%d@example.com' % n
+            customer = Customer(product=self.product, **customer_data)
+            self.customers.append(customer)
+        self.collection = CustomerCollection(self.customers, self.product)
+
+    def codes(self, customers):
+        return [customer.code for customer in customers]
+
+    def test_list_behaviour(self):
+        ''' Test a collection reads like the list it was built from. '''
+        self.assertEquals(3, len(self.collection))
+        self.assertEquals(self.customers, list(self.collection))
+        self.assertEquals(self.customers[1], self.collection[1])
+        self.assertEquals(self.customers, self.collection)
+        self.assertTrue('c1' in self.collection)
+        self.assertTrue(self.customers[2] in self.collection)
+        self.assertFalse('missing' in self.collection)
+
+    def test_hash_indexes(self):
+        ''' Test looking customers up by indexed fields. '''
+        self.assertTrue(self.collection.get('c1') is self.customers[1])
+        self.assertEquals(None, self.collection.get('missing'))
+        self.assertEquals(['c1'], self.codes(
+            self.collection.find_by_email('c1@example.com')))
+        self.assertEquals(['c2'], self.codes(
+            self.collection.find_by_plan('PAID_MONTHLY')))
+        self.assertEquals([], self.collection.find_by_plan('MISSING'))
+        self.assertEquals(['c0', 'c1'], self.codes(
+            self.collection.find_by_status('active')))
+        self.assertEquals(['c2'], self.codes(
+            self.collection.find_by_status('canceled')))
+
+    def test_meta_data_index(self):
+        ''' Test looking customers up by meta data. '''
+        self.customers[0].meta_data = {'tier': 'gold'}
+        self.customers[1].meta_data = {'tier': 'silver'}
+        self.collection.reindex(self.customers[0])
+        self.collection.reindex(self.customers[1])
+
+        self.assertEquals(['c0', 'c1'], self.codes(
+            self.collection.find_by_meta_data('tier')))
+        self.assertEquals(['c1'], self.codes(
+            self.collection.find_by_meta_data('tier', 'silver')))
+
+    @raises(ValueError)
+    def test_unknown_status(self):
+        ''' Test looking up an unknown status is refused. '''
+        self.collection.find_by_status('paused')
+
+    def test_sorted_indexes(self):
+        ''' Test range queries over customer datetimes. '''
+        utc = tzutc()
+        self.assertEquals(['c1', 'c0', 'c2'], self.codes(
+            self.collection.created_between()))
+        self.assertEquals(['c0'], self.codes(self.collection.created_between(
+            datetime(2011, 1, 10, 12, tzinfo=utc),
+            datetime(2011, 2, 1, tzinfo=utc))))
+        self.assertEquals(['c2'], self.codes(
+            self.collection.modified_between(
+                start=datetime(2011, 3, 1, tzinfo=utc))))
+        self.assertEquals(['c2'], self.codes(
+            self.collection.canceled_between()))
+
+    def test_sorted_indexes_naive_bounds(self):
+        ''' Test naive range query bounds are taken to be UTC. '''
+        self.assertEquals(['c0'], self.codes(self.collection.created_between(
+            datetime(2011, 1, 10, 12), datetime(2011, 2, 1))))
+        self.assertEquals(['c0'], self.codes(self.collection.created_between(
+            datetime(2011, 1, 10, 12),
+            datetime(2011, 1, 31, 19, tzinfo=tzoffset(None, -18000)))))
+        self.assertEquals(['c2'], self.codes(
+            self.collection.modified_between(start=datetime(2011, 3, 1))))
+        self.assertEquals(['c2'], self.codes(
+            self.collection.canceled_between(end=datetime(2100, 1, 1))))
+
+    def test_add_and_remove(self):
+        ''' Test adding, replacing and removing customers. '''
+        replacement = self.customers[0]
+        self.collection.remove('c0')
+
+        self.assertEquals(['c1', 'c2'], self.codes(self.collection))
+        self.assertEquals([], self.collection.find_by_email('c0@example.com'))
+        self.assertEquals(['c1', 'c2'], self.codes(
+            self.collection.created_between()))
+
+        self.collection.add(replacement)
+        self.collection.add(replacement)
+
+        self.assertEquals(['c1', 'c2', 'c0'], self.codes(self.collection))
+        self.assertEquals(['c0'], self.codes(
+            self.collection.find_by_plan('TRACKED_MONTHLY')))
+
+    def test_reindex_after_mutation(self):
+        ''' Test the indexes follow a customer reloaded after a change. '''
+        customer = self.customers[2]
+        content = load_file('customers-with-items.xml')
+        self.product.client = FakeClient(content.replace(
+            'code="test"', 'code="c2"', 1))
+
+        customer.charge('CHARGE', 10)
+
+        self.assertEquals(1, len(self.product.client.requests))
+        self.assertEquals('garbage@saaspire.com', customer.email)
+        self.assertEquals([], self.collection.find_by_email('c2@example.com'))
+        self.assertEquals(['c2'], self.codes(
+            self.collection.find_by_email('garbage@saaspire.com')))
+        self.assertEquals([], self.collection.find_by_plan('PAID_MONTHLY'))
+        self.assertEquals(['c0', 'c2'], self.codes(
+            self.collection.find_by_plan('TRACKED_MONTHLY')))
+        self.assertEquals(['c0', 'c1', 'c2'], self.codes(
+            self.collection.find_by_status('active')))
+        self.assertEquals([], self.collection.canceled_between())
+
+    def test_collections_are_released(self):
+        ''' Test a product doesn't keep unused collections alive. '''
+        del self.collection
+        gc.collect()
+
+        self.assertEquals(0, len(self.product._collections))
+
+    def test_get_customers_indexed(self):
+        ''' Test get_customers can return an indexed collection. '''
+        self.product.client = FakeClient(load_file('paypal_customer.xml'))
+
+        customers = self.product.get_customers(indexed=True)
+
+        self.assertTrue(isinstance(customers, CustomerCollection))
+        self.assertEquals(['test'], self.codes(
+            customers.find_by_plan('PAID_MONTHLY')))
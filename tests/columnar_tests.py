@@ -0,0 +1,127 @@
+from datetime import datetime
+from decimal import Decimal
+from StringIO import StringIO
+import unittest
+
+from dateutil.tz import tzoffset
+
+from sharpy.columnar import Categories, CustomerTables, to_cents
+from sharpy.columnar import to_naive_utc
+from sharpy.parsers import CustomersParser
+
+from testing_tools.fixtures import build_customers_xml
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ConversionTests(unittest.TestCase):
+
+    def test_to_cents(self):
+        ''' Test amounts become whole cents, rounding half up. '''
+        self.assertEquals(1050, to_cents(Decimal('10.50')))
+        self.assertEquals(1, to_cents(Decimal('0.005')))
+        self.assertEquals(-250, to_cents(Decimal('-2.5')))
+        self.assertEquals(0, to_cents(None))
+
+    def test_to_naive_utc(self):
+        ''' Test aware datetimes become naive UTC datetimes. '''
+        value = datetime(2011, 1, 1, 6, tzinfo=tzoffset(None, 3600))
+
+        self.assertEquals(datetime(2011, 1, 1, 5), to_naive_utc(value))
+        self.assertEquals(None, to_naive_utc(None))
+
+    def test_categories(self):
+        ''' Test categories are numbered in order of appearance. '''
+        categories = Categories()
+
+        self.assertEquals([0, 1, 0, -1, -1],
+                          [categories.encode(value)
+                           for value in ['a', 'b', 'a', None, '']])
+        self.assertEquals(['a', 'b'], categories.values)
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class CustomerTablesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tables = CustomerTables.from_xml(
+            StringIO(build_customers_xml()))
+
+    def test_customers(self):
+        ''' Test the customers table. '''
+        customers = self.tables.customers
+
+        self.assertEquals(3, len(customers))
+        self.assertEquals(['c0', 'c1', 'c2'], list(customers['code']))
+        self.assertEquals(numpy.datetime64('2011-01-10T23:57:58'),
+                          customers['created'][0])
+
+    def test_subscriptions(self):
+        ''' Test the subscriptions table and plan codes. '''
+        subscriptions = self.tables.subscriptions
+
+        self.assertEquals([0, 1, 2], list(subscriptions['customer']))
+        self.assertEquals(['TRACKED_MONTHLY', 'FREE_MONTHLY', 'PAID_MONTHLY'],
+                          list(subscriptions.labels('plan')))
+        self.assertEquals(list(self.tables.plan_codes),
+                          list(self.tables.plans['code']))
+        canceled = subscriptions['canceled']
+        self.assertEquals([True, True, False],
+                          list(numpy.isnat(canceled)))
+        self.assertEquals(
+            [None, None, 'paypal-wait'],
+            list(subscriptions.labels('cancel_type')))
+
+    def test_plans(self):
+        ''' Test plan amounts are whole cents. '''
+        plans = self.tables.plans
+
+        self.assertEquals(numpy.int64, plans['recurring_charge_cents'].dtype)
+        self.assertEquals([1000, 0, 2000],
+                          list(plans['recurring_charge_cents']))
+        self.assertEquals([False, True, False], list(plans['is_free']))
+
+    def test_items(self):
+        ''' Test item usage rows. '''
+        items = self.tables.items
+
+        self.assertEquals([0, 0, 2, 2], list(items['customer']))
+        self.assertEquals(['MONTHLY_ITEM', 'ONCE_ITEM'] * 2,
+                          list(items.labels('item')))
+        self.assertEquals([3, 1, 0, 0], list(items['quantity']))
+        self.assertEquals([2, 0, 0, 0], list(items['quantity_included']))
+
+    def test_charges(self):
+        ''' Test charge rows. '''
+        charges = self.tables.charges
+
+        self.assertEquals([0, 0, 0, 1, 2], list(charges['customer']))
+        self.assertEquals([0, 0, 0, 1, 2], list(charges['invoice']))
+        self.assertEquals([1000, 1000, 1000, 0, 2000],
+                          list(charges['amount_cents']))
+        self.assertEquals(3000, charges['amount_cents'][
+            charges['customer'] == 0].sum())
+        self.assertEquals(
+            list(self.tables.invoices['billing'][charges['invoice']]),
+            list(charges['billing']))
+
+    def test_from_data(self):
+        ''' Test building tables from parsed customer dicts. '''
+        parser = CustomersParser()
+        customers_data = parser.parse_xml(build_customers_xml(['a', 'b']))
+
+        tables = CustomerTables.from_data(customers_data)
+
+        self.assertEquals(['a', 'b'], list(tables.customers['code']))
+        self.assertEquals(2, len(tables.plans))
+
+    def test_empty(self):
+        ''' Test building tables without customers. '''
+        tables = CustomerTables.from_data([])
+
+        self.assertEquals(0, len(tables.customers))
+        self.assertEquals(0, len(tables.charges))
+        self.assertEquals(numpy.int64, tables.charges['amount_cents'].dtype)
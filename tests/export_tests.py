@@ -0,0 +1,214 @@
+from collections import OrderedDict
+import csv
+import gzip
+import json
+import os
+import shutil
+from StringIO import StringIO
+import tempfile
+import unittest
+
+from nose.tools import raises
+
+from sharpy.export import CSV, CustomerExporter, EXPORT_COLUMNS
+from sharpy.parsers import CustomersParser
+from sharpy.product import CheddarProduct
+
+from testing_tools.fixtures import build_customers_xml, FakeClient
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt_after(customer_elements, count):
+    ''' Yields count customer elements, then fails like a dropped stream. '''
+    for n, customer_element in enumerate(customer_elements):
+        yield customer_element
+        if n + 1 == count:
+            raise Interrupted()
+
+
+class CustomerExporterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, exporter, table):
+        path = exporter.get_path(table)
+        if exporter.compress:
+            f = gzip.open(path, 'rb')
+        else:
+            f = open(path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def read_rows(self, exporter, table):
+        content = self.read(exporter, table)
+        if exporter.format == CSV:
+            return list(csv.DictReader(StringIO(content)))
+        return [json.loads(line) for line in content.splitlines()]
+
+    def test_ndjson(self):
+        ''' Test exporting every table as ndjson. '''
+        exporter = CustomerExporter(self.directory)
+
+        self.assertEquals(3, exporter.export_xml(
+            StringIO(build_customers_xml())))
+
+        customers = self.read_rows(exporter, 'customers')
+        self.assertEquals(['c0', 'c1', 'c2'],
+                          [row['code'] for row in customers])
+        first_line = self.read(exporter, 'customers').splitlines()[0]
+        self.assertEquals(list(EXPORT_COLUMNS['customers']),
+                          json.loads(first_line,
+                                     object_pairs_hook=OrderedDict).keys())
+        self.assertEquals('2011-01-10T23:57:58Z', customers[0]['created'])
+        subscriptions = self.read_rows(exporter, 'subscriptions')
+        self.assertEquals(['TRACKED_MONTHLY', 'FREE_MONTHLY',
+                           'PAID_MONTHLY'],
+                          [row['plan_code'] for row in subscriptions])
+        self.assertEquals(None, subscriptions[0]['canceled'])
+        items = self.read_rows(exporter, 'items')
+        self.assertEquals([('c0', 'MONTHLY_ITEM', '3', '2'),
+                           ('c0', 'ONCE_ITEM', '1', '0'),
+                           ('c2', 'MONTHLY_ITEM', '0', '0'),
+                           ('c2', 'ONCE_ITEM', '0', '0')],
+                          [(row['customer_code'], row['code'],
+                            row['quantity'], row['quantity_included'])
+                           for row in items])
+        charges = self.read_rows(exporter, 'charges')
+        self.assertEquals(5, len(charges))
+        self.assertEquals('c0', charges[0]['customer_code'])
+        invoices = self.read_rows(exporter, 'invoices')
+        self.assertEquals(set(row['id'] for row in invoices),
+                          set(row['invoice_id'] for row in charges))
+
+        checkpoint = exporter.get_checkpoint()
+        self.assertTrue(checkpoint['complete'])
+        self.assertEquals(3, checkpoint['count'])
+        self.assertEquals('c2', checkpoint['last_code'])
+
+    def test_csv(self):
+        ''' Test exporting as csv with a header row. '''
+        exporter = CustomerExporter(self.directory, format=CSV,
+                                    tables=['customers', 'subscriptions'])
+
+        exporter.export_xml(StringIO(build_customers_xml()))
+
+        content = self.read(exporter, 'customers')
+        self.assertEquals(','.join(EXPORT_COLUMNS['customers']),
+                          content.splitlines()[0])
+        subscriptions = self.read_rows(exporter, 'subscriptions')
+        self.assertEquals(['', '', '2011-05-16T16:36:01Z'],
+                          [row['canceled'] for row in subscriptions])
+        self.assertFalse(os.path.exists(exporter.get_path('charges')))
+
+    def test_gzip(self):
+        ''' Test compressed files hold the same rows. '''
+        plain = CustomerExporter(os.path.join(self.directory, 'plain'))
+        compressed = CustomerExporter(os.path.join(self.directory, 'gz'),
+                                      compress=True, checkpoint_every=1)
+
+        plain.export_xml(StringIO(build_customers_xml()))
+        compressed.export_xml(StringIO(build_customers_xml()))
+
+        self.assertTrue(compressed.get_path('charges').endswith(
+            'charges.ndjson.gz'))
+        for table in EXPORT_COLUMNS:
+            self.assertEquals(self.read(plain, table),
+                              self.read(compressed, table))
+
+    def test_export_product(self):
+        ''' Test exporting customers streamed from cheddar. '''
+        product = CheddarProduct('user', 'password', 'PRODUCT')
+        product.client = FakeClient(build_customers_xml())
+        exporter = CustomerExporter(self.directory)
+
+        self.assertEquals(3, exporter.export_product(product))
+        self.assertEquals(3, len(self.read_rows(exporter, 'customers')))
+
+    def check_resume(self, **options):
+        expected = CustomerExporter(os.path.join(self.directory, 'expected'),
+                                    **options)
+        expected.export_xml(StringIO(build_customers_xml()))
+        exporter = CustomerExporter(os.path.join(self.directory, 'resumed'),
+                                    checkpoint_every=2, **options)
+        parser = CustomersParser()
+
+        # c2 is written after the checkpoint at c1, then the stream fails
+        elements = parser.iter_elements(StringIO(build_customers_xml()))
+        self.assertRaises(Interrupted, exporter.export_elements,
+                          interrupt_after(elements, 3), parser)
+
+        checkpoint = exporter.get_checkpoint()
+        self.assertFalse(checkpoint['complete'])
+        self.assertEquals('c1', checkpoint['last_code'])
+
+        self.assertEquals(1, exporter.export_xml(
+            StringIO(build_customers_xml())))
+
+        self.assertEquals(3, exporter.get_checkpoint()['count'])
+        for table in EXPORT_COLUMNS:
+            self.assertEquals(self.read(expected, table),
+                              self.read(exporter, table))
+
+    def test_resume(self):
+        ''' Test an interrupted export carries on from its checkpoint. '''
+        self.check_resume()
+
+    def test_resume_csv_gzip(self):
+        ''' Test resuming a compressed csv export. '''
+        self.check_resume(format=CSV, compress=True)
+
+    def test_restart(self):
+        ''' Test a finished export, or resume=False, starts afresh. '''
+        exporter = CustomerExporter(self.directory)
+        exporter.export_xml(StringIO(build_customers_xml()))
+
+        self.assertEquals(3, exporter.export_xml(
+            StringIO(build_customers_xml())))
+        self.assertEquals(3, len(self.read_rows(exporter, 'customers')))
+
+        exporter.checkpoint_every = 1
+        parser = CustomersParser()
+        elements = parser.iter_elements(StringIO(build_customers_xml()))
+        self.assertRaises(Interrupted, exporter.export_elements,
+                          interrupt_after(elements, 1), parser)
+
+        self.assertEquals(3, exporter.export_xml(
+            StringIO(build_customers_xml()), resume=False))
+        self.assertEquals(3, len(self.read_rows(exporter, 'customers')))
+
+    @raises(ValueError)
+    def test_resume_with_other_settings(self):
+        ''' Test resuming with a different format is refused. '''
+        exporter = CustomerExporter(self.directory, checkpoint_every=1)
+        parser = CustomersParser()
+        elements = parser.iter_elements(StringIO(build_customers_xml()))
+        self.assertRaises(Interrupted, exporter.export_elements,
+                          interrupt_after(elements, 1), parser)
+
+        CustomerExporter(self.directory, format=CSV).export_xml(
+            StringIO(build_customers_xml()))
+
+    @raises(ValueError)
+    def test_missing_checkpoint_customer(self):
+        ''' Test resuming against customers without the last one fails. '''
+        exporter = CustomerExporter(self.directory, checkpoint_every=1)
+        parser = CustomersParser()
+        elements = parser.iter_elements(StringIO(build_customers_xml()))
+        self.assertRaises(Interrupted, exporter.export_elements,
+                          interrupt_after(elements, 1), parser)
+
+        exporter.export_xml(StringIO(build_customers_xml(['x', 'y', 'z'])))
+
+    @raises(ValueError)
+    def test_unknown_format(self):
+        ''' Test an unknown format is refused. '''
+        CustomerExporter(self.directory, format='xml')
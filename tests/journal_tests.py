@@ -0,0 +1,373 @@
+from decimal import Decimal
+import os
+import shutil
+import socket
+import sqlite3
+import tempfile
+import unittest
+
+from nose.tools import raises
+
+from sharpy.breaker import CircuitBreaker
+from sharpy.breaker import CircuitOpen
+from sharpy.client import Client
+from sharpy.exceptions import NotFound
+from sharpy.journal import EntryClaimed
+from sharpy.journal import FileJournal
+from sharpy.journal import Journal
+from sharpy.journal import SQLiteJournal
+from sharpy.product import CheddarProduct
+
+from testing_tools.fixtures import FakeClient, get_cheddar_error
+
+
+class JournalTestsMixin(object):
+    ''' Tests every journal backend should pass. '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = self.get_journal()
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def reopen(self):
+        self.journal.close()
+        self.journal = self.get_journal()
+
+    def record(self, code='customer'):
+        return self.journal.record(
+            code, 'customers/add-charge', {'code': code},
+            {'chargeCode': 'CHARGE', 'eachAmount': Decimal('1.50'),
+             'description': u'caf\xe9'.encode('utf-8')})
+
+    def test_record(self):
+        ''' Test recorded entries are pending. '''
+        entry = self.record()
+        pending = self.journal.get_pending()
+
+        self.assertEquals([entry.id], [each.id for each in pending])
+        self.assertEquals(Journal.PENDING, pending[0].state)
+        self.assertEquals(u'customer', pending[0].customer_code)
+        self.assertEquals({u'code': u'customer'}, pending[0].params)
+        self.assertEquals([[u'chargeCode', u'CHARGE'],
+                           [u'description', u'caf\xe9'],
+                           [u'eachAmount', u'1.50']], pending[0].data)
+
+    def test_states(self):
+        ''' Test only entries which never completed are pending. '''
+        done = self.record()
+        failed = self.record()
+        sent = self.record()
+        pending = self.record()
+        self.journal.mark_sent(done.id)
+        self.journal.mark_done(done.id)
+        self.journal.mark_failed(failed.id, 'rejected')
+        self.journal.mark_sent(sent.id)
+
+        self.assertEquals([pending.id],
+                          [each.id for each in self.journal.get_pending()])
+        self.assertEquals([sent.id, pending.id], [
+            each.id for each in self.journal.get_pending(include_sent=True)])
+
+    def test_claim(self):
+        ''' Test an entry can only be claimed from the expected state. '''
+        entry = self.record()
+
+        self.assertTrue(self.journal.claim(entry.id))
+        self.assertFalse(self.journal.claim(entry.id))
+        self.assertEquals([Journal.SENT], [
+            each.state for each in self.journal.get_pending(True)])
+        self.assertTrue(self.journal.claim(entry.id, Journal.SENT, 1))
+
+        self.journal.release(entry.id)
+
+        self.assertEquals([entry.id],
+                          [each.id for each in self.journal.get_pending()])
+
+    def test_claim_from_sent(self):
+        ''' Test only one of two senders can claim a sent entry. '''
+        self.journal.claim(self.record().id)
+        entry, = self.journal.get_pending(include_sent=True)
+        self.reopen()
+
+        self.assertEquals(1, entry.claims)
+        self.assertTrue(self.journal.claim(entry.id, entry.state,
+                                           entry.claims))
+        self.assertFalse(self.journal.claim(entry.id, entry.state,
+                                            entry.claims))
+        self.assertEquals([2], [
+            each.claims for each in self.journal.get_pending(True)])
+
+    def test_entries_survive_reopening(self):
+        ''' Test entries are durable across journal instances. '''
+        first = self.record()
+        second = self.record()
+        self.journal.mark_done(first.id)
+        self.reopen()
+        third = self.record()
+
+        self.assertEquals([second.id, third.id],
+                          [each.id for each in self.journal.get_pending()])
+        self.assertTrue(third.id > second.id)
+
+
+class FileJournalTests(JournalTestsMixin, unittest.TestCase):
+
+    def get_journal(self):
+        return FileJournal(os.path.join(self.directory, 'journal'))
+
+    def test_partial_record_is_ignored(self):
+        ''' Test a record half written during a crash is skipped. '''
+        entry = self.record()
+        self.journal.close()
+        f = open(self.journal.path, 'ab')
+        f.write('{"id": 2, "entry": {"cust')
+        f.close()
+        self.journal = self.get_journal()
+        later = self.record()
+        self.reopen()
+
+        self.assertEquals([entry.id, later.id],
+                          [each.id for each in self.journal.get_pending()])
+
+    def test_compact(self):
+        ''' Test compacting keeps only the incomplete entries. '''
+        done = self.record()
+        pending = self.record()
+        self.journal.mark_done(done.id)
+        self.journal.compact()
+        self.reopen()
+
+        self.assertEquals([pending.id],
+                          [each.id for each in self.journal.get_pending()])
+        f = open(self.journal.path)
+        self.assertEquals(1, len(f.readlines()))
+        f.close()
+
+
+class SQLiteJournalTests(JournalTestsMixin, unittest.TestCase):
+
+    def get_journal(self):
+        return SQLiteJournal(os.path.join(self.directory, 'journal.db'))
+
+    def test_purge(self):
+        ''' Test purging completed entries leaves pending ones. '''
+        done = self.record()
+        pending = self.record()
+        self.journal.mark_done(done.id)
+        self.journal.purge()
+
+        count = self.journal._connection.execute(
+            'SELECT COUNT(*) FROM sharpy_journal').fetchone()[0]
+        self.assertEquals(1, count)
+        self.assertEquals([pending.id],
+                          [each.id for each in self.journal.get_pending()])
+
+    def test_claim_is_shared(self):
+        ''' Test only one connection's claim of an entry succeeds. '''
+        entry = self.record()
+        other = self.get_journal()
+        try:
+            self.assertTrue(other.claim(entry.id))
+            self.assertFalse(self.journal.claim(entry.id))
+            self.assertTrue(other.claim(entry.id, Journal.SENT, 1))
+            self.assertFalse(self.journal.claim(entry.id, Journal.SENT, 1))
+        finally:
+            other.close()
+
+    def test_old_database_is_upgraded(self):
+        ''' Test a journal created before claims were counted still works. '''
+        self.journal.close()
+        path = os.path.join(self.directory, 'old.db')
+        connection = sqlite3.connect(path)
+        connection.execute(
+            'CREATE TABLE sharpy_journal ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'customer_code TEXT NOT NULL, path TEXT NOT NULL, '
+            'params TEXT NOT NULL, data TEXT NOT NULL, method TEXT, '
+            'state TEXT NOT NULL, created REAL NOT NULL, error TEXT)')
+        connection.execute(
+            "INSERT INTO sharpy_journal (customer_code, path, params, data, "
+            "state, created) VALUES ('customer', 'customers/add-charge', "
+            "'{}', '[]', 'sent', 0)")
+        connection.commit()
+        connection.close()
+        self.journal = SQLiteJournal(path)
+
+        entry, = self.journal.get_pending(include_sent=True)
+
+        self.assertEquals(0, entry.claims)
+        self.assertTrue(self.journal.claim(entry.id, Journal.SENT, 0))
+
+
+class ProductJournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = FileJournal(os.path.join(self.directory, 'journal'))
+        self.product = self.get_product()
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def get_product(self, errors=None):
+        product = CheddarProduct('user', 'password', 'PRODUCT',
+                                 journal=self.journal)
+        product.client = FakeClient(errors=errors)
+        return product
+
+    def test_completed_requests_are_not_pending(self):
+        ''' Test a successful customer request is marked done. '''
+        self.product.make_customer_request(
+            'customer', 'customers/add-charge', {'code': 'customer'},
+            {'chargeCode': 'CHARGE', 'eachAmount': '1.00'})
+
+        self.assertEquals(1, len(self.product.client.requests))
+        self.assertEquals([], self.journal.get_pending(include_sent=True))
+
+    def test_rejected_requests_are_not_pending(self):
+        ''' Test a request cheddar rejects is marked failed. '''
+        product = self.get_product(errors={
+            'customers/add-charge': get_cheddar_error(NotFound, 404)})
+
+        self.assertRaises(NotFound, product.make_customer_request,
+                          'customer', 'customers/add-charge')
+        self.assertEquals([], self.journal.get_pending(include_sent=True))
+
+    def test_unknown_outcome_is_left_sent(self):
+        ''' Test a request whose outcome is unknown stays in the journal. '''
+        product = self.get_product(errors={
+            'customers/add-charge': socket.error('reset')})
+
+        self.assertRaises(socket.error, product.make_customer_request,
+                          'customer', 'customers/add-charge')
+        self.assertEquals([], self.journal.get_pending())
+        self.assertEquals([Journal.SENT], [
+            each.state for each in self.journal.get_pending(True)])
+
+    def test_queue_and_replay(self):
+        ''' Test queued requests are sent in order by replay_journal. '''
+        first = self.product.queue_customer_request(
+            'customer', 'customers/set-item-quantity',
+            {'code': 'customer', 'itemCode': 'ITEM'},
+            {'quantity': Decimal('2.0000')}, 'POST')
+        second = self.product.queue_customer_request(
+            'other', 'customers/add-charge', {'code': 'other'},
+            {'description': u'caf\xe9'})
+        self.assertEquals([], self.product.client.requests)
+
+        sent, errors = self.product.replay_journal(workers=2)
+
+        self.assertEquals({}, errors)
+        self.assertEquals(sorted([first.id, second.id]),
+                          sorted(entry.id for entry in sent))
+        self.assertEquals(sorted([
+            ('customers/add-charge', {u'code': u'other'},
+             [('description', u'caf\xe9'.encode('utf-8'))], None),
+            ('customers/set-item-quantity',
+             {u'code': u'customer', u'itemCode': u'ITEM'},
+             [('quantity', '2.0000')], u'POST'),
+        ]), sorted(self.product.client.requests))
+        self.assertEquals([], self.journal.get_pending(include_sent=True))
+
+    def test_refused_request_is_released(self):
+        ''' Test a request refused by an open breaker stays pending. '''
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        breaker.record_failure()
+        self.product.client = Client('user', 'password', 'PRODUCT',
+                                     endpoint='http://127.0.0.1:1/xml',
+                                     circuit_breaker=breaker)
+
+        self.assertRaises(CircuitOpen, self.product.make_customer_request,
+                          'customer', 'customers/add-charge')
+        self.assertEquals([Journal.PENDING], [
+            each.state for each in self.journal.get_pending(True)])
+
+        self.product.client = FakeClient()
+        sent, errors = self.product.replay_journal()
+
+        self.assertEquals(1, len(sent))
+        self.assertEquals(['customers/add-charge'],
+                          [request[0] for request in
+                           self.product.client.requests])
+
+    def test_refused_retry_is_left_sent(self):
+        ''' Test a request refused on a retry may have been sent. '''
+        error = CircuitOpen('Not sending request, cheddar is unavailable')
+        error.attempts = 2
+        self.product.client = FakeClient(
+            errors={'customers/add-charge': error})
+
+        self.assertRaises(CircuitOpen, self.product.make_customer_request,
+                          'customer', 'customers/add-charge')
+        self.assertEquals([Journal.SENT], [
+            each.state for each in self.journal.get_pending(True)])
+
+    def test_replays_share_entries(self):
+        ''' Test replays sharing a journal never send an entry twice. '''
+        path = os.path.join(self.directory, 'journal.db')
+        first = CheddarProduct('user', 'password', 'PRODUCT',
+                               journal=SQLiteJournal(path))
+        second = CheddarProduct('user', 'password', 'PRODUCT',
+                                journal=SQLiteJournal(path))
+        for name in ('first', 'second', 'third'):
+            first.queue_customer_request('customer', 'customers/' + name)
+        first.client = FakeClient()
+        second.client = FakeClient()
+        make_request = first.client.make_request
+
+        def replay_elsewhere(path, *args, **kwargs):
+            # The second product replays while the first request is out
+            second.replay_journal()
+            return make_request(path, *args, **kwargs)
+        first.client.make_request = replay_elsewhere
+
+        try:
+            sent, errors = first.replay_journal()
+        finally:
+            first.journal.close()
+            second.journal.close()
+
+        self.assertEquals({}, errors)
+        self.assertEquals(['customers/first'],
+                          [request[0] for request in first.client.requests])
+        self.assertEquals(['customers/second', 'customers/third'],
+                          [request[0] for request in second.client.requests])
+
+    @raises(EntryClaimed)
+    def test_claimed_entry_is_not_sent(self):
+        ''' Test sending an entry claimed elsewhere is refused. '''
+        entry = self.product.queue_customer_request(
+            'customer', 'customers/add-charge')
+        self.journal.claim(entry.id)
+
+        try:
+            self.product.send_customer_request(
+                'customer', 'customers/add-charge', entry=entry)
+        finally:
+            self.assertEquals([], self.product.client.requests)
+
+    def test_replay_stops_at_unknown_outcome(self):
+        ''' Test a customer's replay stops when an outcome is unknown. '''
+        self.product.queue_customer_request('customer', 'customers/first')
+        self.product.queue_customer_request('customer', 'customers/second')
+        product = self.get_product(errors={
+            'customers/first': socket.error('reset')})
+
+        sent, errors = product.replay_journal()
+
+        self.assertEquals([], sent)
+        self.assertEquals(1, len(errors))
+        self.assertEquals(['customers/first'],
+                          [request[0] for request in product.client.requests])
+        self.assertEquals(['customers/second'],
+                          [each.path for each in self.journal.get_pending()])
+
+    @raises(ValueError)
+    def test_queue_needs_journal(self):
+        ''' Test queueing a request without a journal fails. '''
+        product = CheddarProduct('user', 'password', 'PRODUCT')
+        product.queue_customer_request('customer', 'customers/add-charge')
@@ -0,0 +1,143 @@
+from decimal import Decimal
+import socket
+import time
+import unittest
+
+from nose.tools import raises
+
+from sharpy.exceptions import CheddarFailure
+from sharpy.exceptions import NotFound
+from sharpy.metering import UsageMeter
+
+from testing_tools.fixtures import get_cheddar_error
+
+
+class FakeProduct(object):
+    ''' Records the customer requests a meter makes. '''
+
+    def __init__(self, errors=None):
+        self.requests = []
+        self.errors = errors or {}
+
+    def make_customer_request(self, code, path, params=None, data=None,
+                              method=None):
+        error = self.errors.pop((code, params['itemCode']), None)
+        if error is not None:
+            raise error
+        self.requests.append((path, code, params['itemCode'],
+                              data['quantity']))
+
+
+class UsageMeterTests(unittest.TestCase):
+
+    def test_flush_sends_net_deltas(self):
+        ''' Test a flush sends one request per changed item. '''
+        product = FakeProduct()
+        meter = UsageMeter(product)
+        for n in range(10):
+            meter.increment('customer', 'ITEM')
+        meter.decrement('customer', 'ITEM', 3)
+        meter.decrement('customer', 'OTHER_ITEM', '0.5')
+        meter.increment('other', 'ITEM')
+        meter.decrement('other', 'ITEM')
+
+        self.assertEquals(2, meter.flush())
+        meter.close()
+
+        self.assertEquals(sorted([
+            ('customers/add-item-quantity', 'customer', 'ITEM',
+             Decimal('7.0000')),
+            ('customers/remove-item-quantity', 'customer', 'OTHER_ITEM',
+             Decimal('0.5000')),
+        ]), sorted(product.requests))
+        stats = meter.get_stats()
+        self.assertEquals(14, stats['events'])
+        self.assertEquals(2, stats['requests'])
+        self.assertEquals(0, stats['pending'])
+
+    def test_flush_with_nothing_pending(self):
+        ''' Test flushing an empty meter makes no requests. '''
+        product = FakeProduct()
+        meter = UsageMeter(product)
+
+        self.assertEquals(0, meter.flush())
+        self.assertEquals([], product.requests)
+
+    def test_close_flushes(self):
+        ''' Test closing the meter sends anything pending. '''
+        product = FakeProduct()
+        with UsageMeter(product, flush_interval=60) as meter:
+            meter.increment('customer', 'ITEM', 2)
+
+        self.assertEquals(1, len(product.requests))
+
+    @raises(ValueError)
+    def test_closed_meter(self):
+        ''' Test a closed meter doesn't accept more events. '''
+        meter = UsageMeter(FakeProduct())
+        meter.close()
+        meter.increment('customer', 'ITEM')
+
+    def test_max_pending_triggers_flush(self):
+        ''' Test reaching max_pending events flushes in the background. '''
+        product = FakeProduct()
+        meter = UsageMeter(product, max_pending=5, flush_interval=60)
+        for n in range(5):
+            meter.increment('customer', 'ITEM')
+
+        for n in range(500):
+            if product.requests:
+                break
+            time.sleep(0.01)
+        meter.close()
+
+        self.assertEquals([('customers/add-item-quantity', 'customer',
+                            'ITEM', Decimal('5.0000'))], product.requests)
+
+    def test_interval_triggers_flush(self):
+        ''' Test pending deltas are flushed every flush_interval. '''
+        product = FakeProduct()
+        meter = UsageMeter(product, flush_interval=0.01)
+        meter.increment('customer', 'ITEM')
+
+        for n in range(500):
+            if product.requests:
+                break
+            time.sleep(0.01)
+        meter.close()
+
+        self.assertEquals(1, len(product.requests))
+
+    def test_transient_failures_are_requeued(self):
+        ''' Test deltas which fail transiently are kept to retry. '''
+        product = FakeProduct(errors={
+            ('customer', 'ITEM'): socket.error('connection refused'),
+            ('other', 'ITEM'): get_cheddar_error(CheddarFailure, 500),
+        })
+        meter = UsageMeter(product, flush_interval=60)
+        meter.increment('customer', 'ITEM', 2)
+        meter.increment('other', 'ITEM')
+
+        meter.flush()
+        meter.increment('customer', 'ITEM')
+
+        self.assertEquals({('customer', 'ITEM'): Decimal(3),
+                           ('other', 'ITEM'): Decimal(1)},
+                          meter.get_pending())
+        self.assertEquals(2, meter.get_stats()['requeued'])
+        meter.close()
+        self.assertEquals(2, len(product.requests))
+
+    def test_rejected_deltas_are_dropped(self):
+        ''' Test deltas cheddar rejects are dropped. '''
+        product = FakeProduct(errors={
+            ('missing', 'ITEM'): get_cheddar_error(NotFound, 404),
+        })
+        meter = UsageMeter(product, flush_interval=60)
+        meter.increment('missing', 'ITEM')
+
+        meter.flush()
+
+        self.assertEquals({}, meter.get_pending())
+        self.assertEquals(1, meter.get_stats()['failed'])
+        meter.close()
@@ -0,0 +1,210 @@
+from datetime import date, datetime
+from decimal import Decimal
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from dateutil.tz import tzoffset
+from nose.tools import raises
+
+from sharpy.mirror import CustomerMirror
+from sharpy.product import CheddarProduct
+
+from testing_tools.fixtures import build_customers_xml, FakeClient
+
+
+class CustomerMirrorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.product = CheddarProduct('user', 'password', 'PRODUCT')
+        self.product.client = FakeClient(build_customers_xml())
+        self.mirror = CustomerMirror(
+            self.product, os.path.join(self.directory, 'mirror.db'))
+
+    def tearDown(self):
+        self.mirror.close()
+        shutil.rmtree(self.directory)
+
+    def test_sync(self):
+        ''' Test a sync stores every customer. '''
+        self.assertEquals(None, self.mirror.get_last_sync())
+
+        self.assertEquals(3, self.mirror.sync())
+
+        self.assertEquals(['c0', 'c1', 'c2'],
+                          [row['code'] for row in
+                           self.mirror.find_customers()])
+        self.assertTrue(isinstance(self.mirror.get_last_sync(), datetime))
+        rows = self.mirror.query('SELECT code, quantity, quantity_included '
+                                 'FROM items WHERE customer_code = ? '
+                                 'ORDER BY code', ('c0',))
+        self.assertEquals([('MONTHLY_ITEM', Decimal(3), Decimal(2)),
+                           ('ONCE_ITEM', Decimal(1), Decimal(0))],
+                          [tuple(row) for row in rows])
+
+    def test_summary_rows(self):
+        ''' Test summary rows decode dates and datetimes. '''
+        self.mirror.sync()
+
+        row = self.mirror.find_customers(code='c0')[0]
+
+        self.assertEquals('TRACKED_MONTHLY', row['plan_code'])
+        self.assertEquals(date(2011, 7, 31), row['cc_expiration_date'])
+        self.assertEquals(datetime(2011, 1, 10, 23, 57, 58), row['created'])
+        self.assertEquals(None, row['canceled'])
+
+    def test_filters(self):
+        ''' Test filtering mirrored customers. '''
+        self.mirror.sync()
+
+        def codes(**filters):
+            return [row['code']
+                    for row in self.mirror.find_customers(**filters)]
+
+        self.assertEquals(['c2'], codes(plan_code='PAID_MONTHLY'))
+        self.assertEquals(['c1', 'c2'],
+                          codes(plan_code=['FREE_MONTHLY', 'PAID_MONTHLY']))
+        self.assertEquals(['c2'], codes(canceled=True))
+        self.assertEquals(['c0', 'c1'], codes(canceled=False))
+        self.assertEquals(['c0'],
+                          codes(card_expires_before=date(2011, 12, 31)))
+        self.assertEquals(['c2'],
+                          codes(card_expires_after=date(2012, 1, 1)))
+        self.assertEquals(['c0'], codes(item_code='MONTHLY_ITEM'))
+        self.assertEquals(['c2'], codes(
+            created_after=datetime(2011, 5, 16, 10, 0, 0,
+                                   tzinfo=tzoffset(None, -6 * 3600))))
+        self.assertEquals(['c1', 'c0'], codes(
+            created_before=datetime(2011, 2, 1), order_by='c.created'))
+        self.assertEquals(2, self.mirror.count_customers(canceled=False))
+        self.assertEquals(1, len(self.mirror.find_customers(limit=1)))
+
+    def test_get_customers(self):
+        ''' Test customers rebuilt from the mirror match cheddar's. '''
+        self.mirror.sync()
+        expected = dict((customer.code, customer)
+                        for customer in self.product.iter_customers())
+
+        customers = self.mirror.get_customers()
+
+        self.assertEquals(['c0', 'c1', 'c2'],
+                          [customer.code for customer in customers])
+        for customer in customers:
+            expected_customer = expected[customer.code]
+            self.assertTrue(customer.product is self.product)
+            self.assertEquals(expected_customer.email, customer.email)
+            self.assertEquals(expected_customer.subscription.plan.code,
+                              customer.subscription.plan.code)
+            self.assertEquals(expected_customer.subscription.invoices,
+                              list(customer.subscription.invoices))
+
+    def test_get_customer(self):
+        ''' Test getting one mirrored customer by code. '''
+        self.mirror.sync()
+
+        customer = self.mirror.get_customer('c0')
+
+        self.assertEquals('c0', customer.code)
+        self.assertEquals(Decimal(1),
+                          customer.subscription.items['ONCE_ITEM'].
+                          quantity_used)
+        self.assertEquals(None, self.mirror.get_customer('missing'))
+
+    def test_full_sync_prunes(self):
+        ''' Test a full sync removes customers cheddar no longer has. '''
+        self.mirror.sync()
+        self.product.client.content = build_customers_xml(['c0', 'c1'])
+
+        self.assertEquals(2, self.mirror.sync())
+
+        self.assertEquals(['c0', 'c1'],
+                          [row['code'] for row in
+                           self.mirror.find_customers()])
+        self.assertEquals([], self.mirror.query(
+            'SELECT * FROM invoices WHERE customer_code = ?', ('c2',)))
+
+    def test_filtered_sync_replaces(self):
+        ''' Test a filtered sync only replaces the customers it fetched. '''
+        self.mirror.sync()
+        content = build_customers_xml(['c0'])
+        self.product.client.content = content.replace(
+            '<quantity>3</quantity>', '<quantity>5</quantity>')
+
+        self.assertEquals(1,
+                          self.mirror.sync(plan_codes=['TRACKED_MONTHLY']))
+
+        self.assertEquals(3, self.mirror.count_customers())
+        rows = self.mirror.query('SELECT quantity FROM items '
+                                 'WHERE customer_code = ? AND code = ?',
+                                 ('c0', 'MONTHLY_ITEM'))
+        self.assertEquals([Decimal(5)], [row[0] for row in rows])
+        charges = self.mirror.query('SELECT COUNT(*) FROM charges '
+                                    'WHERE customer_code = ?', ('c0',))
+        self.assertEquals(3, charges[0][0])
+
+    def test_sync_without_customers(self):
+        ''' Test syncing an account with no customers empties the mirror. '''
+        self.mirror.sync()
+        self.product.client.content = None
+
+        self.assertEquals(0, self.mirror.sync())
+        self.assertEquals(0, self.mirror.count_customers())
+
+    @raises(ValueError)
+    def test_filtered_sync_cant_prune(self):
+        ''' Test pruning a filtered sync is refused. '''
+        self.mirror.sync(prune=True, plan_codes=['FREE_MONTHLY'])
+
+    def test_mirror_persists(self):
+        ''' Test a mirror can be reopened. '''
+        self.mirror.sync()
+        self.mirror.close()
+
+        self.mirror = CustomerMirror(
+            self.product, os.path.join(self.directory, 'mirror.db'))
+
+        self.assertEquals(3, self.mirror.count_customers())
+
+    def test_no_global_decimal_adapter(self):
+        ''' Test the mirror leaves sqlite3's Decimal handling alone. '''
+        self.mirror.sync()
+
+        self.assertFalse((Decimal, sqlite3.PrepareProtocol) in
+                         sqlite3.adapters)
+        self.assertFalse('DECIMAL' in sqlite3.converters)
+        rows = self.mirror.query('SELECT each_amount FROM charges '
+                                 'WHERE customer_code = ?', ('c0',))
+        self.assertEquals([Decimal('10.00')] * 3, [row[0] for row in rows])
+
+    def test_reads_during_sync(self):
+        ''' Test reads don't wait for a sync to finish downloading. '''
+        self.mirror.sync()
+        iter_customer_elements = self.product.iter_customer_elements
+        downloading = threading.Event()
+        release = threading.Event()
+        counts = []
+
+        def slow_iter_customer_elements(*args, **kwargs):
+            for element in iter_customer_elements(*args, **kwargs):
+                yield element
+                downloading.set()
+                release.wait()
+        self.product.iter_customer_elements = slow_iter_customer_elements
+
+        sync = threading.Thread(target=self.mirror.sync)
+        sync.start()
+        try:
+            downloading.wait()
+            reader = threading.Thread(
+                target=lambda: counts.append(self.mirror.count_customers()))
+            reader.start()
+            reader.join(5)
+        finally:
+            release.set()
+            sync.join()
+
+        self.assertEquals([3], counts)
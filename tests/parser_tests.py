@@ -1,17 +1,40 @@
-from datetime import datetime
+import cPickle as pickle
+from datetime import datetime, timedelta
 from decimal import Decimal
 import os
+from StringIO import StringIO
 import unittest
 
-from dateutil.tz import tzutc
+from dateutil.tz import tzoffset, tzutc
 from nose.tools import raises
 
 from sharpy.exceptions import ParseError
 from sharpy.parsers import CheddarOutputParser
+from sharpy.parsers import LazyElementList
 from sharpy.parsers import parse_error
 from sharpy.parsers import PlansParser
 from sharpy.parsers import CustomersParser
+from sharpy.parsers import dump_compact
+from sharpy.parsers import load_compact
 from sharpy.parsers import PromotionsParser
+from sharpy.parsers import split_customers_xml
+from sharpy.product import CheddarProduct
+from sharpy.product import Customer
+from sharpy.product import PricingPlan
+from sharpy.product import Promotion
+from sharpy.product import REFRESH_LAZY, REFRESH_NONE
+
+from testing_tools.fixtures import build_customers_xml
+
+
+class ShoutingCustomersParser(CustomersParser):
+    ''' A parser subclass, which parallel parsing should run in workers. '''
+
+    def parse_customer(self, customer_element):
+        customer = super(ShoutingCustomersParser, self).parse_customer(
+            customer_element)
+        customer['code'] = customer['code'].upper()
+        return customer
 
 
 class ParserTests(unittest.TestCase):
@@ -108,6 +131,17 @@ class ParserTests(unittest.TestCase):
 
         self.assertEquals(expected, result)
 
+    def test_decimal_parsing_memo(self):
+        ''' Test repeated decimal strings share one Decimal. '''
+        parser = CheddarOutputParser()
+
+        first = parser.parse_decimal('7.50')
+        second = CheddarOutputParser().parse_decimal('7.50')
+
+        self.assertTrue(first is second)
+        self.assertEquals('7.50', str(parser.parse_decimal('7.50')))
+        self.assertEquals('7.5', str(parser.parse_decimal('7.5')))
+
     def test_datetime_parsing(self):
         ''' Test datetime parsing. '''
         parser = CheddarOutputParser()
@@ -132,6 +166,63 @@ class ParserTests(unittest.TestCase):
 
         parser.parse_datetime('test')
 
+    def test_datetime_parsing_zulu(self):
+        ''' Test datetime parsing with a Z timezone. '''
+        parser = CheddarOutputParser()
+
+        expected = datetime(2011, 1, 7, 20, 46, 43, tzinfo=tzutc())
+        result = parser.parse_datetime('2011-01-07T20:46:43Z')
+
+        self.assertEquals(expected, result)
+        self.assertEquals(tzutc(), result.tzinfo)
+
+    def test_datetime_parsing_offset(self):
+        ''' Test datetime parsing with a non-UTC offset. '''
+        parser = CheddarOutputParser()
+
+        expected = datetime(2011, 1, 7, 20, 46, 43,
+                            tzinfo=tzoffset(None, -10800))
+        result = parser.parse_datetime('2011-01-07T20:46:43-03:00')
+
+        self.assertEquals(expected, result)
+        self.assertEquals(timedelta(hours=-3), result.utcoffset())
+
+    def test_datetime_parsing_naive(self):
+        ''' Test datetime parsing without a timezone. '''
+        parser = CheddarOutputParser()
+
+        expected = datetime(2011, 1, 7, 20, 46, 43)
+        result = parser.parse_datetime('2011-01-07T20:46:43')
+
+        self.assertEquals(expected, result)
+        self.assertEquals(None, result.tzinfo)
+
+    def test_datetime_parsing_fallback(self):
+        ''' Test datetime parsing of a non-ISO format. '''
+        parser = CheddarOutputParser()
+
+        expected = datetime(2011, 1, 7, 20, 46, 43)
+        result = parser.parse_datetime('Jan 7 2011 20:46:43')
+
+        self.assertEquals(expected, result)
+
+    def test_datetime_parsing_memo(self):
+        ''' Test repeated datetimes are only parsed once. '''
+        parser = CheddarOutputParser()
+
+        first = parser.parse_datetime('2011-01-07T20:46:43+00:00')
+        second = CheddarOutputParser().parse_datetime(
+            '2011-01-07T20:46:43+00:00')
+
+        self.assertTrue(first is second)
+
+    @raises(ParseError)
+    def test_datetime_parsing_out_of_range(self):
+        ''' Test datetime parsing with an impossible date. '''
+        parser = CheddarOutputParser()
+
+        parser.parse_datetime('2011-13-07T20:46:43+00:00')
+
     def test_datetime_parsing_empty(self):
         ''' Test datetime parsing with empty string. '''
         parser = CheddarOutputParser()
@@ -819,3 +910,363 @@ class ParserTests(unittest.TestCase):
         pp = pprint.PrettyPrinter(indent=4)
         pp.pprint(result)
         self.assertEquals(expected, result)
+
+    def assert_iter_parse_matches(self, filename):
+        ''' Helper method comparing streamed and whole document parsing. '''
+        path = os.path.join(os.path.dirname(__file__), 'files', filename)
+        parser = CustomersParser()
+
+        expected = parser.parse_xml(self.load_file(filename))
+        f = open(path)
+        result = list(parser.iter_parse(f))
+        f.close()
+
+        self.assertEquals(expected, result)
+
+    def test_customers_iter_parse_with_no_items(self):
+        ''' Test streaming customer parser without items. '''
+        self.assert_iter_parse_matches('customers-without-items.xml')
+
+    def test_customers_iter_parse_with_items(self):
+        ''' Test streaming customer parser with items. '''
+        self.assert_iter_parse_matches('customers-with-items.xml')
+
+    def test_customers_iter_parse_paypal(self):
+        ''' Test streaming customer parser with paypal customer. '''
+        self.assert_iter_parse_matches('paypal_customer.xml')
+
+    def test_customers_iter_parse_is_lazy(self):
+        ''' Test streaming customer parser yields as it goes. '''
+        parser = CustomersParser()
+        content = StringIO(self.load_file('customers-with-items.xml'))
+        customers = parser.iter_parse(content)
+
+        customer = customers.next()
+
+        self.assertEquals('test', customer['code'])
+        self.assertRaises(StopIteration, customers.next)
+
+    def test_split_customers_xml(self):
+        ''' Test splitting a customers document between customers. '''
+        parser = CustomersParser()
+        content = build_customers_xml()
+
+        for count in (2, 3, 50):
+            pieces = split_customers_xml(content, count)
+            codes = [[customer['code'] for customer in
+                      parser.parse_xml(piece)] for piece in pieces]
+
+            self.assertTrue(1 < len(pieces) <= count)
+            self.assertTrue(all(codes))
+            self.assertEquals(['c0', 'c1', 'c2'], sum(codes, []))
+            self.assertTrue(all(piece.startswith('<?xml')
+                                for piece in pieces))
+        self.assertEquals(3, len(split_customers_xml(content, 50)))
+        self.assertEquals([content], split_customers_xml(content, 1))
+        self.assertEquals(parser.parse_xml(content),
+                          sum([parser.parse_xml(piece) for piece in
+                               split_customers_xml(content, 2)], []))
+
+    def test_split_empty_customers_xml(self):
+        ''' Test splitting customers documents without customers. '''
+        self.assertEquals(['<customers/>'],
+                          split_customers_xml('<customers/>', 4))
+        self.assertEquals([], CustomersParser().parse_xml(
+            split_customers_xml('<customers>\n</customers>', 4)[0]))
+
+    def test_compact_round_trip(self):
+        ''' Test compactly pickled customers unpickle unchanged. '''
+        customers = CustomersParser().parse_xml(build_customers_xml())
+        decimals = {}
+
+        result = load_compact(dump_compact(customers), decimals)
+        again = load_compact(dump_compact(customers), decimals)
+
+        self.assertEquals(customers, result)
+        charge = result[0]['subscriptions'][0]['invoices'][0]['charges'][0]
+        other = again[0]['subscriptions'][0]['invoices'][0]['charges'][0]
+        self.assertEquals(Decimal('10.00'), charge['each_amount'])
+        self.assertTrue(charge['each_amount'] is other['each_amount'])
+
+    def test_customers_parse_xml_parallel(self):
+        ''' Test parsing across processes matches parsing in one. '''
+        parser = CustomersParser()
+        content = build_customers_xml()
+
+        expected = parser.parse_xml(content)
+        result = parser.parse_xml(content, processes=2)
+
+        self.assertEquals(expected, result)
+        self.assertEquals(expected, parser.parse_xml_parallel(
+            content, processes=2, chunks=2))
+
+    def test_customers_parse_xml_parallel_subclass(self):
+        ''' Test workers parse with the caller's parser class. '''
+        parser = ShoutingCustomersParser()
+
+        result = parser.parse_xml(build_customers_xml(), processes=2)
+
+        self.assertEquals(['C0', 'C1', 'C2'],
+                          [customer['code'] for customer in result])
+
+    @raises(ParseError)
+    def test_customers_parse_xml_parallel_error(self):
+        ''' Test parse errors in workers reach the caller. '''
+        content = build_customers_xml().replace(
+            '<isActive>1</isActive>', '<isActive>maybe</isActive>')
+
+        CustomersParser().parse_xml(content, processes=2)
+
+    def test_lazy_element_list(self):
+        ''' Test lazy element lists decode items on first access. '''
+        parser = CustomersParser()
+        content = self.load_file('customers-with-items.xml')
+        invoices_element = parser.parse_elements(content)[0].find(
+            'subscriptions/subscription/invoices')
+        calls = []
+
+        def parse_invoice(element):
+            calls.append(element)
+            return parser.parse_invoice(element)
+
+        invoices = LazyElementList(invoices_element, parse_invoice)
+
+        self.assertEquals(1, len(invoices))
+        self.assertEquals([], calls)
+        self.assertEquals(invoices[0], invoices[-1])
+        self.assertEquals(1, len(calls))
+        self.assertEquals(list(invoices), invoices[:])
+
+    def assert_lazy_customer_matches(self, filename):
+        product = CheddarProduct('user', 'password', 'PRODUCT')
+        parser = CustomersParser()
+        content = self.load_file(filename)
+        expected = Customer(product=product, **parser.parse_xml(content)[0])
+        element = parser.parse_elements(content)[0]
+
+        result = Customer.from_element(element, product, parser)
+
+        self.assertFalse(result.is_loaded('subscription'))
+        self.assertEquals(expected.code, result.code)
+        self.assertEquals(expected.meta_data, result.meta_data)
+        expected_sub = expected.subscription
+        result_sub = result.subscription
+        self.assertEquals(expected_sub.id, result_sub.id)
+        self.assertEquals(expected_sub.created, result_sub.created)
+        self.assertEquals(expected_sub.invoices, list(result_sub.invoices))
+        self.assertEquals(expected_sub.plan.code, result_sub.plan.code)
+        self.assertEquals(sorted(expected_sub.items.keys()),
+                          sorted(result_sub.items.keys()))
+        for code, item in expected_sub.items.items():
+            self.assertEquals(item.quantity_used,
+                              result_sub.items[code].quantity_used)
+            self.assertEquals(item.subscription, expected_sub)
+            self.assertEquals(result_sub.items[code].subscription, result_sub)
+
+    def test_lazy_customer_with_no_items(self):
+        ''' Test lazily decoded customer without items. '''
+        self.assert_lazy_customer_matches('customers-without-items.xml')
+
+    def test_lazy_customer_with_items(self):
+        ''' Test lazily decoded customer with items. '''
+        self.assert_lazy_customer_matches('customers-with-items.xml')
+
+    def test_lazy_customer_paypal(self):
+        ''' Test lazily decoded paypal customer. '''
+        self.assert_lazy_customer_matches('paypal_customer.xml')
+
+    def test_models_pickle(self):
+        ''' Test slotted models survive pickle protocols 0 and 2. '''
+        parser = CustomersParser()
+        content = self.load_file('customers-with-items.xml')
+        eager = Customer(product=None, **parser.parse_xml(content)[0])
+        eager.first_name = 'New'
+        lazy = Customer.from_element(parser.parse_elements(content)[0],
+                                     None, parser)
+        plan = PricingPlan(**PlansParser().parse_xml(
+            self.load_file('plans.xml'))[0])
+        promotion = Promotion(**PromotionsParser().parse_xml(
+            self.load_file('promotions.xml'))[0])
+
+        for protocol in (0, 2):
+            for customer in (eager, lazy):
+                result = pickle.loads(pickle.dumps(customer, protocol))
+                expected_sub = customer.subscription
+                result_sub = result.subscription
+                self.assertEquals(customer.code, result.code)
+                self.assertEquals(customer.first_name, result.first_name)
+                self.assertEquals(customer.get_changes(),
+                                  result.get_changes())
+                self.assertEquals(expected_sub.id, result_sub.id)
+                self.assertEquals(list(expected_sub.invoices),
+                                  list(result_sub.invoices))
+                self.assertEquals(expected_sub.plan.code,
+                                  result_sub.plan.code)
+                self.assertTrue(result_sub.customer is result)
+                for code, item in expected_sub.items.items():
+                    self.assertEquals(item.quantity_used,
+                                      result_sub.items[code].quantity_used)
+                    self.assertTrue(
+                        result_sub.items[code].subscription is result_sub)
+
+            result = pickle.loads(pickle.dumps(plan, protocol))
+            self.assertEquals(plan.code, result.code)
+            self.assertEquals(plan.items, result.items)
+            result = pickle.loads(pickle.dumps(promotion, protocol))
+            self.assertEquals(promotion.code, result.code)
+            self.assertEquals(promotion.coupons, result.coupons)
+
+    def get_refresh_customer(self, refresh=None):
+        # A customer whose product answers every request with the
+        # customers-with-items fixture, with its first name changed.
+        product = CheddarProduct('user', 'password', 'PRODUCT',
+                                 refresh=refresh)
+        parser = CustomersParser()
+        content = self.load_file('customers-with-items.xml')
+        customer = Customer(product=product, **parser.parse_xml(content)[0])
+        customer.first_name = 'Old'
+        customer.clear_changes()
+        requests = []
+
+        class Response(object):
+            pass
+
+        def make_request(**kwargs):
+            requests.append(kwargs)
+            response = Response()
+            response.content = content
+            return response
+
+        product.client.make_request = make_request
+
+        return customer, requests
+
+    def test_refresh_eager(self):
+        ''' Test the default refresh decodes the whole customer. '''
+        customer, requests = self.get_refresh_customer()
+        item = customer.subscription.items['MONTHLY_ITEM']
+        item.quantity_used = Decimal(0)
+        item.clear_changes()
+
+        item.increment(1)
+
+        self.assertEquals(1, len(requests))
+        self.assertEquals('Test', customer.first_name)
+        self.assertTrue(item is customer.subscription.items['MONTHLY_ITEM'])
+        self.assertEquals(Decimal(3), item.quantity_used)
+        self.assertTrue(isinstance(customer.subscription.invoices, list))
+
+    def test_refresh_lazy(self):
+        ''' Test lazy refresh defers decoding invoices. '''
+        customer, requests = self.get_refresh_customer(REFRESH_LAZY)
+        subscription = customer.subscription
+        item = subscription.items['MONTHLY_ITEM']
+        item.quantity_used = Decimal(0)
+        item.clear_changes()
+
+        customer.charge('CHARGE', 10)
+
+        self.assertEquals('Test', customer.first_name)
+        self.assertTrue(subscription is customer.subscription)
+        self.assertTrue(item is subscription.items['MONTHLY_ITEM'])
+        self.assertEquals(Decimal(3), item.quantity_used)
+        self.assertTrue(isinstance(subscription.invoices, LazyElementList))
+        self.assertEquals(1, len(subscription.invoices))
+
+    def test_refresh_none(self):
+        ''' Test no refresh leaves the customer as it was. '''
+        customer, requests = self.get_refresh_customer(REFRESH_NONE)
+
+        customer.charge('CHARGE', 10)
+        customer.subscription.cancel()
+
+        self.assertEquals(2, len(requests))
+        self.assertEquals('Old', customer.first_name)
+        self.assertEquals(None, customer.subscription.canceled)
+
+    def test_refresh_per_call(self):
+        ''' Test a call's refresh overrides the product's. '''
+        customer, requests = self.get_refresh_customer(REFRESH_NONE)
+
+        customer.charge('CHARGE', 10, refresh='eager')
+
+        self.assertEquals('Test', customer.first_name)
+
+    @raises(ValueError)
+    def test_unknown_refresh(self):
+        ''' Test an unknown refresh policy is refused. '''
+        CheddarProduct('user', 'password', 'PRODUCT', refresh='sometimes')
+
+    def test_reload_updates_in_place(self):
+        ''' Test reloading a customer keeps its child objects. '''
+        customer, requests = self.get_refresh_customer()
+        subscription = customer.subscription
+        items = subscription.items
+        item = items['MONTHLY_ITEM']
+        plan = subscription.plan
+        meta_data = customer.meta_data
+
+        customer.charge('CHARGE', 10)
+
+        self.assertEquals('Test', customer.first_name)
+        self.assertTrue(subscription is customer.subscription)
+        self.assertTrue(items is subscription.items)
+        self.assertTrue(item is items['MONTHLY_ITEM'])
+        self.assertTrue(plan is subscription.plan)
+        self.assertTrue(meta_data is customer.meta_data)
+        self.assertFalse(customer.has_changes())
+
+    def test_reload_keeps_unsaved_changes(self):
+        ''' Test reloading a customer keeps fields assigned since. '''
+        customer, requests = self.get_refresh_customer()
+        customer.last_name = 'New'
+        item = customer.subscription.items['MONTHLY_ITEM']
+        item.quantity_used = Decimal(7)
+
+        customer.charge('CHARGE', 10)
+
+        self.assertEquals('Test', customer.first_name)
+        self.assertEquals('New', customer.last_name)
+        self.assertEquals(Decimal(7), item.quantity_used)
+        self.assertEquals({'last_name': 'New'}, customer.get_changes())
+
+    def test_save_without_changes(self):
+        ''' Test saving an unchanged customer sends nothing. '''
+        customer, requests = self.get_refresh_customer()
+
+        self.assertFalse(customer.save())
+        self.assertEquals([], requests)
+
+    def test_save_sends_changed_fields(self):
+        ''' Test save sends only the fields which were assigned. '''
+        customer, requests = self.get_refresh_customer(REFRESH_NONE)
+        customer.first_name = 'New'
+        customer.subscription.cc_zip = '12345'
+
+        self.assertTrue(customer.save())
+
+        self.assertEquals(1, len(requests))
+        self.assertEquals('customers/edit', requests[0]['path'])
+        self.assertEquals({'firstName': 'New',
+                           'subscription[ccZip]': '12345'},
+                          requests[0]['data'])
+        self.assertFalse(customer.has_changes())
+        self.assertFalse(customer.subscription.has_changes())
+        self.assertEquals('New', customer.first_name)
+
+    def test_save_items(self):
+        ''' Test save sets changed item quantities. '''
+        customer, requests = self.get_refresh_customer()
+        customer.email = 'new@example.com'
+        item = customer.subscription.items['ONCE_ITEM']
+        item.quantity_used = 5
+
+        self.assertTrue(customer.subscription.save())
+
+        self.assertEquals(['customers/edit', 'customers/set-item-quantity'],
+                          [request['path'] for request in requests])
+        self.assertEquals({'quantity': Decimal(5)}, requests[1]['data'])
+        self.assertFalse(item.has_changes())
+        # Reloaded once everything was sent
+        self.assertEquals(Decimal(1), item.quantity_used)
+        self.assertFalse(item.save())
@@ -0,0 +1,79 @@
+import time
+import unittest
+
+from nose.tools import raises
+
+from sharpy.pool import HttpPool
+from sharpy.pool import PoolTimeout
+
+
+class HttpPoolTests(unittest.TestCase):
+
+    def test_reuse(self):
+        ''' Test a released connection is handed back out. '''
+        pool = HttpPool()
+        url = 'https://cheddargetter.com/xml/plans/get'
+        first = pool.acquire(url)
+        pool.release(url, first)
+        second = pool.acquire(url)
+
+        self.assertTrue(first is second)
+        self.assertEquals(1, pool.get_stats()['opens'])
+        self.assertEquals(1, pool.get_stats()['hits'])
+
+    def test_hosts_are_separate(self):
+        ''' Test connections are only reused for the same host. '''
+        pool = HttpPool()
+        first = pool.acquire('https://cheddargetter.com/xml')
+        pool.release('https://cheddargetter.com/xml', first)
+        second = pool.acquire('https://example.com/xml')
+
+        self.assertFalse(first is second)
+        self.assertEquals(2, pool.get_stats()['opens'])
+
+    @raises(PoolTimeout)
+    def test_max_per_host(self):
+        ''' Test the per host limit makes further requests wait. '''
+        pool = HttpPool(max_per_host=1, wait_timeout=0.01)
+        url = 'https://cheddargetter.com/xml'
+        pool.acquire(url)
+        pool.acquire(url)
+
+    def test_idle_eviction(self):
+        ''' Test idle connections past the idle timeout are evicted. '''
+        pool = HttpPool(idle_timeout=0.01)
+        url = 'https://cheddargetter.com/xml'
+        first = pool.acquire(url)
+        pool.release(url, first)
+        time.sleep(0.02)
+        second = pool.acquire(url)
+
+        self.assertFalse(first is second)
+        self.assertEquals(1, pool.get_stats()['evictions'])
+
+    def test_discard(self):
+        ''' Test discarded connections are not reused. '''
+        pool = HttpPool()
+        url = 'https://cheddargetter.com/xml'
+        first = pool.acquire(url)
+        pool.release(url, first, discard=True)
+        stats = pool.get_stats()
+
+        self.assertEquals(0, stats['idle'])
+        self.assertEquals(0, stats['in_use'])
+        self.assertEquals(1, stats['discards'])
+
+    def test_failed_open_frees_slot(self):
+        ''' Test a connection which can't be created doesn't use a slot. '''
+        pool = HttpPool(max_per_host=1, wait_timeout=0.01)
+        url = 'https://cheddargetter.com/xml'
+        create_http = pool.create_http
+
+        def fail():
+            raise ValueError('bad cache')
+        pool.create_http = fail
+
+        self.assertRaises(ValueError, pool.acquire, url)
+        self.assertEquals(0, pool.get_stats()['in_use'])
+        pool.create_http = create_http
+        pool.acquire(url)
@@ -4,6 +4,8 @@ import string
 from copy import copy
 from datetime import datetime, timedelta
 from decimal import Decimal
+import threading
+import time
 import unittest
 
 from dateutil.relativedelta import relativedelta
@@ -11,6 +13,8 @@ from dateutil.tz import tzutc
 from nose.tools import raises
 from testconfig import config
 
+from sharpy.asynchronous import AsyncCheddarProduct
+from sharpy.cache import LRUCache
 from sharpy.product import CheddarProduct
 from sharpy.exceptions import NotFound
 
@@ -112,6 +116,25 @@ class ProductTests(unittest.TestCase):
 
         self.assertEquals(code, plan.code)
 
+    def test_cached_plans(self):
+        ''' Test plans are fetched once when a result cache is used. '''
+        product = CheddarProduct(result_cache=LRUCache(),
+                                 **self.client_defaults)
+
+        plans = product.get_all_plans()
+        plan = product.get_plan('PAID_MONTHLY')
+        stats = product.client.get_pool_stats()
+
+        self.assertEquals(1, stats['opens'] + stats['hits'])
+        self.assertEquals('PAID_MONTHLY', plan.code)
+        self.assertTrue(plan not in plans)
+
+        product.invalidate_plans()
+        product.get_plan('PAID_MONTHLY')
+        stats = product.client.get_pool_stats()
+
+        self.assertEquals(2, stats['opens'] + stats['hits'])
+
     def test_plan_initial_bill_date(self):
         ''' Test plan with initial bill date. '''
         product = self.get_product()
@@ -377,6 +400,99 @@ class ProductTests(unittest.TestCase):
         fetched_customers = product.get_customers()
         self.assertEquals(2, len(fetched_customers))
 
+    def test_build_customer_filter_data(self):
+        ''' Test building customers/get filter data. '''
+        product = self.get_product()
+        result = product.build_customer_filter_data(
+            subscription_status='activeOnly',
+            plan_codes=['FREE_MONTHLY', 'PAID_MONTHLY'],
+            created_after=datetime(2011, 1, 1, 12, 30),
+            created_before=datetime(2011, 2, 1).date(),
+            order_by='createdDatetime',
+            order_by_direction='desc',
+        )
+        expected = [
+            ('subscriptionStatus', 'activeOnly'),
+            ('planCode[]', 'FREE_MONTHLY'),
+            ('planCode[]', 'PAID_MONTHLY'),
+            ('createdAfterDate', '2011-01-01'),
+            ('createdBeforeDate', '2011-02-01'),
+            ('orderBy', 'createdDatetime'),
+            ('orderByDirection', 'desc'),
+        ]
+
+        self.assertEquals(expected, result)
+
+    def test_get_customer_windows(self):
+        ''' Test splitting a date range into creation date windows. '''
+        product = self.get_product()
+        result = product.get_customer_windows(
+            start=datetime(2011, 1, 15).date(),
+            end=datetime(2011, 3, 20).date(),
+        )
+        expected = [
+            (datetime(2011, 1, 15).date(), datetime(2011, 2, 14).date()),
+            (datetime(2011, 2, 15).date(), datetime(2011, 3, 14).date()),
+            (datetime(2011, 3, 15).date(), datetime(2011, 3, 20).date()),
+        ]
+
+        self.assertEquals(expected, result)
+
+    def test_get_customer_windows_with_window(self):
+        ''' Test splitting a date range with a custom window. '''
+        product = self.get_product()
+        result = product.get_customer_windows(
+            start=datetime(2011, 1, 1),
+            end=datetime(2011, 1, 3),
+            window=relativedelta(days=2),
+        )
+        expected = [
+            (datetime(2011, 1, 1).date(), datetime(2011, 1, 2).date()),
+            (datetime(2011, 1, 3).date(), datetime(2011, 1, 3).date()),
+        ]
+
+        self.assertEquals(expected, result)
+
+    @clear_users
+    def test_get_customers_with_filters(self):
+        ''' Create free and paid customers, filter by plan. '''
+        self.get_customer()
+        self.get_customer(code='test2', **self.paid_defaults)
+        product = self.get_product()
+
+        import time
+        time.sleep(0.5)
+        fetched_customers = product.get_customers(
+            plan_codes=['PAID_MONTHLY'])
+        self.assertEquals(['test2'],
+                          [customer.code for customer in fetched_customers])
+
+    @clear_users
+    def test_scan_customers(self):
+        ''' Create two customers, verify 2 scanned concurrently. '''
+        self.get_customer()
+        self.get_customer(code='test2')
+        product = self.get_product()
+
+        import time
+        time.sleep(0.5)
+        start = datetime.utcnow() - relativedelta(days=10)
+        codes = [customer.code for customer in product.scan_customers(
+            start, window=relativedelta(days=1), workers=3)]
+        self.assertEquals(['test', 'test2'], sorted(codes))
+
+    @clear_users
+    def test_iter_customers(self):
+        ''' Create two customers, verify 2 streamed. '''
+        self.get_customer()
+        self.get_customer(code='test2')
+        product = self.get_product()
+
+        import time
+        time.sleep(0.5)
+        codes = [customer.code for customer in product.iter_customers()]
+        self.assertEquals(['test', 'test2'], sorted(codes))
+
     @clear_users
     def test_get_customer(self):
         ''' Test getting a customer by code.. '''
@@ -392,6 +508,101 @@ class ProductTests(unittest.TestCase):
                           fetched_customer.last_name)
         self.assertEquals(created_customer.email, fetched_customer.email)
 
+    @clear_users
+    def test_get_customer_async(self):
+        ''' Test getting customers by code without blocking. '''
+        created_customer = self.get_customer()
+        second_customer = self.get_customer(code='test2')
+        product = AsyncCheddarProduct(**self.client_defaults)
+
+        first_result = product.get_customer_async(code=created_customer.code)
+        second_result = product.get_customer_async(code=second_customer.code)
+
+        self.assertEquals(created_customer.code, first_result.get().code)
+        self.assertEquals(second_customer.code, second_result.get().code)
+        product.close()
+
+    @clear_users
+    def test_create_customer_async(self):
+        ''' Test creating a customer without blocking. '''
+        product = AsyncCheddarProduct(**self.client_defaults)
+        result = product.create_customer_async(**self.customer_defaults)
+        customer = result.get()
+
+        self.assertEquals(self.customer_defaults['code'], customer.code)
+        self.assertEquals(product, customer.product)
+        product.close()
+
+    @clear_users
+    def test_get_customers_by_codes(self):
+        ''' Test bulk fetching customers, including a missing code. '''
+        self.get_customer()
+        self.get_customer(code='test2')
+        product = self.get_product()
+
+        customers, errors = product.get_customers_by_codes(
+            ['test', 'test2', 'missing', 'test'], workers=2)
+
+        self.assertEquals(['test', 'test2'], sorted(customers.keys()))
+        self.assertEquals('test2', customers['test2'].code)
+        self.assertEquals(['missing'], errors.keys())
+        self.assertTrue(isinstance(errors['missing'], NotFound))
+
+    def test_get_customers_by_codes_empty(self):
+        ''' Test bulk fetching no customers makes no requests. '''
+        product = self.get_product()
+
+        self.assertEquals(({}, {}), product.get_customers_by_codes([]))
+
+    def test_concurrent_loads_are_coalesced(self):
+        ''' Test concurrent misses for a cached value share one load. '''
+        for result_cache in (None, LRUCache()):
+            product = CheddarProduct(result_cache=result_cache,
+                                     **self.client_defaults)
+            release = threading.Event()
+            calls = []
+            results = []
+
+            def loader():
+                calls.append(None)
+                release.wait()
+                return {'items': []}
+
+            def get():
+                results.append(product.get_cached('name', loader))
+
+            threads = [threading.Thread(target=get) for n in range(5)]
+            for thread in threads:
+                thread.start()
+            while product.single_flight.get_stats()['coalesced'] < 4:
+                time.sleep(0.001)
+            release.set()
+            for thread in threads:
+                thread.join()
+
+            self.assertEquals(1, len(calls))
+            self.assertEquals([{'items': []}] * 5, results)
+            self.assertEquals(5, len(set(id(result['items'])
+                                         for result in results)))
+
+    @clear_users
+    def test_cached_customer_invalidated_on_update(self):
+        ''' Test a cached customer is refetched after it changes. '''
+        product = CheddarProduct(result_cache=LRUCache(),
+                                 **self.client_defaults)
+        created_customer = self.get_customer()
+        customer = product.get_customer(created_customer.code)
+        cached_customer = product.get_customer(created_customer.code)
+        stats = product.client.get_pool_stats()
+
+        self.assertFalse(customer is cached_customer)
+        self.assertEquals(1, stats['opens'] + stats['hits'])
+
+        customer.update(first_name='Different')
+        fetched_customer = product.get_customer(created_customer.code)
+
+        self.assertEquals('Different', fetched_customer.first_name)
+
     @clear_users
     def test_simple_customer_update(self):
         ''' Test Update Customer. '''
@@ -475,6 +686,22 @@ class ProductTests(unittest.TestCase):
         ''' Test item increment. '''
         self.assert_increment()
 
+    @clear_users
+    def test_increment_async(self):
+        ''' Test item increment without blocking. '''
+        customer = self.get_customer_with_items()
+        product = AsyncCheddarProduct(**self.client_defaults)
+        customer = product.get_customer_async(customer.code).get()
+        item = customer.subscription.items['MONTHLY_ITEM']
+
+        old_quantity = item.quantity_used
+        result = product.increment_async(item, 2)
+
+        self.assertTrue(result.get() is item)
+        self.assertAlmostEqual(Decimal(2), item.quantity_used - old_quantity,
+                               places=2)
+        product.close()
+
     @clear_users
     def test_int_increment(self):
         ''' Test item increment with integer. '''
@@ -603,6 +830,23 @@ class ProductTests(unittest.TestCase):
         ''' Test adding a custom charge to an invoice. '''
         self.assert_charged(code='TEST-CHARGE', each_amount=1, quantity=1)
 
+    @clear_users
+    def test_add_charge_async(self):
+        ''' Test adding a custom charge without blocking. '''
+        customer = self.get_customer(**self.paid_defaults)
+        product = AsyncCheddarProduct(**self.client_defaults)
+        customer = product.get_customer_async(customer.code).get()
+
+        result = product.charge_async(customer, code='TEST-CHARGE',
+                                      each_amount=1)
+
+        self.assertTrue(result.get() is customer)
+        charge_codes = [charge['code']
+                        for invoice in customer.subscription.invoices
+                        for charge in invoice['charges']]
+        self.assertTrue('TEST-CHARGE' in charge_codes)
+        product.close()
+
     @clear_users
     def test_add_float_charge(self):
         ''' Test adding a custom charge to an invoice with float. '''
@@ -0,0 +1,94 @@
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+from nose.tools import raises, assert_raises
+
+from sharpy.client import Client
+from sharpy.ratelimit import FileTokenBucket
+from sharpy.ratelimit import RateLimited
+from sharpy.ratelimit import TokenBucket
+from sharpy.retry import RetryPolicy
+
+
+class TokenBucketTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_burst_then_reject(self):
+        ''' Test a full bucket allows a burst of capacity requests. '''
+        bucket = TokenBucket(rate=1, capacity=3, blocking=False)
+
+        for n in range(3):
+            bucket.acquire()
+
+        with assert_raises(RateLimited) as context:
+            bucket.acquire()
+        self.assertTrue(0 < context.exception.retry_after <= 1)
+        self.assertFalse(bucket.try_acquire())
+        stats = bucket.get_stats()
+        self.assertEquals(3, stats['acquired'])
+        self.assertEquals(2, stats['rejected'])
+
+    def test_blocking_acquire_waits(self):
+        ''' Test a blocking acquire waits for the bucket to refill. '''
+        bucket = TokenBucket(rate=50, capacity=1)
+        bucket.acquire()
+
+        waited = bucket.acquire()
+        stats = bucket.get_stats()
+
+        self.assertTrue(waited > 0.01)
+        self.assertEquals(2, stats['acquired'])
+        self.assertEquals(1, stats['waited'])
+        self.assertEquals(waited, stats['wait_time'])
+        self.assertEquals(waited, stats['max_wait_time'])
+
+    @raises(RateLimited)
+    def test_blocking_acquire_timeout(self):
+        ''' Test a blocking acquire gives up after its timeout. '''
+        bucket = TokenBucket(rate=0.1, capacity=1)
+        bucket.acquire()
+        bucket.acquire(timeout=0.01)
+
+    def test_refill_is_capped(self):
+        ''' Test the bucket never holds more than capacity tokens. '''
+        bucket = TokenBucket(rate=1000, capacity=2, blocking=False)
+        time.sleep(0.01)
+
+        self.assertTrue(bucket.try_acquire())
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+
+    def test_file_bucket_is_shared(self):
+        ''' Test file buckets on the same path share one budget. '''
+        path = os.path.join(self.directory, 'bucket')
+        first = FileTokenBucket(path, rate=0.1, capacity=2, blocking=False)
+        second = FileTokenBucket(path, rate=0.1, capacity=2, blocking=False)
+
+        self.assertTrue(first.try_acquire())
+        self.assertTrue(second.try_acquire())
+        self.assertFalse(first.try_acquire())
+        self.assertFalse(second.try_acquire())
+
+        first.reset()
+        self.assertTrue(second.try_acquire())
+
+    def test_client_is_throttled(self):
+        ''' Test the client takes a token for each request. '''
+        bucket = TokenBucket(rate=0.1, capacity=1, blocking=False)
+        client = Client('user', 'password', 'PRODUCT',
+                        endpoint='http://127.0.0.1:1/xml',
+                        retry_policy=RetryPolicy(max_attempts=1),
+                        rate_limiter=bucket)
+
+        assert_raises(socket.error, client.make_request, 'plans/get')
+        assert_raises(RateLimited, client.make_request, 'plans/get')
+        self.assertEquals(1, client.get_pool_stats()['opens'])
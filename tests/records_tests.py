@@ -0,0 +1,81 @@
+import cPickle as pickle
+from copy import deepcopy
+import unittest
+
+from nose.tools import raises
+
+from sharpy.records import Charge, Invoice
+
+
+class RecordTests(unittest.TestCase):
+
+    def get_charge(self):
+        return Charge(id='1', code='CHARGE', type='custom', quantity=2)
+
+    def test_attribute_and_item_access(self):
+        ''' Test record fields can be read as attributes or items. '''
+        charge = self.get_charge()
+
+        self.assertEquals('CHARGE', charge.code)
+        self.assertEquals('CHARGE', charge['code'])
+        self.assertEquals(None, charge['description'])
+        self.assertEquals('default', charge.get('missing', 'default'))
+        self.assertTrue('code' in charge)
+        self.assertFalse('missing' in charge)
+
+    @raises(KeyError)
+    def test_unknown_key(self):
+        ''' Test reading an unknown key raises KeyError. '''
+        self.get_charge()['missing']
+
+    @raises(TypeError)
+    def test_unknown_field(self):
+        ''' Test creating a record with an unknown field fails. '''
+        Charge(missing=1)
+
+    @raises(AttributeError)
+    def test_no_instance_dict(self):
+        ''' Test records don't accept arbitrary attributes. '''
+        self.get_charge().missing = 1
+
+    def test_compares_to_dict(self):
+        ''' Test records compare equal to the equivalent dict. '''
+        charge = self.get_charge()
+        expected = {
+            'id': '1',
+            'code': 'CHARGE',
+            'type': 'custom',
+            'quantity': 2,
+            'each_amount': None,
+            'description': None,
+            'created_datetime': None,
+        }
+
+        self.assertEquals(expected, charge)
+        self.assertEquals(charge, expected)
+        self.assertEquals(expected, dict(charge))
+        self.assertEquals(expected, charge.to_dict())
+        expected['quantity'] = 3
+        self.assertNotEquals(expected, charge)
+
+    def test_compares_to_record(self):
+        ''' Test records compare by type and fields. '''
+        self.assertEquals(self.get_charge(), self.get_charge())
+        self.assertNotEquals(self.get_charge(), Charge(id='2'))
+        self.assertNotEquals(Invoice(id='1'), Charge(id='1'))
+
+    def test_set_item(self):
+        ''' Test setting a field as an item. '''
+        charge = self.get_charge()
+        charge['quantity'] = 5
+
+        self.assertEquals(5, charge.quantity)
+
+    def test_copy_and_pickle(self):
+        ''' Test records survive deepcopy and every pickle protocol. '''
+        invoice = Invoice(id='1', charges=[self.get_charge()])
+
+        self.assertEquals(invoice, deepcopy(invoice))
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEquals(invoice,
+                              pickle.loads(pickle.dumps(invoice, protocol)))
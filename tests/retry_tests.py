@@ -0,0 +1,166 @@
+import socket
+import unittest
+
+from nose.tools import assert_raises
+
+from sharpy.client import Client
+from sharpy.exceptions import CheddarFailure
+from sharpy.exceptions import NaughtyGateway
+from sharpy.exceptions import NotFound
+from sharpy.product import CheddarProduct
+from sharpy.retry import RetryPolicy
+
+from testing_tools.fixtures import get_cheddar_error
+
+
+class RecordingRetryPolicy(RetryPolicy):
+    ''' A retry policy which records its delays instead of sleeping. '''
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingRetryPolicy, self).__init__(*args, **kwargs)
+        self.delays = []
+
+    def sleep(self, delay):
+        self.delays.append(delay)
+
+
+class RetryPolicyTests(unittest.TestCase):
+
+    def get_flaky(self, failures):
+        ''' Returns a function which raises each of failures in turn. '''
+        calls = []
+
+        def func():
+            calls.append(None)
+            if len(calls) <= len(failures):
+                raise failures[len(calls) - 1]
+            return 'result'
+
+        return func, calls
+
+    def test_get_is_retried(self):
+        ''' Test a GET is retried until it succeeds. '''
+        policy = RecordingRetryPolicy(max_attempts=3)
+        func, calls = self.get_flaky([
+            socket.timeout('timed out'),
+            get_cheddar_error(NaughtyGateway, 502),
+        ])
+
+        result = policy.call(func, 'GET', 'plans/get')
+        stats = policy.get_stats()
+
+        self.assertEquals('result', result)
+        self.assertEquals(3, len(calls))
+        self.assertEquals(2, len(policy.delays))
+        self.assertEquals(1, stats['requests'])
+        self.assertEquals(2, stats['retries'])
+        self.assertEquals(1, stats['recovered'])
+
+    def test_retries_exhausted(self):
+        ''' Test the last error is raised once max_attempts is reached. '''
+        policy = RecordingRetryPolicy(max_attempts=3)
+        error = get_cheddar_error(CheddarFailure, 500)
+        func, calls = self.get_flaky([error] * 5)
+
+        with assert_raises(CheddarFailure) as context:
+            policy.call(func, 'GET', 'plans/get')
+
+        self.assertEquals(3, context.exception.attempts)
+        self.assertEquals(3, len(calls))
+        self.assertEquals(1, policy.get_stats()['exhausted'])
+
+    def test_post_not_retried(self):
+        ''' Test a POST isn't retried unless marked safe. '''
+        policy = RecordingRetryPolicy()
+        func, calls = self.get_flaky([socket.error('reset')])
+
+        assert_raises(socket.error, policy.call, func, 'POST',
+                      'customers/add-charge')
+
+        self.assertEquals(1, len(calls))
+        self.assertEquals(1, policy.get_stats()['not_retried'])
+
+    def test_post_retried_when_idempotent(self):
+        ''' Test a POST explicitly marked idempotent is retried. '''
+        policy = RecordingRetryPolicy()
+        func, calls = self.get_flaky([socket.error('reset')])
+
+        result = policy.call(func, 'POST', 'customers/get', idempotent=True)
+
+        self.assertEquals('result', result)
+        self.assertEquals(2, len(calls))
+
+    def test_post_retried_for_safe_path(self):
+        ''' Test a POST to one of the policy's safe paths is retried. '''
+        policy = RecordingRetryPolicy(
+            safe_paths=['customers/set-item-quantity'])
+        func, calls = self.get_flaky([socket.error('reset')])
+
+        result = policy.call(func, 'POST', 'customers/set-item-quantity')
+
+        self.assertEquals('result', result)
+        self.assertEquals(2, len(calls))
+
+    def test_get_not_retried_when_not_idempotent(self):
+        ''' Test idempotent=False turns off retries for a GET. '''
+        policy = RecordingRetryPolicy()
+        func, calls = self.get_flaky([socket.error('reset')])
+
+        assert_raises(socket.error, policy.call, func, 'GET', 'plans/get',
+                      idempotent=False)
+        self.assertEquals(1, len(calls))
+
+    def test_client_errors_not_retried(self):
+        ''' Test errors which aren't transient are raised straight away. '''
+        policy = RecordingRetryPolicy()
+        func, calls = self.get_flaky([
+            get_cheddar_error(NotFound, 404)])
+
+        assert_raises(NotFound, policy.call, func, 'GET', 'customers/get')
+        self.assertEquals(1, len(calls))
+        self.assertEquals(0, policy.get_stats()['retries'])
+
+    def test_backoff_delays(self):
+        ''' Test delays are jittered below an exponential, capped curve. '''
+        policy = RetryPolicy(base_delay=1, max_delay=5)
+
+        for retry, cap in ((1, 1), (2, 2), (3, 4), (4, 5), (10, 5)):
+            for n in range(20):
+                delay = policy.get_delay(retry)
+                self.assertTrue(0 <= delay <= cap)
+
+    def test_single_attempt(self):
+        ''' Test max_attempts=1 disables retries. '''
+        policy = RecordingRetryPolicy(max_attempts=1)
+        func, calls = self.get_flaky([socket.error('reset')])
+
+        assert_raises(socket.error, policy.call, func, 'GET', 'plans/get')
+        self.assertEquals(1, len(calls))
+
+    def test_client_retries_connection_errors(self):
+        ''' Test the client retries requests which can't connect. '''
+        policy = RecordingRetryPolicy(max_attempts=2)
+        client = Client('user', 'password', 'PRODUCT',
+                        endpoint='http://127.0.0.1:1/xml',
+                        retry_policy=policy)
+
+        assert_raises(socket.error, client.make_request, 'plans/get')
+        stats = client.get_retry_stats()
+
+        self.assertEquals(1, stats['retries'])
+        self.assertEquals(1, stats['exhausted'])
+
+    def test_customer_requests_not_retried(self):
+        ''' Test customer mutations sent as a GET aren't retried. '''
+        policy = RecordingRetryPolicy(max_attempts=2)
+        product = CheddarProduct('user', 'password', 'PRODUCT',
+                                 endpoint='http://127.0.0.1:1/xml',
+                                 retry_policy=policy)
+
+        assert_raises(socket.error, product.make_customer_request, 'test',
+                      'customers/cancel', params={'code': 'test'},
+                      method='GET')
+        stats = product.client.get_retry_stats()
+
+        self.assertEquals(0, stats['retries'])
+        self.assertEquals([], policy.delays)
@@ -0,0 +1,172 @@
+from datetime import date, datetime
+from StringIO import StringIO
+import unittest
+
+from dateutil.tz import tzoffset
+
+from sharpy import revenue
+from sharpy.columnar import CustomerTables
+
+from testing_tools.fixtures import build_customers_xml
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class RevenueTests(unittest.TestCase):
+    '''
+    The fixture customers are c0 on TRACKED_MONTHLY (10.00 a month) and c1
+    on FREE_MONTHLY, both signed up on 2011-01-10, and c2 on PAID_MONTHLY
+    (20.00 a month), created on 2011-05-16 and canceled here on
+    2011-08-01.
+    '''
+
+    def setUp(self):
+        self.tables = CustomerTables.from_xml(
+            StringIO(build_customers_xml()))
+        self.tables.subscriptions['canceled'][2] = numpy.datetime64(
+            '2011-08-01T00:00:00')
+
+    def test_plan_monthly_cents(self):
+        ''' Test plan charges are spread over their billing frequency. '''
+        plans = self.tables.plans
+        plans['billing_frequency_quantity'][0] = 3
+        plans['billing_frequency_unit'][2] = -1
+
+        self.assertEquals([333, 0, 0],
+                          list(revenue.plan_monthly_cents(self.tables)))
+
+        plans.categories['billing_frequency_unit'][0] = 'year'
+
+        self.assertEquals([28, 0, 0],
+                          list(revenue.plan_monthly_cents(self.tables)))
+
+    def test_mrr(self):
+        ''' Test mrr and arr count the subscriptions paying at a time. '''
+        self.assertEquals(1000, revenue.mrr(self.tables))
+        self.assertEquals(12000, revenue.arr(self.tables))
+        self.assertEquals(0, revenue.mrr(self.tables, date(2011, 1, 1)))
+        self.assertEquals(3000, revenue.mrr(self.tables, date(2011, 6, 1)))
+        self.assertEquals(1000, revenue.mrr(
+            self.tables, datetime(2011, 5, 16, 17, 36,
+                                  tzinfo=tzoffset(None, 3600))))
+        self.assertEquals(3000, revenue.mrr(
+            self.tables, datetime(2011, 5, 16, 17, 37,
+                                  tzinfo=tzoffset(None, 3600))))
+
+    def test_trials(self):
+        ''' Test subscriptions in their trial aren't paying yet. '''
+        self.tables.plans['trial_days'][0] = 30
+
+        self.assertEquals(0, revenue.mrr(self.tables, date(2011, 2, 1)))
+        self.assertEquals(1000, revenue.mrr(
+            self.tables, date(2011, 2, 1), exclude_trials=False))
+        self.assertEquals(1000, revenue.mrr(self.tables, date(2011, 2, 10)))
+
+    def test_mrr_by_plan(self):
+        ''' Test mrr and plan mix by plan code. '''
+        self.assertEquals(
+            {'TRACKED_MONTHLY': 1000, 'FREE_MONTHLY': 0, 'PAID_MONTHLY': 2000},
+            revenue.mrr_by_plan(self.tables, date(2011, 6, 1)))
+        self.assertEquals(
+            {'TRACKED_MONTHLY': 1, 'FREE_MONTHLY': 1},
+            revenue.plan_mix(self.tables))
+        self.assertEquals({}, revenue.plan_mix(self.tables, date(2010, 1, 1)))
+
+    def test_mrr_by_campaign_source(self):
+        ''' Test mrr by the customers' campaign sources. '''
+        customers = self.tables.customers
+        customers.columns['campaign_source'] = numpy.array(
+            [0, -1, 0], dtype=numpy.int32)
+        customers.categories['campaign_source'] = numpy.array(
+            ['google'], dtype=object)
+
+        self.assertEquals(
+            {'google': 3000, None: 0},
+            revenue.mrr_by_campaign_source(self.tables, date(2011, 6, 1)))
+        self.assertEquals({'google': 1000, None: 0},
+                          revenue.mrr_by_campaign_source(self.tables))
+
+    def test_mrr_by_month(self):
+        ''' Test the mrr at the start of each month. '''
+        series = revenue.mrr_by_month(self.tables, date(2010, 12, 1),
+                                      date(2011, 9, 30))
+
+        self.assertEquals(
+            [('2010-12', 0), ('2011-01', 0), ('2011-02', 1000),
+             ('2011-03', 1000), ('2011-04', 1000), ('2011-05', 1000),
+             ('2011-06', 3000), ('2011-07', 3000), ('2011-08', 1000),
+             ('2011-09', 1000)],
+            [(str(month), total) for month, total in series])
+
+    def test_mrr_by_month_matches_mrr(self):
+        ''' Test each month of the series agrees with mrr at that time. '''
+        self.tables.plans['trial_days'][2] = 45
+        self.tables.subscriptions['canceled'][2] = numpy.datetime64('NaT')
+
+        series = revenue.mrr_by_month(self.tables, date(2011, 1, 1),
+                                      date(2012, 1, 1))
+
+        for month, total in series:
+            self.assertEquals(
+                revenue.mrr(self.tables, month.astype('datetime64[s]')),
+                total)
+
+    def test_charge_totals(self):
+        ''' Test charges and credits are totaled separately. '''
+        self.tables.charges['amount_cents'][2] = -500
+
+        self.assertEquals({'charges': 4000, 'credits': -500, 'net': 3500},
+                          revenue.charge_totals(self.tables))
+        self.assertEquals({'charges': 2000, 'credits': -500, 'net': 1500},
+                          revenue.charge_totals(self.tables,
+                                                date(2011, 2, 10),
+                                                date(2011, 2, 11)))
+        self.assertEquals(
+            {'TRACKED_MONTHLY_RECURRING': 1000, 'MONTHLY_ITEM': 1000,
+             'ONCE_ITEM': -500, 'FREE_MONTHLY_RECURRING': 0,
+             'PAID_MONTHLY_RECURRING': 2000},
+            revenue.charge_totals_by_code(self.tables))
+
+    def test_charge_totals_by_month(self):
+        ''' Test charges are totaled by the month they were billed. '''
+        totals = revenue.charge_totals_by_month(
+            self.tables, date(2011, 3, 1), date(2011, 6, 1))
+
+        self.assertEquals(
+            [('2011-03', 0), ('2011-04', 0), ('2011-05', 0),
+             ('2011-06', 2000)],
+            [(str(month), total) for month, total in totals])
+
+    def test_charge_totals_by_month_out_of_range(self):
+        ''' Test charges billed outside the months are left out. '''
+        # Charges are billed on 2011-02-10 (3000) and 2011-06-16 (2000)
+        totals = revenue.charge_totals_by_month(
+            self.tables, date(2011, 3, 1), date(2011, 5, 31))
+
+        self.assertEquals(
+            [('2011-03', 0), ('2011-04', 0), ('2011-05', 0)],
+            [(str(month), total) for month, total in totals])
+
+        totals = revenue.charge_totals_by_month(
+            self.tables, date(2011, 1, 1), date(2011, 2, 1))
+
+        self.assertEquals(
+            [('2011-01', 0), ('2011-02', 3000)],
+            [(str(month), total) for month, total in totals])
+
+    def test_empty(self):
+        ''' Test rollups over tables without customers. '''
+        tables = CustomerTables.from_data([])
+
+        self.assertEquals(0, revenue.mrr(tables))
+        self.assertEquals({}, revenue.mrr_by_plan(tables))
+        self.assertEquals({'charges': 0, 'credits': 0, 'net': 0},
+                          revenue.charge_totals(tables))
+        self.assertEquals([0, 0], [total for month, total in
+                                   revenue.mrr_by_month(tables,
+                                                        date(2011, 1, 1),
+                                                        date(2011, 2, 1))])
@@ -0,0 +1,170 @@
+import threading
+import time
+import unittest
+
+from sharpy.product import CheddarProduct
+from sharpy.retry import RetryPolicy
+from sharpy.singleflight import SingleFlight
+
+
+class ScriptedRetryPolicy(RetryPolicy):
+    '''
+    A retry policy which answers requests itself instead of sending them,
+    holding the first customers/get until release is set.
+    '''
+
+    def __init__(self, release):
+        super(ScriptedRetryPolicy, self).__init__()
+        self.release = release
+        self.calls = []
+
+    def call(self, func, method, path, idempotent=None):
+        self.calls.append(path)
+        result = '%s %d' % (path, len(self.calls))
+        if len(self.calls) == 1:
+            self.release.wait()
+        return result
+
+
+class SingleFlightTests(unittest.TestCase):
+
+    def run_concurrently(self, single_flight, func, count=5, **kwargs):
+        '''
+        Starts count threads calling func through single_flight while func
+        is blocked, and returns their results once func is released.
+        '''
+        release = threading.Event()
+        results = []
+
+        def blocked():
+            release.wait()
+            return func()
+
+        def run():
+            try:
+                results.append(single_flight.do('key', blocked, **kwargs))
+            except Exception, e:
+                results.append(e)
+
+        threads = [threading.Thread(target=run) for n in range(count)]
+        for thread in threads:
+            thread.start()
+        while single_flight.get_stats()['coalesced'] < count - 1:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def test_concurrent_calls_are_coalesced(self):
+        ''' Test concurrent calls for a key share one call. '''
+        single_flight = SingleFlight()
+        calls = []
+
+        def func():
+            calls.append(None)
+            return ['result']
+
+        results = self.run_concurrently(single_flight, func)
+
+        self.assertEquals(1, len(calls))
+        self.assertEquals([['result']] * 5, results)
+        self.assertEquals(1, len(set(id(result) for result in results)))
+        self.assertEquals({'calls': 1, 'coalesced': 4},
+                          single_flight.get_stats())
+
+    def test_shared_results_are_copied(self):
+        ''' Test each caller of a shared call gets its own copy. '''
+        single_flight = SingleFlight()
+
+        results = self.run_concurrently(single_flight, lambda: ['result'],
+                                        copy=list)
+
+        self.assertEquals([['result']] * 5, results)
+        self.assertEquals(5, len(set(id(result) for result in results)))
+
+    def test_unshared_result_is_not_copied(self):
+        ''' Test a call no one joined returns its result as is. '''
+        single_flight = SingleFlight()
+        result = ['result']
+
+        self.assertTrue(single_flight.do('key', lambda: result, copy=list)
+                        is result)
+
+    def test_exceptions_are_shared(self):
+        ''' Test every caller of a failed call gets its exception. '''
+        single_flight = SingleFlight()
+
+        def func():
+            raise ValueError('failed')
+
+        results = self.run_concurrently(single_flight, func)
+
+        self.assertEquals(5, len(results))
+        for result in results:
+            self.assertTrue(isinstance(result, ValueError))
+
+    def test_calls_are_not_cached(self):
+        ''' Test a call made after another finished runs again. '''
+        single_flight = SingleFlight()
+        calls = []
+
+        single_flight.do('key', lambda: calls.append(None))
+        single_flight.do('key', lambda: calls.append(None))
+
+        self.assertEquals(2, len(calls))
+
+    def test_forget(self):
+        ''' Test a forgotten key starts a new call. '''
+        single_flight = SingleFlight()
+        release = threading.Event()
+        results = []
+
+        def first():
+            release.wait()
+            return 'first'
+
+        thread = threading.Thread(
+            target=lambda: results.append(single_flight.do('key', first)))
+        thread.start()
+        while not single_flight.get_stats()['calls']:
+            time.sleep(0.001)
+        single_flight.forget('key')
+        second = single_flight.do('key', lambda: 'second')
+        release.set()
+        thread.join()
+
+        self.assertEquals('second', second)
+        self.assertEquals(['first'], results)
+
+    def test_customer_mutation_forgets_flights(self):
+        ''' Test a GET after a cancel doesn't join one from before it. '''
+        release = threading.Event()
+        policy = ScriptedRetryPolicy(release)
+        product = CheddarProduct('user', 'password', 'PRODUCT',
+                                 endpoint='http://127.0.0.1:1/xml',
+                                 retry_policy=policy)
+        client = product.client
+        params = {'code': 'test'}
+        results = []
+
+        def get():
+            results.append(client.make_request('customers/get', params))
+
+        first = threading.Thread(target=get)
+        first.start()
+        while not policy.calls:
+            time.sleep(0.001)
+        product.make_customer_request('test', 'customers/cancel', params,
+                                      method='GET')
+        second = threading.Thread(target=get)
+        second.start()
+        second.join(1)
+        release.set()
+        first.join()
+        second.join()
+
+        self.assertEquals(['customers/get', 'customers/cancel',
+                           'customers/get'], policy.calls)
+        self.assertEquals(['customers/get 3', 'customers/get 1'], results)
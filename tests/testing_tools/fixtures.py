@@ -0,0 +1,83 @@
+import os
+from StringIO import StringIO
+
+from sharpy.exceptions import NotFound
+
+FILES_DIR = os.path.join(os.path.dirname(__file__), '..', 'files')
+
+CUSTOMER_FILES = ('customers-with-items.xml', 'customers-without-items.xml',
+                  'paypal_customer.xml')
+
+
+def load_file(filename):
+    f = open(os.path.join(FILES_DIR, filename))
+    content = f.read()
+    f.close()
+    return content
+
+
+def build_customers_xml(codes=None):
+    '''
+    Combines the customers in the customer fixtures into one customers
+    document, giving them the codes c0, c1, c2 unless told otherwise.
+
+    c0 is on TRACKED_MONTHLY with items, c1 on FREE_MONTHLY and c2 on
+    PAID_MONTHLY, canceled.
+    '''
+    codes = codes or ['c0', 'c1', 'c2']
+    customers = []
+    for filename, code in zip(CUSTOMER_FILES, codes):
+        content = load_file(filename)
+        customer = content[content.index('<customer '):
+                           content.rindex('</customers>')]
+        customers.append(customer.replace('code="test"',
+                                          'code="%s"' % code, 1))
+
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<customers>%s'
+            '</customers>' % ''.join(customers))
+
+
+class FakeResponse(object):
+    ''' Stand in for an httplib2 response. '''
+    reason = 'Fake'
+
+    def __init__(self, status=200, content=''):
+        self.status = status
+        self.content = content
+
+
+def get_cheddar_error(exception_class, status):
+    ''' Builds a cheddar error as if the response had the given status. '''
+    return exception_class(FakeResponse(status), load_file('error.xml'))
+
+
+class FakeClient(object):
+    '''
+    Stand in for a Client which answers every request with content instead
+    of sending it, or with a 404 if content is None.  Requests are recorded
+    as (path, params, data, method) tuples.  An exception in errors, keyed
+    by path, is raised by the next request for that path.
+    '''
+
+    def __init__(self, content='', errors=None):
+        self.content = content
+        self.errors = errors or {}
+        self.requests = []
+
+    def answer(self, path, params, data, method):
+        self.requests.append((path, params, data, method))
+        error = self.errors.pop(path, None)
+        if error is None and self.content is None:
+            error = get_cheddar_error(NotFound, 404)
+        if error is not None:
+            raise error
+
+    def make_request(self, path, params=None, data=None, method=None,
+                     idempotent=None, mutation=None):
+        self.answer(path, params, data, method)
+        return FakeResponse(200, self.content)
+
+    def open_request(self, path, params=None, data=None, method=None,
+                     idempotent=None):
+        self.answer(path, params, data, method)
+        return StringIO(self.content)